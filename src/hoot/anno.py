@@ -3,14 +3,21 @@
 ## Provides tools to load binary masks from encoded COCO RLE format
 
 import json
-from dataclasses import dataclass, field
+import hashlib
+from functools import cached_property
+from dataclasses import dataclass, field, fields
 from dacite import from_dict
 from typing import List, Union
 from types import SimpleNamespace
-from typing import List, Union, Optional, Tuple
+from typing import List, Union, Optional, Tuple, Dict
 from pycocotools import mask
 import numpy as np
+from hoot import metrics
 from pathlib import Path
+import os
+from collections.abc import Sequence
+from collections import OrderedDict
+import threading
 
 ## Occlusion tags class, provides a mapping from attr to str
 class OcclusionTags(SimpleNamespace):
@@ -38,21 +45,145 @@ class TargetTags(SimpleNamespace):
     self_propelled = "self_propelled"
     animate = "animate"
 
+## Thread-safe LRU cache bounded by the total size in bytes of its values
+## Keeps hit/miss counters so the cache budget can be tuned
+class LRUByteCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes: int):
+        with self._lock:
+            if nbytes > self.max_bytes or key in self._entries:
+                return
+            self._entries[key] = (value, nbytes)
+            self.size += nbytes
+            ## Evict least recently used entries until we're back under budget
+            while self.size > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.size -= evicted_bytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries),
+                "size": self.size, "max_bytes": self.max_bytes}
+
+## Opt-in caches shared by all Mask instances, disabled (None) by default
+## _decoded_mask_cache holds decoded bitmaps, _counts_cache holds the hex-to-bytes converted counts
+_decoded_mask_cache: Optional[LRUByteCache] = None
+_counts_cache: Optional[LRUByteCache] = None
+
+## Enables the shared mask caches with the given byte budgets (0 leaves a cache disabled)
+## Keeping a counts cache lets a frame skip bytes.fromhex even after its bitmap has been evicted
+def enable_mask_cache(max_bytes: int=1 << 30, counts_max_bytes: int=0) -> None:
+    global _decoded_mask_cache, _counts_cache
+    _decoded_mask_cache = LRUByteCache(max_bytes) if max_bytes > 0 else None
+    _counts_cache = LRUByteCache(counts_max_bytes) if counts_max_bytes > 0 else None
+
+## Disables and empties the shared mask caches
+def disable_mask_cache() -> None:
+    global _decoded_mask_cache, _counts_cache
+    _decoded_mask_cache = None
+    _counts_cache = None
+
+## Returns hit/miss counters and sizes of the enabled mask caches
+def mask_cache_stats() -> dict:
+    stats = {}
+    if _decoded_mask_cache is not None:
+        stats["masks"] = _decoded_mask_cache.stats()
+    if _counts_cache is not None:
+        stats["counts"] = _counts_cache.stats()
+    return stats
+
 ## Mask class that holds a COCO RLE encoded mask
+## counts is hex encoded when read from anno.json, raw bytes when read from anno.bin (see hoot/binary_anno.py)
 ## Provides a property to return the decoded binary mask
 @dataclass
 class Mask:
     size: List[int]
-    counts: str
+    counts: Union[str, bytes]
+
+    ## Cache key for the counts - a digest, so the shared caches don't hold a copy of every hex string
+    ## (which is twice the size of the cached counts bytes). Computed once per Mask, so a cache hit is a dict lookup
+    @cached_property
+    def counts_key(self) -> bytes:
+        counts = self.counts.encode('ascii') if isinstance(self.counts, str) else self.counts
+        return hashlib.blake2b(counts, digest_size=16).digest()
+
+    ## Function that converts mask counts to bytes, cached if the counts cache is enabled
+    @property
+    def counts_bytes(self) -> bytes:
+        if isinstance(self.counts, bytes):
+            return self.counts
+        cache = _counts_cache
+        if cache is None:
+            return bytes.fromhex(self.counts)
+        key = self.counts_key
+        counts_bytes = cache.get(key)
+        if counts_bytes is None:
+            counts_bytes = bytes.fromhex(self.counts)
+            cache.put(key, counts_bytes, len(counts_bytes) + len(key))
+        return counts_bytes
 
     ## Function that converts mask counts to bytes and decodes it
-    ## Returns a binary 2D array
+    ## Returns a binary 2D array - read-only if it came from the shared mask cache
     @property
     def mask(self) -> np.ndarray:
-        counts_bytes = bytes.fromhex(self.counts)
-        mask_mat = mask.decode({"size": self.size, "counts":counts_bytes})
+        cache = _decoded_mask_cache
+        if cache is None:
+            return mask.decode({"size": self.size, "counts": self.counts_bytes})
+
+        key = (self.size[0], self.size[1], self.counts_key)
+        mask_mat = cache.get(key)
+        if mask_mat is None:
+            mask_mat = mask.decode({"size": self.size, "counts": self.counts_bytes})
+            mask_mat.flags.writeable = False
+            cache.put(key, mask_mat, mask_mat.nbytes)
         return mask_mat
 
+    ## COCO RLE dict that can be passed to pycocotools.mask functions without decoding
+    @property
+    def rle(self) -> dict:
+        return {"size": self.size, "counts": self.counts_bytes}
+
+    ## Number of mask pixels, computed on the RLE
+    @property
+    def area(self) -> int:
+        return int(mask.area(self.rle))
+
+    ## Mask bounding box as [x, y, w, h], computed on the RLE
+    @property
+    def bbox(self) -> List[float]:
+        return mask.toBbox(self.rle).tolist()
+
+## Converts a polygon (list of [x, y] points, eg. rot_bb or aa_bb) to a COCO RLE of the given size
+## Returns None if the polygon isn't annotated (eg. absent target)
+def polygon_to_rle(polygon: List[List[float]], height: int, width: int) -> Optional[dict]:
+    points = [coord for pt in polygon for coord in pt]
+    if len(points) < 6:
+        return None
+    return mask.frPyObjects([points], height, width)[0]
+
 ## Occlusion Masks class that holds all occlusion masks for a frame
 ## If a certain type of occluder does not exists for the frame, stores empty list
 ## Provides get_masks fn to return masks for a given list of occ. types
@@ -84,6 +215,52 @@ class OcclusionMasks:
             else:
                 assert False, 'unrecognized occ_type'
 
+    ## RLEs of the masks present for the given occ. types (all layers except 'all' by default)
+    def rles(self, occ_types: Optional[List[str]]=None) -> List[dict]:
+        if occ_types is None:
+            occ_types = ["s", "sp", "st", "t"]
+        return [m.rle for _, m in self.get_masks(occ_types) if m]
+
+    ## Union of the given occluder layers as a single RLE (None if there are no masks)
+    def union(self, occ_types: Optional[List[str]]=None) -> Optional[dict]:
+        rles = self.rles(occ_types)
+        if not rles:
+            return None
+        return mask.merge(rles, intersect=False)
+
+    ## Intersection of the given occluder layers as a single RLE (None if any layer is missing)
+    def intersection(self, occ_types: Optional[List[str]]=None) -> Optional[dict]:
+        if occ_types is None:
+            occ_types = ["s", "sp", "st", "t"]
+        rles = self.rles(occ_types)
+        if not rles or len(rles) != len(occ_types):
+            return None
+        return mask.merge(rles, intersect=True)
+
+    ## Area of the union of the given occluder layers, computed on the RLE
+    def area(self, occ_types: Optional[List[str]]=None) -> int:
+        union = self.union(occ_types)
+        return int(mask.area(union)) if union is not None else 0
+
+    ## Fraction of the target polygon (eg. frame.rot_bb) covered by the union of the given occluder layers
+    ## Returns nan if there's no annotated target, 0 if there are no occluders
+    def target_overlap(self, polygon: List[List[float]], occ_types: Optional[List[str]]=None) -> float:
+        union = self.union(occ_types)
+        if union is not None:
+            height, width = union["size"]
+        elif polygon:
+            ## No mask to take the frame size from, a canvas that holds the polygon gives the same area
+            height = int(np.ceil(max(pt[1] for pt in polygon))) + 1
+            width = int(np.ceil(max(pt[0] for pt in polygon))) + 1
+        else:
+            return float("nan")
+        target = polygon_to_rle(polygon, max(height, 1), max(width, 1))
+        if target is None or mask.area(target) == 0:
+            return float("nan")
+        if union is None:
+            return 0.0
+        return float(mask.area(mask.merge([union, target], intersect=True)) / mask.area(target))
+
 
 ## Frame Attributes class which holds frame-level occlusion attributes 
 @dataclass
@@ -118,6 +295,14 @@ class Frame:
         h = max_y - min_y
         return [min_x, min_y, w, h]
 
+## Stacks a list of 4-point boxes (rot_bb/aa_bb) into an (N,4,2) float array, NaN where a box isn't annotated
+def polygon_array(boxes: List[List[List[float]]]) -> np.ndarray:
+    polygons = np.full((len(boxes), 4, 2), np.nan)
+    for idx, box in enumerate(boxes):
+        if len(box) == 4:
+            polygons[idx] = box
+    return polygons
+
 ## Video class that hold video key, path and a list of frame objects, as well as other video data
 @dataclass
 class Video:
@@ -137,6 +322,21 @@ class Video:
     def __post_init__(self):
         self.frames.sort(key=lambda f: f.frame_id)
 
+    ## Boxes of all frames as an (N,4,2) array, box is 'aa_bb' or 'rot_bb' - frames without a 4-point box are NaN
+    def polygons(self, box: str="aa_bb") -> np.ndarray:
+        return polygon_array([getattr(frame, box) for frame in self.frames])
+
+    ## Vectorized Frame.to_xywh over the whole video, returns an (N,4) x,y,w,h array
+    def to_xywh(self) -> np.ndarray:
+        from hoot.geometry import polygons_to_xywh
+        return polygons_to_xywh(self.polygons("aa_bb"))
+
+    ## Streams (frame, image, masks) with images decoded ahead on a thread pool - see hoot.frames.iter_frames
+    def iter_frames(self, prefetch: int=8, workers: int=4, with_masks: Optional[List[str]]=None, resize=None,
+                    reuse_buffers: bool=False, start: int=0, stop: Optional[int]=None, cached=None):
+        from hoot.frames import iter_frames
+        return iter_frames(self, prefetch, workers, with_masks, resize, reuse_buffers, start, stop, cached)
+
     ## Computes video-level occlusion tags from frame tags
     ## e.g. if any frame is video has solid occluder, it gets added to video tags
     @property
@@ -164,24 +364,173 @@ class Video:
                 video_tags.add(OcclusionTags.partial_obj_occlusion)
         return list(video_tags)
 
+## Computes per-frame occlusion statistics for a whole video directly on the COCO RLEs, without decoding any bitmaps
+## box selects the target polygon ('rot_bb' or 'aa_bb'), occ_types the occluder layers (all except 'all' by default)
+## Returns a dict of NumPy arrays with one entry per frame:
+##   area_<type>, overlap_<type> - layer area in pixels and fraction of the target it covers (for each occ type)
+##   union_area, union_overlap   - the same for the union of all given layers
+##   target_area                 - target polygon area in pixels (0 if absent, overlaps are nan then)
+##   union_bbox                  - (N,4) x,y,w,h box of the union of all given layers
+def occlusion_stats(video: Video, box: str="rot_bb", occ_types: Optional[List[str]]=None) -> Dict[str, np.ndarray]:
+    if occ_types is None:
+        occ_types = ["s", "sp", "st", "t"]
+    num_frames = len(video.frames)
+    empty = mask.encode(np.zeros((video.height, video.width), dtype=np.uint8, order='F'))
+
+    ## Build RLE lists - missing layers/targets become an empty RLE so everything can be batched
+    layer_rles = {occ_type: [] for occ_type in occ_types}
+    union_rles = []
+    target_rles = []
+    for frame in video.frames:
+        rles = []
+        for occ_type, m in frame.occ_masks.get_masks(occ_types):
+            rle = m.rle if m else empty
+            layer_rles[occ_type].append(rle)
+            if m:
+                rles.append(rle)
+        union_rles.append(mask.merge(rles, intersect=False) if rles else empty)
+        target = polygon_to_rle(getattr(frame, box), video.height, video.width)
+        target_rles.append(target if target is not None else empty)
+
+    stats = {}
+    if num_frames == 0:
+        return stats
+
+    target_area = mask.area(target_rles).astype(np.float64)
+    stats["target_area"] = target_area
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for occ_type in occ_types:
+            stats[f"area_{occ_type}"] = mask.area(layer_rles[occ_type]).astype(np.float64)
+            overlap = mask.area([mask.merge([l, t], intersect=True) for l, t in zip(layer_rles[occ_type], target_rles)])
+            stats[f"overlap_{occ_type}"] = np.where(target_area > 0, overlap / target_area, np.nan)
+        stats["union_area"] = mask.area(union_rles).astype(np.float64)
+        overlap = mask.area([mask.merge([u, t], intersect=True) for u, t in zip(union_rles, target_rles)])
+        stats["union_overlap"] = np.where(target_area > 0, overlap / target_area, np.nan)
+    stats["union_bbox"] = mask.toBbox(union_rles)
+    return stats
+
+## Keys of a dict that are fields of a dataclass - unknown anno.json keys are dropped, as dacite does
+def _known_fields(cls, data: dict) -> dict:
+    names = _FIELD_NAMES.get(cls)
+    if names is None:
+        names = _FIELD_NAMES[cls] = frozenset(f.name for f in fields(cls))
+    return {k: v for k, v in data.items() if k in names}
+
+_FIELD_NAMES: Dict[type, frozenset] = {}
+
+## Builds a Frame directly from its anno.json dict - much faster than running dacite per frame
+def frame_from_dict(frame_data: dict, videopath: Path) -> Frame:
+    frame_id = int(frame_data['frame_id'])
+    occ_masks = OcclusionMasks(**_known_fields(OcclusionMasks, {
+        occ_type: Mask(**_known_fields(Mask, m)) if isinstance(m, dict) else m
+        for occ_type, m in frame_data['occ_masks'].items()}))
+    return Frame(
+        frame_id=frame_id,
+        frame_path=str(videopath.joinpath(f'{frame_id:06}.png')),
+        rot_bb=frame_data['rot_bb'],
+        aa_bb=frame_data['aa_bb'],
+        occ_masks=occ_masks,
+        attributes=FrameAttributes(**_known_fields(FrameAttributes, frame_data['attributes']))
+    )
+
+## Sequence of frames that keeps the raw anno.json dicts and only builds Frame objects when indexed or sliced
+## Built frames are kept, so each frame is parsed at most once
+class LazyFrames(Sequence):
+    def __init__(self, frame_dicts: List[dict], videopath: Path):
+        self._frame_dicts = sorted(frame_dicts, key=lambda f: int(f['frame_id']))
+        self._frames: List[Optional[Frame]] = [None] * len(self._frame_dicts)
+        self._videopath = videopath
+
+    def __len__(self) -> int:
+        return len(self._frame_dicts)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        frame = self._frames[idx]
+        if frame is None:
+            frame = frame_from_dict(self._frame_dicts[idx], self._videopath)
+            self._frames[idx] = frame
+        return frame
+
+    ## Raw anno.json dict of a frame, without building the Frame (see also BinaryFrames.raw)
+    def raw(self, idx: int) -> dict:
+        return self._frame_dicts[idx]
+
+    ## Boxes of all frames as an (N,4,2) array, read from the raw frame dicts without building any frames
+    def polygons(self, box: str="aa_bb") -> np.ndarray:
+        return polygon_array([frame_data[box] for frame_data in self._frame_dicts])
+
+## Video whose frames are parsed on demand, video-level fields are available right away
+@dataclass
+class LazyVideo(Video):
+    frames: LazyFrames
+
+    ## Frames are already sorted by LazyFrames
+    def __post_init__(self):
+        pass
+
+    ## Boxes of all frames as an (N,4,2) array, without building any frames
+    def polygons(self, box: str="aa_bb") -> np.ndarray:
+        return self.frames.polygons(box)
+
+    ## Computes video-level occlusion tags straight from the raw frame dicts, without building any frames
+    @property
+    def occlusion_tags(self) -> List[str]:
+        video_tags = set()
+        occ_type_tags = {"s": OcclusionTags.solid, "sp": OcclusionTags.sparse,
+                         "st": OcclusionTags.semi_transparent, "t": OcclusionTags.transparent}
+        for idx in range(len(self.frames)):
+            frame_data = self.frames.raw(idx)
+            for occ_type, tag in occ_type_tags.items():
+                if type(frame_data['occ_masks'].get(occ_type, [])) != list:
+                    video_tags.add(tag)
+            for attr, value in _known_fields(FrameAttributes, frame_data['attributes']).items():
+                if value:
+                    video_tags.add(getattr(OcclusionTags, attr))
+        return list(video_tags)
+
 ## Loads video annotations for HOOT
-def load_video_from_file(videopath: Path, in_test=None, annopath=None, metapath=None) -> Video:
-    ## If not given specifically, load anno.json/meta.info from default path
+## If lazy is set, returns a LazyVideo whose frames are only parsed when accessed
+## If scale is set (0.5, 0.25 or 0.125), loads that pyramid level of the video instead (see hoot/pyramid.py) -
+## frame paths, boxes, masks and width/height are then all at that resolution
+## A video folder's anno.bin (see hoot/binary_anno.py) is read instead of its anno.json, unless annopath is given
+def load_video_from_file(videopath: Path, in_test=None, annopath=None, metapath=None, lazy: bool=False,
+                         scale: Optional[float]=None) -> Video:
+    if scale is not None and scale != 1:
+        from hoot.pyramid import pyramid_level_path
+        assert annopath is None and metapath is None, 'scale loads the annotations of the pyramid level'
+        videopath = pyramid_level_path(Path(videopath), scale)
+        assert videopath.joinpath('anno.json').exists(), f'{videopath} not found, build it with hoot build-pyramid'
+    ## If not given specifically, load anno.bin or anno.json/meta.info from default path
+    binary = None
     if annopath is None:
+        from hoot.binary_anno import open_binary_annotations
+        binary = open_binary_annotations(videopath)
         annopath = videopath.joinpath('anno.json')
-        assert annopath.exists()
+        assert binary is not None or annopath.exists()
     if metapath is None:
         metapath = videopath.joinpath('meta.info')
         assert metapath.exists()
 
+    if binary is not None:
+        from hoot.binary_anno import binary_video
+        with open(metapath, 'r') as f:
+            meta_data = json.load(f)
+        motion_tags, target_tags = load_tags_from_metadata(meta_data)
+        with metrics.span('anno_parse', video=str(videopath), bytes=binary.size, format='binary'):
+            return binary_video(binary, videopath, lazy, height=int(meta_data['height']), width=int(meta_data['width']),
+                                motion_tags=motion_tags, target_tags=target_tags)
+
     # Edit annotation dict to add path and test video info
-    with open(annopath, 'r') as f:
+    with metrics.span('anno_parse', video=str(videopath), bytes=os.path.getsize(annopath)), open(annopath, 'r') as f:
         anno_data = json.load(f)
     anno_data['video_path'] = str(videopath)
     anno_data['in_test'] = in_test
-    for f in anno_data['frames']:
-        frame_id = int(f['frame_id'])
-        f['frame_path'] = str(videopath.joinpath(f'{frame_id:06}.png'))
+    if not lazy:
+        for f in anno_data['frames']:
+            frame_id = int(f['frame_id'])
+            f['frame_path'] = str(videopath.joinpath(f'{frame_id:06}.png'))
 
     # Load metadata.info json
     with open(metapath, 'r') as f:
@@ -192,8 +541,24 @@ def load_video_from_file(videopath: Path, in_test=None, annopath=None, metapath=
     anno_data['motion_tags'] = motion_tags
     anno_data['target_tags'] = target_tags
 
+    # Lazy videos keep the raw frame dicts and build frames on access
+    if lazy:
+        return LazyVideo(
+            video_key=anno_data['video_key'],
+            video_path=anno_data['video_path'],
+            frames=LazyFrames(anno_data['frames'], Path(videopath)),
+            frame_occlusion_level=anno_data['frame_occlusion_level'],
+            median_target_occlusion_level=anno_data['median_target_occlusion_level'],
+            mean_target_occlusion_level=anno_data['mean_target_occlusion_level'],
+            height=anno_data['height'],
+            width=anno_data['width'],
+            motion_tags=motion_tags,
+            target_tags=target_tags
+        )
+
     # Load rest o the annotations from the anno.json file
-    video = from_dict(data_class=Video, data=anno_data)
+    with metrics.span('anno_build', video=str(videopath), frames=len(anno_data['frames'])):
+        video = from_dict(data_class=Video, data=anno_data)
     return video
 
 ## Loads video-level tags like motion and target tags from the meta.info
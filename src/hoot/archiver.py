@@ -1,53 +1,223 @@
 import shutil
 import multiprocessing
 import dataclasses
-from tqdm import tqdm
-from typing import Optional, NamedTuple, Tuple, List
+from typing import Optional, NamedTuple, Tuple, List, Dict
 from pathlib import Path
 import json
 import pickle
 import re
 import os
+import zipfile
+import hashlib
+import dacite
 from hoot.anno import load_video_from_file, OcclusionMasks, OcclusionTags, MotionTags
 
-from hoot.utils import package_folder, validate_class_name, PackageInfo
+from hoot.utils import package_folder, validate_class_name, validate_version, PackageInfo, pool_map, hash_file, compression_policy
+from hoot.manifest import zip_manifest, write_manifest, manifest_path
 from hoot.metadata import HootDataset, TargetClass, AnnotatedVideo, OcclusionLevels
+from hoot.binary_anno import ANNO_BINARY_NAME, ANNO_BINARY_MAGIC, pack_annotation_file
 
 allowed_file_types = {'.png', '.json', '.txt', '.info'}
 
 class ArchiveArgs(NamedTuple):
     id: str
+    class_name: str
     frame_set_dir: str
     dest_frame_set_zip: str
     file_allow_list: str
+    fingerprint: str
+    journal_path: str
+    legacy_cache: Optional[str]=None
+    compression: Optional[Dict[str, Tuple[int, Optional[int]]]]=None
+    binary_anno: bool=False
 
 @dataclasses.dataclass
 class ArchiveResult:
     package_info: PackageInfo
     occlusion_levels: OcclusionLevels
 
-def archive_job(args: ArchiveArgs) -> PackageInfo:
-    '''Used to pass multiple arguments into a multiprocessing pool'''
+## One archive journal line per zipped video, see make_archive
+@dataclasses.dataclass
+class JournalEntry:
+    key: str
+    fingerprint: str
+    id: str
+    sha256: str
+    original_size: int
+    zip_sha256: str
+    download_size: int
+    occlusion_levels: OcclusionLevels
+    tags: List[str] = dataclasses.field(default_factory=list)
+    ## extension -> [original bytes, compressed bytes]
+    member_sizes: Dict[str, List[int]] = dataclasses.field(default_factory=dict)
+    merkle_root: Optional[str] = None
+
+JOURNAL_NAME = '.hoot.journal.jsonl'
+
+## Result cache file names: .hoot.<class>.<id>.<sha256>.<original_size>.<zip_sha256>
+## (caches written by older versions don't have the zip_sha256)
+## Only read to migrate archives built before the journal existed
+result_cache_regex = re.compile(r'\.hoot\..+\.(\d+)\.([0-9a-f]{64})\.(\d+)(?:\.([0-9a-f]{64}))?')
+
+def source_fingerprint(frame_set_dir: Path, file_allow_list, compression: Optional[Dict[str, Tuple[int, Optional[int]]]]=None,
+                       binary_anno: bool=False) -> str:
+    '''Fingerprint of the files that go into a frame set's zip - their names, sizes and mtimes
+        The compression policy and the anno.bin format (if emitted) are included, so changing them rezips every video
+    '''
+    fingerprint = hashlib.sha256()
+    if compression is not None:
+        fingerprint.update(repr(sorted(compression.items())).encode('utf-8'))
+    if binary_anno:
+        fingerprint.update(ANNO_BINARY_MAGIC)
+    for f in sorted(os.scandir(frame_set_dir), key=lambda e: e.name):
+        if not f.is_file() or os.path.splitext(f.name)[1] not in file_allow_list:
+            continue
+        st = f.stat()
+        fingerprint.update(f'{f.name}\0{st.st_size}\0{st.st_mtime_ns}\n'.encode('utf-8'))
+    return fingerprint.hexdigest()
+
+def newest_source_mtime(frame_set_dir: Path, file_allow_list) -> float:
+    '''Latest mtime of the files that go into a frame set's zip (0 if there are none)'''
+    return max((f.stat().st_mtime for f in os.scandir(frame_set_dir)
+                if f.is_file() and os.path.splitext(f.name)[1] in file_allow_list), default=0.0)
+
+def append_journal(journal_path: Path, entry: JournalEntry) -> None:
+    '''Appends an entry with a single O_APPEND write, so lines from pool workers don't interleave'''
+    line = (json.dumps(dataclasses.asdict(entry)) + '\n').encode('utf-8')
+    fd = os.open(journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+def load_journal(journal_path: Path) -> Dict[str, JournalEntry]:
+    '''Reads the archive journal, the last entry for a video wins
+        A truncated last line (eg. from a killed run) is ignored
+    '''
+    entries = {}
+    if not journal_path.exists():
+        return entries
+    with open(journal_path, 'r') as f:
+        for line in f:
+            try:
+                entry = dacite.from_dict(data_class=JournalEntry, data=json.loads(line))
+            except (ValueError, dacite.DaciteError):
+                continue
+            entries[entry.key] = entry
+    return entries
+
+def write_journal(journal_path: Path, entries: List[JournalEntry]) -> None:
+    '''Rewrites the journal with exactly one line per video'''
+    tmp_path = Path(str(journal_path) + '.tmp')
+    with open(tmp_path, 'w') as f:
+        for entry in entries:
+            f.write(json.dumps(dataclasses.asdict(entry)) + '\n')
+    os.replace(tmp_path, journal_path)
+
+def archive_job(args: ArchiveArgs) -> JournalEntry:
+    '''Used to pass multiple arguments into a multiprocessing pool
+        Zips a frame set and parses its anno.json, then appends the result to the archive journal
+        Zips into a .tmp file and only renames + journals once the zip is complete,
+        so an interrupted run never leaves a journal entry pointing at a partial zip
+        Frame sets with a legacy result cache aren't rezipped, only parsed
+        Also writes the zip's per-file manifest next to it (see hoot/manifest.py)
+        With binary_anno, the zip also gets an anno.bin packed from the anno.json (see hoot/binary_anno.py)
+    '''
     assert isinstance(args, ArchiveArgs)
-    (id, frame_set_dir, dest_frame_set_zip, file_allow_list) = args
-    return package_folder(id, frame_set_dir, dest_frame_set_zip, file_allow_list)
+    zip_path = Path(args.dest_frame_set_zip)
+    if args.legacy_cache is not None:
+        match_result = result_cache_regex.match(Path(args.legacy_cache).name)
+        assert match_result is not None
+        with zipfile.ZipFile(zip_path, 'r') as data_zip:
+            manifest = zip_manifest(data_zip)
+        result = PackageInfo(match_result.group(1), int(match_result.group(3)), match_result.group(2), str(zip_path),
+                             match_result.group(4) or hash_file(zip_path).hexdigest(), manifest_member_sizes(manifest), manifest)
+    else:
+        tmp_zip = Path(str(zip_path) + '.tmp')
+        extra_files = {}
+        if args.binary_anno:
+            extra_files[ANNO_BINARY_NAME] = pack_annotation_file(Path(args.frame_set_dir).joinpath('anno.json'))
+        result = package_folder(args.id, Path(args.frame_set_dir), tmp_zip, args.file_allow_list, args.compression, extra_files)
+        os.replace(tmp_zip, zip_path)
+    write_manifest(Path(manifest_path(zip_path)), result.manifest)
 
-def make_archive(directory: str, destination: str, version: str, threads: Optional[int]=None, clean: bool=False):
-    '''builds a complete Hoot archive + metadata.json
-        If an archive operation should fail, make_archive will resume from the last successful
-        zip operation. To accomplish this, make_archive will write a 'result_cache'
-        file to the destination/*class folder for each video:
+    video_data = load_video_from_file(Path(args.frame_set_dir), lazy=True)
+    entry = JournalEntry(
+        key=f'{args.class_name}/{args.id}',
+        fingerprint=args.fingerprint,
+        id=result.id,
+        sha256=result.sha256,
+        original_size=result.original_size,
+        zip_sha256=result.zip_sha256,
+        download_size=os.path.getsize(zip_path),
+        occlusion_levels=OcclusionLevels(
+            video_data.frame_occlusion_level,
+            video_data.mean_target_occlusion_level,
+            video_data.median_target_occlusion_level
+        ),
+        tags=sorted(video_data.occlusion_tags),
+        member_sizes=result.member_sizes,
+        merkle_root=result.manifest['merkle_root']
+    )
+    append_journal(Path(args.journal_path), entry)
+    return entry
+
+def manifest_member_sizes(manifest: dict) -> Dict[str, List[int]]:
+    '''Original and compressed bytes per file extension of a zip, from its manifest'''
+    member_sizes = {}
+    for member in manifest['files']:
+        sizes = member_sizes.setdefault(os.path.splitext(member['name'])[1], [0, 0])
+        sizes[0] += member['size']
+        sizes[1] += member['compress_size']
+    return member_sizes
 
-        eg .hoot.apple.001.e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855.1827573571861812
-                 id                                   sha265                          original_size
+def print_compression_stats(entries: List[JournalEntry]) -> None:
+    '''Prints the compression ratio of each file type over the whole archive'''
+    totals = {}
+    for entry in entries:
+        for ext, (original, compressed) in entry.member_sizes.items():
+            sizes = totals.setdefault(ext, [0, 0])
+            sizes[0] += original
+            sizes[1] += compressed
+    if not totals:
+        return
+    print(f'{"type":<8} {"original MB":>12} {"zipped MB":>12} {"ratio":>8}')
+    for ext, (original, compressed) in sorted(totals.items(), key=lambda kv: -kv[1][0]):
+        ratio = original / compressed if compressed else float('inf')
+        print(f'{ext:<8} {original / 1048576:>12.2f} {compressed / 1048576:>12.2f} {ratio:>7.2f}x')
 
-        Once all the zips and result_caches are built, make_archive will assemble all the metadata
+def find_result_cache(caches: List[Path], class_name: str, frame_set_name: str) -> Optional[Path]:
+    '''Returns the result cache file for a frame set, if there is one'''
+    prefix = f'.hoot.{class_name}.{frame_set_name}.'
+    for c in caches:
+        if c.name.startswith(prefix):
+            return c
+    return None
+
+def make_archive(directory: str, destination: str, version: str, threads: Optional[int]=None, clean: bool=False,
+                 compress_level: int=6, binary_anno: bool=False):
+    '''builds a complete Hoot archive + metadata.json
+        make_archive keeps a journal in destination/.hoot.journal.jsonl with one json line per video:
+        a fingerprint of its source files (names, sizes, mtimes), the zip's size and sha256 and the
+        occlusion levels/tags parsed from its anno.json
+        Next to each zip, <id>.manifest.json lists every member's sha256 and zip offsets - its Merkle root
+        goes into metadata.json, so downloads can be verified and repaired file by file
+
+        On a rebuild, only frame sets whose fingerprint changed (or whose zip is missing) are rezipped
+        and reparsed - metadata.json is then assembled from the journal in one pass.
+        Workers append to the journal as each zip completes, so an interrupted build resumes where it stopped.
+        Archives built by older versions (with .hoot.<class>.<id>.* result cache files) are migrated
+        into the journal without being rezipped.
+        Zipping runs on a process pool with 'threads' workers (cpu count if None)
+        PNG frames are stored as is, text members are deflated at compress_level (see COMPRESSION_POLICY)
+        binary_anno adds an anno.bin to every zip, which load_video_from_file reads instead of the anno.json
+        Zips and manifests of journaled videos whose frame set was removed from directory are deleted
     '''
-    
+    assert validate_version(version)
+
     # handle directories
     dir = Path(directory)
     dest = Path(destination)
-    #breakpoint()
     if dest.exists() and clean:
         shutil.rmtree(dest)
         dest.mkdir()
@@ -61,7 +231,6 @@ def make_archive(directory: str, destination: str, version: str, threads: Option
     for f in hoot_files:
         if f.name.endswith('.txt') == False:
             continue
-        # print(f, dest.joinpath(f.name))
         shutil.copy(f, dest.joinpath(f.name))
         if f.name == "test.txt":
             with open(f, "r") as fr:
@@ -69,85 +238,103 @@ def make_archive(directory: str, destination: str, version: str, threads: Option
     assert len(test_video_keys) != 0
 
     # assemble all class directories
-    class_directories = [d for d in sorted(dir.iterdir()) if d.is_dir()]
+    ## (hidden folders like .hoot.pyramid hold derived data, not classes)
+    class_directories = [d for d in sorted(dir.iterdir()) if d.is_dir() and not d.name.startswith('.')]
+    journal_path = dest.joinpath(JOURNAL_NAME)
+    journal = load_journal(journal_path)
+    compression = compression_policy(compress_level)
 
-    # archive clss folders - MAJORITY OF CPU TIME HERE
+    # collect zip jobs for frame sets that are new or changed since they were journaled
+    frame_set_keys = []
+    archive_jobs = []
     for class_dir in class_directories:
         assert validate_class_name(class_dir.name)
         dest_class_dir = dest.joinpath(class_dir.name)
         dest_class_dir.mkdir(exist_ok=True)
 
         frame_sets = [d for d in sorted(class_dir.iterdir()) if d.is_dir()]
-        frame_set_caches = [c for c in sorted(class_dir.iterdir()) if c.name.startswith(f'.hoot.')]
-        print(frame_set_caches)
-        for frame_set in tqdm(frame_sets, desc='zipping videos'):
-            
-            #check frame_set_caches
-            has_cache = False
-            for c in frame_set_caches:
-                if c.name.startswith(f'.hoot.{class_dir.name}.{frame_set.name}'):
-                    has_cache = True
-                    print(f'found cache file: {clean} {c}')
-                    break
-            if has_cache and clean == False:
+        frame_set_caches = None
+        for frame_set in frame_sets:
+            key = f'{class_dir.name}/{frame_set.name}'
+            frame_set_keys.append((class_dir.name, key))
+            dest_zip = dest_class_dir.joinpath(f'{frame_set.name}.zip')
+            fingerprint = source_fingerprint(frame_set, allowed_file_types, compression, binary_anno)
+            entry = journal.get(key)
+            if (entry is not None and entry.fingerprint == fingerprint and entry.merkle_root is not None
+                    and dest_zip.exists() and os.path.exists(manifest_path(dest_zip))):
                 continue
-            
-            # zip package and write hidden '.hoot.*...' result cache file
-            result = package_folder(frame_set.name, frame_set, dest_class_dir.joinpath(f'{frame_set.name}.zip'), allowed_file_types)
-            dest_class_dir.joinpath(f'.hoot.{class_dir.name}.{frame_set.name}.{result.sha256}.{result.original_size}').touch()
 
+            legacy_cache = None
+            ## (legacy zips have no anno.bin, so they're rebuilt when one is wanted)
+            if entry is None and dest_zip.exists() and not binary_anno:
+                if frame_set_caches is None:
+                    frame_set_caches = [c for c in sorted(dest_class_dir.iterdir()) if c.name.startswith('.hoot.')]
+                legacy_cache = find_result_cache(frame_set_caches, class_dir.name, frame_set.name)
+                ## A legacy zip older than any of its source files is stale - rezip it instead of migrating it
+                if legacy_cache is not None and newest_source_mtime(frame_set, allowed_file_types) > os.path.getmtime(dest_zip):
+                    legacy_cache = None
+            archive_jobs.append(ArchiveArgs(
+                frame_set.name,
+                class_dir.name,
+                str(frame_set),
+                str(dest_zip),
+                allowed_file_types,
+                fingerprint,
+                str(journal_path),
+                str(legacy_cache) if legacy_cache is not None else None,
+                compression,
+                binary_anno
+            ))
+
+    print(f'{len(archive_jobs)} of {len(frame_set_keys)} videos changed since the last build')
 
+    # archive class folders - MAJORITY OF CPU TIME HERE
+    for entry in pool_map(archive_job, archive_jobs, threads, desc='zipping videos'):
+        journal[entry.key] = entry
 
-    # compile metadata
+    # drop videos whose frame set was removed from the source since they were journaled
+    removed_keys = set(journal) - {key for _, key in frame_set_keys}
+    for key in sorted(removed_keys):
+        dest_zip = dest.joinpath(f'{key}.zip')
+        for path in [dest_zip, Path(manifest_path(dest_zip)), Path(str(dest_zip) + '.tmp')]:
+            if path.exists():
+                path.unlink()
+        del journal[key]
+    for class_dir in {dest.joinpath(key).parent for key in removed_keys}:
+        if class_dir.is_dir() and not any(class_dir.iterdir()):
+            class_dir.rmdir()
+    if removed_keys:
+        print(f'{len(removed_keys)} videos removed since the last build')
+
+    # compile metadata straight from the journal
     dataset = HootDataset(
-        version='1.0',
+        version=version,
         change_log='Initial Release'
     )
+    target_classes = {}
+    for class_name, key in frame_set_keys:
+        if class_name not in target_classes:
+            target_classes[class_name] = TargetClass(class_name)
+            dataset.classes.append(target_classes[class_name])
+        entry = journal[key]
+        in_test = f'{class_name}-{entry.id}' in test_video_keys
+        target_classes[class_name].videos.append(AnnotatedVideo(
+            id=entry.id,
+            path=f'{key}.zip',
+            sha256=entry.sha256,
+            download_size=entry.download_size,
+            install_size=entry.original_size,
+            test_split=in_test,
+            occlusion_levels=entry.occlusion_levels,
+            tags=entry.tags,
+            zip_sha256=entry.zip_sha256,
+            merkle_root=entry.merkle_root
+        ))
 
-    for class_dir in class_directories:
-        target_class = TargetClass(class_dir.name)
-        dataset.classes.append(target_class)
-        dest_class_dir = dest.joinpath(class_dir.name)
-
-        frame_sets = [d for d in sorted(class_dir.iterdir()) if d.is_dir()]
-        frame_set_caches = [c for c in sorted(dest_class_dir.iterdir()) if c.name.startswith(f'.hoot.{class_dir.name}.')]
-        for frame_set in tqdm(frame_sets, desc='parsing anno.json'):  # TODO: could be multi-processed
-            #fetch result cache
-            result_cache = None
-            for c in frame_set_caches:
-                if c.name.startswith(f'.hoot.{class_dir.name}.{frame_set.name}'):
-                    result_cache = c
-                    break
-            assert result_cache is not None, f'no result exists for frame_set {frame_set}' + f'\n{frame_set_caches}'
-            
-            #parse result cache - read id, sha256, size, zip_size
-            match_result = re.match(r'\.hoot\..+\.(\d+)\.([0-9a-f]{64})\.(\d+)', result_cache.name)
-            assert match_result is not None
-            zip_path = dest_class_dir.joinpath(f'{frame_set.name}.zip')
-            f_id = match_result.group(1)
-            f_sha256 = match_result.group(2)
-            f_size = int(match_result.group(3))
-            f_zip_size = os.path.getsize(zip_path)
-
-            # read anno.json
-            in_test = class_dir.name + "-" + frame_set.name in test_video_keys
-            video_data = load_video_from_file(frame_set, in_test=in_test)
-
-            target_class.videos.append(AnnotatedVideo(
-                id=f_id,
-                path=f'{class_dir.name}/{zip_path.name}',
-                sha256=f_sha256,
-                download_size=f_zip_size,
-                install_size=f_size,
-                test_split=in_test,
-                occlusion_levels=OcclusionLevels(
-                    video_data.frame_occlusion_level,
-                    video_data.mean_target_occlusion_level,
-                    video_data.median_target_occlusion_level
-                ),
-                tags=video_data.occlusion_tags
-            ))
-    
+    # compact the journal - drops superseded lines
+    entries = [journal[key] for _, key in frame_set_keys]
+    write_journal(journal_path, entries)
+    print_compression_stats(entries)
 
     # render dataclasses to json
     with open(dest.joinpath('metadata.json'), 'w') as f:
@@ -0,0 +1,219 @@
+## Benchmark suite for the toolkit's hot paths
+## Generates a synthetic HOOT dataset, times each stage (MB/s, frames/s, peak RSS) and writes the results as json
+## Everything runs offline - downloads go through the local test server on a free port
+
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+import cv2
+import numpy as np
+
+from hoot.synthetic import generate_dataset
+from hoot.utils import package_folder, hash_folder
+from hoot.anno import load_video_from_file
+from hoot.archiver import make_archive, allowed_file_types
+from hoot.downloader import Downloader
+from hoot.metadata import load_from_json
+from hoot.test_server import make_local_server, LinkConditions
+from hoot.visualizer import render_video
+from hoot.frame_cache import build_frame_cache, load_cached_frames
+from hoot.pyramid import build_pyramids
+from hoot.binary_anno import ANNO_BINARY_NAME, pack_annotation_file
+
+## Peak resident set size so far in MB, of this process (children=False) or of its largest finished child
+## process, eg. a pool worker (children=True) - None where the resource module isn't available (Windows)
+def peak_rss_mb(children: bool=False) -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    ## ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+## Collects timed stages
+class BenchmarkRecorder:
+    def __init__(self):
+        self.stages: List[dict] = []
+
+    ## Records a stage that processed num_bytes bytes and num_items items (frames, masks, videos...)
+    def record(self, name: str, seconds: float, num_bytes: int=0, num_items: int=0, item_unit: str='items'):
+        stage = {
+            'name': name,
+            'seconds': seconds,
+            'bytes': num_bytes,
+            'items': num_items,
+            'item_unit': item_unit,
+            'mb_per_s': num_bytes / (1024 * 1024) / seconds if seconds > 0 and num_bytes else None,
+            'items_per_s': num_items / seconds if seconds > 0 and num_items else None,
+            'peak_rss_mb': peak_rss_mb(),
+            'children_peak_rss_mb': peak_rss_mb(children=True),
+        }
+        self.stages.append(stage)
+        rate = f'{stage["mb_per_s"]:.1f} MB/s' if stage['mb_per_s'] else ''
+        if stage['items_per_s']:
+            rate += f'  {stage["items_per_s"]:.1f} {item_unit}/s'
+        print(f'{name:<24} {seconds:>8.3f}s  {rate}')
+
+def _video_dirs(datapath: Path) -> List[Path]:
+    return [v for c in sorted(datapath.iterdir()) if c.is_dir() for v in sorted(c.iterdir()) if v.is_dir()]
+
+## Runs every benchmark stage in workdir (a temporary directory if None) and returns the results dict
+## If output_file is given, results are written there as json
+## If baseline_file is given, each stage's throughput is printed relative to that earlier run
+## conditions (if given) simulates latency, bandwidth caps and connection drops on the local download server
+def run_benchmarks(workdir: Optional[str]=None, num_classes: int=2, videos_per_class: int=3, num_frames: int=30,
+                   width: int=640, height: int=360, jobs: int=4, output_file: Optional[str]=None,
+                   baseline_file: Optional[str]=None, keep: bool=False, conditions: Optional[LinkConditions]=None) -> dict:
+    root = Path(workdir) if workdir else Path(tempfile.mkdtemp(prefix='hoot-bench-'))
+    root.mkdir(parents=True, exist_ok=True)
+    data = root.joinpath('data')
+    recorder = BenchmarkRecorder()
+
+    try:
+        ## Synthetic dataset
+        start = time.perf_counter()
+        generate_dataset(str(data), num_classes, videos_per_class, num_frames, width, height)
+        video_dirs = _video_dirs(data)
+        total_frames = len(video_dirs) * num_frames
+        data_bytes = sum(f.stat().st_size for v in video_dirs for f in v.iterdir())
+        recorder.record('generate_dataset', time.perf_counter() - start, data_bytes, total_frames, 'frames')
+
+        ## package_folder
+        zip_dir = root.joinpath('zips')
+        zip_dir.mkdir(exist_ok=True)
+        start = time.perf_counter()
+        zipped = sum(package_folder(v.name, v, zip_dir.joinpath(f'{v.parent.name}-{v.name}.zip'), allowed_file_types).original_size for v in video_dirs)
+        recorder.record('package_folder', time.perf_counter() - start, zipped, len(video_dirs), 'videos')
+
+        ## hash_folder
+        start = time.perf_counter()
+        hashed = sum(hash_folder(v)[0] for v in video_dirs)
+        recorder.record('hash_folder', time.perf_counter() - start, hashed, len(video_dirs), 'videos')
+
+        ## load_video_from_file - eager (dacite) and lazy
+        anno_bytes = sum(v.joinpath('anno.json').stat().st_size for v in video_dirs)
+        start = time.perf_counter()
+        videos = [load_video_from_file(v) for v in video_dirs]
+        recorder.record('load_video', time.perf_counter() - start, anno_bytes, total_frames, 'frames')
+        start = time.perf_counter()
+        for v in video_dirs:
+            load_video_from_file(v, lazy=True)
+        recorder.record('load_video_lazy', time.perf_counter() - start, anno_bytes, total_frames, 'frames')
+
+        ## load_video_from_file again, from an anno.bin packed next to each anno.json
+        for v in video_dirs:
+            v.joinpath(ANNO_BINARY_NAME).write_bytes(pack_annotation_file(v.joinpath('anno.json')))
+        binary_bytes = sum(v.joinpath(ANNO_BINARY_NAME).stat().st_size for v in video_dirs)
+        start = time.perf_counter()
+        for v in video_dirs:
+            load_video_from_file(v)
+        recorder.record('load_video_binary', time.perf_counter() - start, binary_bytes, total_frames, 'frames')
+
+        ## Mask.mask decode
+        masks = [m for video in videos for frame in video.frames for _, m in frame.occ_masks.get_masks() if m]
+        start = time.perf_counter()
+        decoded = sum(m.mask.nbytes for m in masks)
+        recorder.record('mask_decode', time.perf_counter() - start, decoded, len(masks), 'masks')
+
+        ## PNG decode vs. reading the same frames from the memory-mapped frame cache
+        start = time.perf_counter()
+        decoded = sum(cv2.imread(frame.frame_path).nbytes for video in videos for frame in video.frames)
+        recorder.record('frame_decode', time.perf_counter() - start, decoded, total_frames, 'frames')
+        frame_cache_dir = root.joinpath('frame_cache')
+        start = time.perf_counter()
+        build_frame_cache(str(data), str(frame_cache_dir), threads=jobs)
+        recorder.record('cache_frames', time.perf_counter() - start, decoded, total_frames, 'frames')
+        start = time.perf_counter()
+        cached_bytes = 0
+        for video in videos:
+            cached = load_cached_frames(str(frame_cache_dir), video.video_key)
+            for i in range(len(cached)):
+                ## (summing touches every byte of the view, so the pages are actually read)
+                cached[i].sum(dtype=np.uint64)
+                cached_bytes += cached[i].nbytes
+        recorder.record('cached_frame_read', time.perf_counter() - start, cached_bytes, total_frames, 'frames')
+
+        ## make_archive + downloader against the local test server
+        host_root = root.joinpath('host')
+        export = host_root.joinpath('v1_0', 'HD')
+        export.parent.mkdir(parents=True, exist_ok=True)
+        start = time.perf_counter()
+        make_archive(str(data), str(export), '1.0', jobs, clean=True)
+        recorder.record('make_archive', time.perf_counter() - start, data_bytes, len(video_dirs), 'videos')
+
+        httpd = make_local_server(str(host_root), 0, conditions)
+        server_thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        server_thread.start()
+        try:
+            dl = Downloader(f'http://localhost:{httpd.server_address[1]}/v1_0/HD/', jobs)
+            metadata = load_from_json(dl.download_metadata())
+            download_dir = root.joinpath('download')
+            to_download = []
+            for c in metadata.classes:
+                download_dir.joinpath(c.name).mkdir(parents=True, exist_ok=True)
+                to_download += [(download_dir.joinpath(c.name), v) for v in c.videos]
+            start = time.perf_counter()
+            dl.download_videos(to_download, jobs, clean=True)
+            download_bytes = sum(v.download_size for _, v in to_download)
+            recorder.record('download', time.perf_counter() - start, download_bytes, len(to_download), 'videos')
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+        ## Headless visualizer frame throughput
+        render_dir = root.joinpath('render')
+        render_dir.mkdir(exist_ok=True)
+        start = time.perf_counter()
+        for video in videos:
+            render_video(video, render_dir.joinpath(f'{video.video_key}.mp4'))
+        recorder.record('render_video', time.perf_counter() - start, 0, total_frames, 'frames')
+
+        ## Pyramid build, then rendering from the 1/4 level instead of decoding full resolution frames
+        start = time.perf_counter()
+        build_pyramids(str(data), threads=jobs)
+        recorder.record('build_pyramids', time.perf_counter() - start, data_bytes, total_frames, 'frames')
+        start = time.perf_counter()
+        for v in video_dirs:
+            quarter = load_video_from_file(v, lazy=True, scale=0.25)
+            render_video(quarter, render_dir.joinpath(f'{quarter.video_key}-1_4.mp4'), downscale=False)
+        recorder.record('render_video_1_4', time.perf_counter() - start, 0, total_frames, 'frames')
+    finally:
+        if not keep and workdir is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    results = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'config': {'num_classes': num_classes, 'videos_per_class': videos_per_class, 'num_frames': num_frames,
+                   'width': width, 'height': height, 'jobs': jobs, 'link': (conditions or LinkConditions())._asdict()},
+        'system': {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count()},
+        'stages': recorder.stages,
+    }
+
+    if output_file:
+        with open(output_file, 'w') as f:
+            json.dump(results, f, indent=2)
+    if baseline_file:
+        compare_results(baseline_file, results)
+    return results
+
+## Prints each stage's throughput relative to a baseline results file (>1.0 is faster)
+def compare_results(baseline_file: str, results: dict) -> Dict[str, float]:
+    with open(baseline_file, 'r') as f:
+        baseline = {s['name']: s for s in json.load(f)['stages']}
+    speedups = {}
+    for stage in results['stages']:
+        base = baseline.get(stage['name'])
+        if base is None or not base['seconds'] or not stage['seconds']:
+            continue
+        speedups[stage['name']] = base['seconds'] / stage['seconds']
+        print(f'{stage["name"]:<24} {speedups[stage["name"]]:>6.2f}x vs baseline')
+    return speedups
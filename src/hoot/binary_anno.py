@@ -0,0 +1,241 @@
+## Compact binary annotation container for HOOT (anno.bin)
+## Holds the same annotations as a video's anno.json, but masks are raw COCO RLE bytes (anno.json hex-encodes them),
+## boxes are packed float32 and frame attributes/occluders are bit fields (same bits as the annotation index)
+##
+## File layout: 8 byte magic, then little-endian u32 header length, u64 frame table offset, u64 payload offset,
+## the json header (video-level fields), the frame table (one FRAME_RECORD per frame, sorted by frame id) and
+## the RLE payload. The table and payload are memory-mapped, so any frame is read in O(1) without loading the file
+##
+## load_video_from_file prefers anno.bin over anno.json when a video folder has one (see make-archive --binary-anno)
+
+import hashlib
+import json
+import os
+import struct
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Dict, List, Optional
+import numpy as np
+
+from hoot.anno import Frame, FrameAttributes, Mask, OcclusionMasks, Video, LazyVideo
+from hoot.index import ATTRIBUTE_BITS, OCCLUDER_TYPES, OCCLUDER_BITS
+
+ANNO_BINARY_NAME = 'anno.bin'
+ANNO_BINARY_MAGIC = b'HOOTANN1'
+PREAMBLE = struct.Struct('<IQQ')
+
+## Bits of FRAME_RECORD['boxes'] - set when the box has 4 annotated points
+BOX_BITS = {'rot_bb': 0, 'aa_bb': 1}
+FRAME_RECORD = np.dtype([
+    ('frame_id', '<u4'),
+    ('attributes', 'u1'),
+    ('occluders', 'u1'),
+    ('boxes', 'u1'),
+    ('reserved', 'u1'),
+    ('rot_bb', '<f4', (4, 2)),
+    ('aa_bb', '<f4', (4, 2)),
+    ('rle_offsets', '<u8', (len(OCCLUDER_TYPES),)),
+    ('rle_lengths', '<u4', (len(OCCLUDER_TYPES),)),
+])
+VIDEO_FIELDS = ['video_key', 'frame_occlusion_level', 'median_target_occlusion_level', 'mean_target_occlusion_level']
+
+## Packs an anno.json dict into anno.bin content
+## source_sha256 is the sha256 of the anno.json it was packed from - a loader falls back to anno.json if that changed
+## Raises ValueError for annotations the format can't hold (boxes that aren't 4 points, masks of different sizes)
+def pack_annotations(anno_data: dict, source_sha256: Optional[str]=None) -> bytes:
+    frames = sorted(anno_data['frames'], key=lambda f: int(f['frame_id']))
+    table = np.zeros(len(frames), dtype=FRAME_RECORD)
+    payload = bytearray()
+    mask_size = None
+
+    for i, f in enumerate(frames):
+        record = table[i]
+        record['frame_id'] = int(f['frame_id'])
+        for attr, bit in ATTRIBUTE_BITS.items():
+            if f['attributes'][attr]:
+                record['attributes'] |= 1 << bit
+        for box, bit in BOX_BITS.items():
+            if len(f[box]) == 4:
+                record[box] = f[box]
+                record['boxes'] |= 1 << bit
+            elif len(f[box]) != 0:
+                raise ValueError(f'frame {f["frame_id"]}: {box} has {len(f[box])} points, only 4-point boxes can be packed')
+        for occ_type, m in f['occ_masks'].items():
+            if not isinstance(m, dict):
+                continue
+            if mask_size is None:
+                mask_size = [int(s) for s in m['size']]
+            elif [int(s) for s in m['size']] != mask_size:
+                raise ValueError(f'frame {f["frame_id"]}: masks of different sizes can\'t be packed')
+            bit = OCCLUDER_BITS[occ_type]
+            counts = bytes.fromhex(m['counts'])
+            record['occluders'] |= 1 << bit
+            record['rle_offsets'][bit] = len(payload)
+            record['rle_lengths'][bit] = len(counts)
+            payload += counts
+
+    header = {field: anno_data[field] for field in VIDEO_FIELDS}
+    header.update({'num_frames': len(frames), 'mask_size': mask_size, 'source_sha256': source_sha256,
+                   'attribute_bits': ATTRIBUTE_BITS, 'occluder_types': OCCLUDER_TYPES})
+    header = json.dumps(header).encode('utf-8')
+    ## The table starts 8-byte aligned, so its u64 offsets can be read in place
+    table_offset = -(-(len(ANNO_BINARY_MAGIC) + PREAMBLE.size + len(header)) // 8) * 8
+    payload_offset = table_offset + table.nbytes
+    preamble = ANNO_BINARY_MAGIC + PREAMBLE.pack(len(header), table_offset, payload_offset) + header
+    return preamble + b'\0' * (table_offset - len(preamble)) + table.tobytes() + bytes(payload)
+
+## anno.bin content for an anno.json file
+def pack_annotation_file(annopath: Path) -> bytes:
+    with open(annopath, 'rb') as f:
+        content = f.read()
+    return pack_annotations(json.loads(content), hashlib.sha256(content).hexdigest())
+
+## Memory-mapped anno.bin of one video
+class BinaryAnnotations:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            if f.read(len(ANNO_BINARY_MAGIC)) != ANNO_BINARY_MAGIC:
+                raise ValueError(f'{path} is not a HOOT binary annotation file')
+            header_length, table_offset, payload_offset = PREAMBLE.unpack(f.read(PREAMBLE.size))
+            self.header: dict = json.loads(f.read(header_length))
+        self.num_frames: int = self.header['num_frames']
+        self.mask_size: Optional[List[int]] = self.header['mask_size']
+        self.size = os.path.getsize(self.path)
+
+        if self.num_frames > 0:
+            self.table = np.memmap(self.path, dtype=FRAME_RECORD, mode='r', offset=table_offset, shape=(self.num_frames,))
+        else:
+            self.table = np.zeros(0, dtype=FRAME_RECORD)
+        if self.size > payload_offset:
+            self.payload = np.memmap(self.path, dtype=np.uint8, mode='r', offset=payload_offset)
+        else:
+            self.payload = np.zeros(0, dtype=np.uint8)
+
+    ## Builds a Frame from a FRAME_RECORD (as a tuple from .tolist()) - masks keep the raw RLE bytes
+    ## .tolist() leaves the (4,2) box fields as arrays, they're converted to lists of [x, y] like anno.json boxes
+    def _frame(self, record: tuple, payload, videopath: Path) -> Frame:
+        frame_id, attributes, occluders, boxes, _, rot_bb, aa_bb, rle_offsets, rle_lengths = record
+        occ_masks = {}
+        for bit, occ_type in enumerate(OCCLUDER_TYPES):
+            if occluders & (1 << bit):
+                start = rle_offsets[bit]
+                occ_masks[occ_type] = Mask(size=list(self.mask_size), counts=bytes(payload[start:start + rle_lengths[bit]]))
+        return Frame(
+            frame_id=frame_id,
+            frame_path=str(videopath.joinpath(f'{frame_id:06}.png')),
+            rot_bb=rot_bb.tolist() if boxes & (1 << BOX_BITS['rot_bb']) else [],
+            aa_bb=aa_bb.tolist() if boxes & (1 << BOX_BITS['aa_bb']) else [],
+            occ_masks=OcclusionMasks(**occ_masks),
+            attributes=FrameAttributes(**{attr: bool(attributes & (1 << bit)) for attr, bit in ATTRIBUTE_BITS.items()})
+        )
+
+    ## Frame at a table position, reads only that frame's record and masks
+    def frame(self, idx: int, videopath: Path) -> Frame:
+        return self._frame(self.table[idx].tolist(), self.payload, videopath)
+
+    ## All frames, converting the table and payload in one pass
+    def frames(self, videopath: Path) -> List[Frame]:
+        payload = self.payload.tobytes()
+        return [self._frame(record, payload, videopath) for record in self.table.tolist()]
+
+    ## anno.json style dict of a frame, read straight from its table row without building a Frame
+    ## Mask counts are the raw RLE bytes (anno.json hex-encodes them), like Mask.counts of a frame from anno.bin
+    def raw(self, idx: int) -> dict:
+        record = self.table[idx]
+        attributes, occluders, boxes = int(record['attributes']), int(record['occluders']), int(record['boxes'])
+        occ_masks = {}
+        for bit, occ_type in enumerate(OCCLUDER_TYPES):
+            if occluders & (1 << bit):
+                start = int(record['rle_offsets'][bit])
+                occ_masks[occ_type] = {'size': list(self.mask_size),
+                                       'counts': self.payload[start:start + int(record['rle_lengths'][bit])].tobytes()}
+            else:
+                occ_masks[occ_type] = []
+        return {
+            'frame_id': int(record['frame_id']),
+            'rot_bb': record['rot_bb'].tolist() if boxes & (1 << BOX_BITS['rot_bb']) else [],
+            'aa_bb': record['aa_bb'].tolist() if boxes & (1 << BOX_BITS['aa_bb']) else [],
+            'occ_masks': occ_masks,
+            'attributes': {attr: bool(attributes & (1 << bit)) for attr, bit in ATTRIBUTE_BITS.items()}
+        }
+
+    ## Boxes of all frames as an (N,4,2) array straight from the table, NaN where a box isn't annotated
+    def polygons(self, box: str='aa_bb') -> np.ndarray:
+        polygons = self.table[box].astype(np.float64)
+        polygons[(self.table['boxes'] & (1 << BOX_BITS[box])) == 0] = np.nan
+        return polygons
+
+## Sequence of frames over an anno.bin, with the same interface as LazyFrames
+## Frames are built when indexed and kept, so each frame is read at most once
+class BinaryFrames(Sequence):
+    def __init__(self, annotations: BinaryAnnotations, videopath: Path):
+        self._annotations = annotations
+        self._frames: List[Optional[Frame]] = [None] * annotations.num_frames
+        self._videopath = videopath
+
+    def __len__(self) -> int:
+        return self._annotations.num_frames
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        frame = self._frames[idx]
+        if frame is None:
+            frame = self._annotations.frame(idx, self._videopath)
+            self._frames[idx] = frame
+        return frame
+
+    def raw(self, idx: int) -> dict:
+        return self._annotations.raw(idx)
+
+    def polygons(self, box: str='aa_bb') -> np.ndarray:
+        return self._annotations.polygons(box)
+
+## anno.bin paths whose newer anno.json was checked in this process, with the stats both files had then
+## Kept in memory only, so loading annotations never writes anything
+_checked_sources: Dict[str, tuple] = {}
+
+def _source_stats(binpath: Path, annopath: Path) -> tuple:
+    return tuple((st.st_size, st.st_mtime_ns, st.st_ino) for st in (os.stat(binpath), os.stat(annopath)))
+
+## Gives a video folder's anno.bin its anno.json's mtime if that's newer, eg. right after both were extracted from
+## the same zip - so open_binary_annotations takes anno.bin as current without hashing the anno.json
+def mark_binary_current(videopath: Path) -> None:
+    binpath = Path(videopath).joinpath(ANNO_BINARY_NAME)
+    annopath = Path(videopath).joinpath('anno.json')
+    anno_mtime = os.stat(annopath).st_mtime_ns
+    bin_stat = os.stat(binpath)
+    if anno_mtime > bin_stat.st_mtime_ns:
+        os.utime(binpath, ns=(bin_stat.st_atime_ns, anno_mtime))
+
+## Opens a video folder's anno.bin, None if it has none or it's stale
+## anno.bin is current if the anno.json isn't newer than it, otherwise only if the anno.json still hashes to the
+## sha256 recorded at pack time (eg. after the anno.json was copied or touched) - a match is remembered for the
+## rest of the process, so the hash is checked once per process and not on every load
+def open_binary_annotations(videopath: Path) -> Optional[BinaryAnnotations]:
+    binpath = Path(videopath).joinpath(ANNO_BINARY_NAME)
+    if not binpath.exists():
+        return None
+    try:
+        annotations = BinaryAnnotations(binpath)
+    except (OSError, ValueError, struct.error):
+        return None
+    annopath = Path(videopath).joinpath('anno.json')
+    if annopath.exists() and os.stat(annopath).st_mtime_ns > os.stat(binpath).st_mtime_ns:
+        stats = _source_stats(binpath, annopath)
+        if _checked_sources.get(str(binpath)) != stats:
+            with open(annopath, 'rb') as f:
+                if hashlib.sha256(f.read()).hexdigest() != annotations.header.get('source_sha256'):
+                    return None
+            _checked_sources[str(binpath)] = stats
+    return annotations
+
+## Builds a Video (or a LazyVideo over BinaryFrames if lazy) from an anno.bin, video_fields are the meta.info
+## fields (height, width, motion_tags, target_tags)
+def binary_video(annotations: BinaryAnnotations, videopath: Path, lazy: bool=False, **video_fields) -> Video:
+    header = annotations.header
+    fields = {field: header[field] for field in VIDEO_FIELDS}
+    if lazy:
+        return LazyVideo(video_path=str(videopath), frames=BinaryFrames(annotations, Path(videopath)), **fields, **video_fields)
+    return Video(video_path=str(videopath), frames=annotations.frames(Path(videopath)), **fields, **video_fields)
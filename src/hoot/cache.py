@@ -0,0 +1,156 @@
+## Local cache of dataset metadata, keyed by version and quality (eg. ~/.cache/hoot/v1_0-HD/)
+## Holds the raw metadata.json, the parsed HootDataset as a pickle (so startup skips json + dacite),
+## the additional files (test.txt, train.txt, LICENSE...) and the ETag/Last-Modified validators of each file,
+## which the downloader uses to revalidate with a conditional GET instead of downloading again
+##
+## The cache directory is HOOT_CACHE_DIR if set - point it at shared storage to share one cache between nodes
+## validators.json is only updated under a lock file, so concurrent writers don't drop each other's entries
+## The pickle is only loaded if it matches the sha256 recorded when it was written, and (on POSIX) if it's owned by
+## the current user and not writable by anyone else - a cache directory shared with other users never runs their pickles
+
+import dataclasses
+import hashlib
+import json
+import os
+import pickle
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+from hoot.metadata import HootDataset, TargetClass, AnnotatedVideo, OcclusionLevels, load_from_json
+
+CACHE_DIR_ENV = 'HOOT_CACHE_DIR'
+VALIDATORS_NAME = 'validators.json'
+PICKLE_NAME = 'metadata.pickle'
+LOCK_SUFFIX = '.lock'
+## A lock file older than this is left over from a crashed writer and is broken
+STALE_LOCK_SECONDS = 60
+
+def default_cache_dir() -> Path:
+    return Path(os.environ.get(CACHE_DIR_ENV, Path.home().joinpath('.cache', 'hoot')))
+
+## Fingerprint of the metadata dataclass fields - a pickle made by a version of the toolkit with
+## different fields is ignored and rebuilt from the cached metadata.json
+def schema_version() -> str:
+    fields = [f'{cls.__name__}.{f.name}' for cls in (HootDataset, TargetClass, AnnotatedVideo, OcclusionLevels)
+              for f in dataclasses.fields(cls)]
+    return hashlib.sha256(','.join(fields).encode('utf-8')).hexdigest()[:16]
+
+## Writes data to path through a temporary file, so concurrent readers never see a partial file
+def _write_atomic(path: Path, data: bytes) -> None:
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+## Holds an exclusive lock file next to path while the block runs - O_EXCL creation works on local and network
+## file systems alike, on every platform
+@contextmanager
+def _file_lock(path: Path, timeout: float=30.0):
+    lock_path = path.with_name(path.name + LOCK_SUFFIX)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > STALE_LOCK_SECONDS:
+                    os.remove(lock_path)
+                    continue
+            except OSError:
+                continue
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'timed out waiting for {lock_path}')
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(lock_path)
+
+## Whether a cached pickle can be loaded - owned by this user and not group/world writable (always true on Windows)
+def _trusted(path: Path) -> bool:
+    if not hasattr(os, 'getuid'):
+        return True
+    st = os.stat(path)
+    return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+class MetadataCache:
+    def __init__(self, version: str, host_url: str, cache_dir: Optional[str]=None) -> None:
+        self.directory = Path(cache_dir) if cache_dir else default_cache_dir()
+        self.directory = self.directory.joinpath(version)
+        self.host_url = host_url
+
+    def _validators(self) -> dict:
+        try:
+            with open(self.directory.joinpath(VALIDATORS_NAME), 'r') as f:
+                validators = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        ## A cache filled from another host (eg. a local test server) doesn't count
+        if validators.get('host_url') != self.host_url:
+            return {}
+        return validators.get('files', {})
+
+    ## Path of a cached file, or None if it isn't cached
+    def file_path(self, name: str) -> Optional[Path]:
+        path = self.directory.joinpath('files', name)
+        return path if name in self._validators() and path.exists() else None
+
+    ## Conditional request headers for a cached file
+    def conditional_headers(self, name: str) -> dict:
+        validators = self._validators().get(name)
+        if validators is None or self.file_path(name) is None:
+            return {}
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        return headers
+
+    ## Stores a downloaded file with the validators from its response headers
+    def store_file(self, name: str, content: bytes, etag: Optional[str]=None, last_modified: Optional[str]=None, **extra) -> Path:
+        path = self.directory.joinpath('files', name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        _write_atomic(path, content)
+        validators_path = self.directory.joinpath(VALIDATORS_NAME)
+        with _file_lock(validators_path):
+            files = self._validators()
+            files[name] = {'etag': etag, 'last_modified': last_modified, **extra}
+            _write_atomic(validators_path, json.dumps({'host_url': self.host_url, 'files': files}).encode('utf-8'))
+        return path
+
+    ## The cached dataset - from the pickle if it matches the cached metadata.json and was written with the
+    ## current metadata schema, otherwise parsed from the cached metadata.json (and pickled again)
+    def load_dataset(self) -> Optional[HootDataset]:
+        json_path = self.file_path('metadata.json')
+        if json_path is None:
+            return None
+        validators = self._validators()['metadata.json']
+        pickle_path = self.directory.joinpath(PICKLE_NAME)
+        try:
+            with open(pickle_path, 'rb') as f:
+                pickled = f.read()
+            if _trusted(pickle_path) and hashlib.sha256(pickled).hexdigest() == validators.get('pickle_sha256'):
+                schema, sha256, dataset = pickle.loads(pickled)
+                if schema == schema_version() and sha256 == validators.get('sha256'):
+                    return dataset
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+            pass
+        with open(json_path, 'rb') as f:
+            content = f.read()
+        return self.store_dataset(content, validators.get('etag'), validators.get('last_modified'))
+
+    ## Caches metadata.json content and pickles the dataset parsed from it
+    def store_dataset(self, content: bytes, etag: Optional[str]=None, last_modified: Optional[str]=None) -> HootDataset:
+        dataset = load_from_json(json.loads(content))
+        sha256 = hashlib.sha256(content).hexdigest()
+        pickled = pickle.dumps((schema_version(), sha256, dataset), protocol=pickle.HIGHEST_PROTOCOL)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        _write_atomic(self.directory.joinpath(PICKLE_NAME), pickled)
+        self.store_file('metadata.json', content, etag, last_modified, sha256=sha256,
+                        pickle_sha256=hashlib.sha256(pickled).hexdigest())
+        return dataset
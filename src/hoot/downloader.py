@@ -13,152 +13,559 @@ import zipfile
 from tqdm import tqdm
 import os
 import shutil
-from hoot.metadata import load_from_json
-from typing import List
+import threading
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import time
+from hoot.metadata import load_from_json, load_from_file, save_to_json, AnnotatedVideo, HootDataset
+from hoot.cache import MetadataCache
+from hoot.utils import hash_file
+from hoot import metrics
+from hoot.query import compile_query
+from hoot.manifest import manifest_path, merkle_root, hash_files, corrupt_members, member_data_range, decode_member, ZIP_LOCAL_HEADER
+from typing import List, Set, Tuple, Optional, Callable
 
 base_url = 'http://ilab.usc.edu/hoot/'
+## Copy of the metadata.json a local install was downloaded from
+local_metadata_name = 'metadata.json'
+
+## Keys (class/video id) of the videos of that release that are installed - a subset install (--where,
+## --test-only) only has some of them
+local_installed_name = '.hoot.installed.json'
+
+## Whether a video of a local install is on disk, extracted or as a zip
+def video_installed(dest: Path, class_name: str, v: AnnotatedVideo) -> bool:
+    return dest.joinpath(class_name, v.id).exists() or dest.joinpath(v.path).exists()
+
+## Loads the release a local install in dest was made from and the (class name, video id) pairs installed from it
+## Returns (None, empty set) if dest has no metadata.json - installs made before the installed set was saved count
+## the videos of their metadata.json that are on disk
+def load_local_metadata(dest: Path) -> Tuple[Optional[HootDataset], Set[Tuple[str, str]]]:
+    local_metadata_path = dest.joinpath(local_metadata_name)
+    if not local_metadata_path.exists():
+        return (None, set())
+    metadata = load_from_file(local_metadata_path)
+    installed_path = dest.joinpath(local_installed_name)
+    if installed_path.exists():
+        with open(installed_path, 'r') as f:
+            installed = {tuple(key.split('/', 1)) for key in json.load(f)}
+    else:
+        installed = {(c.name, v.id) for c in metadata.classes for v in c.videos if video_installed(dest, c.name, v)}
+    return (metadata, installed)
+
+## Saves the release a local install in dest was made from (which hoot sync diffs the next release against)
+## along with the (class name, video id) pairs installed from it
+def save_local_metadata(metadata: HootDataset, dest: Path, installed: Set[Tuple[str, str]]) -> None:
+    save_to_json(metadata, dest.joinpath(local_metadata_name))
+    with open(dest.joinpath(local_installed_name), 'w') as f:
+        json.dump(sorted(f'{class_name}/{video_id}' for class_name, video_id in installed), f, indent=2)
+
+## Raised when an archive can't be downloaded or fails verification
+class DownloadError(Exception):
+    pass
 
 ## Downloader class 
+## Holds a single keep-alive requests.Session for the host
+## The connection pool is sized by the number of concurrent jobs so every worker reuses a connection
+## With a MetadataCache, metadata.json and the additional files are revalidated with conditional requests,
+## and in offline mode they're served from the cache only - any other request raises a DownloadError
 class Downloader:
-    def __init__(self, host_url: str) -> None:
+    def __init__(self, host_url: str, jobs: int=1, cache: Optional[MetadataCache]=None, offline: bool=False) -> None:
         self.host_url = host_url
+        self.cache = cache
+        self.offline = offline
+        if offline and cache is None:
+            raise ValueError('offline mode needs a metadata cache')
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(jobs, 1))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    ## GETs a small file in one piece, retrying dropped connections and 5xx errors with exponential backoff
+    def get(self, url: str, headers: Optional[dict]=None, retries: int=5, backoff: float=1.0) -> requests.Response:
+        if self.offline:
+            raise DownloadError(f'{url} is not available offline')
+        attempt = 0
+        while True:
+            try:
+                response = self.session.get(self.host_url + url, headers=headers, timeout=60)
+                if response.status_code < 500:
+                    return response
+                error = requests.HTTPError(f'Service returned error {response.status_code}', response=response)
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                error = e
+            attempt += 1
+            if attempt > retries:
+                raise DownloadError(f'{url} failed after {retries} retries') from error
+            time.sleep(backoff * 2 ** (attempt - 1))
 
     def download_metadata(self) -> dict:
         #fetch metadata json
-        response = requests.get(self.host_url + 'metadata.json')
-        assert response.status_code == HTTPStatus.OK, f'Service returned error {response.status_code}'
-        return response.json()
+        with metrics.span('metadata_fetch') as fetch_span:
+            response = self.get('metadata.json')
+            assert response.status_code == HTTPStatus.OK, f'Service returned error {response.status_code}'
+            fetch_span.set(bytes=len(response.content))
+            return response.json()
 
-    def download_url(self, url: str, directory: Path, zip_size: int, clean):
+    ## Returns the parsed metadata - revalidated against the cache if there is one, so an unchanged
+    ## metadata.json costs a 304 and a pickle load instead of a download, json parse and dacite
+    def load_metadata(self) -> HootDataset:
+        if self.cache is None:
+            return load_from_json(self.download_metadata())
+        if self.offline:
+            dataset = self.cache.load_dataset()
+            if dataset is None:
+                raise DownloadError(f'no cached metadata in {self.cache.directory}, run once without --offline')
+            return dataset
+
+        with metrics.span('metadata_fetch') as fetch_span:
+            response = self.get('metadata.json', headers=self.cache.conditional_headers('metadata.json'))
+            if response.status_code == HTTPStatus.NOT_MODIFIED:
+                dataset = self.cache.load_dataset()
+                if dataset is not None:
+                    fetch_span.set(bytes=0, not_modified=True)
+                    return dataset
+                response = self.get('metadata.json')
+            assert response.status_code == HTTPStatus.OK, f'Service returned error {response.status_code}'
+            fetch_span.set(bytes=len(response.content), not_modified=False)
+            return self.cache.store_dataset(response.content, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+
+    ## Downloads a single archive into directory
+    ## on_progress (if given) is called with the number of bytes written for each chunk
+    ## An existing .tmp file is resumed with an HTTP Range request, failed transfers are retried with exponential backoff
+    ## The zip sha256 is computed while the bytes stream in and checked (if given) before moving from .tmp
+    def download_url(self, url: str, directory: Path, zip_size: int, clean, on_progress: Optional[Callable[[int], None]]=None,
+                     zip_sha256: Optional[str]=None, retries: int=5, backoff: float=1.0):
         
         local_filepath = directory.joinpath(Path(url).name)
         tmp_local_filepath = str(local_filepath)+".tmp"
         ## If not clean, skip if file already exists
         ## Sha would have been checked before movinf from .tmp
         if not clean and os.path.exists(local_filepath):
+            if on_progress:
+                on_progress(zip_size)
             return local_filepath
+        if clean and os.path.exists(tmp_local_filepath):
+            os.remove(tmp_local_filepath)
+
+        ## Pick up the hash of a partial download left by an earlier run
+        zip_hash = hashlib.sha256()
+        offset = 0
+        if os.path.exists(tmp_local_filepath):
+            offset = os.path.getsize(tmp_local_filepath)
+            if offset > zip_size:
+                os.remove(tmp_local_filepath)
+                offset = 0
+            else:
+                hash_file(tmp_local_filepath, zip_hash)
+                if on_progress:
+                    on_progress(offset)
+
+        if self.offline and offset < zip_size:
+            raise DownloadError(f'{url} is not available offline')
+        attempt = 0
+        start_offset = offset
+        with metrics.span('download', video=url, resumed_from=start_offset) as download_span:
+            while offset < zip_size:
+                try:
+                    offset, zip_hash = self._stream_to_file(url, tmp_local_filepath, offset, zip_hash, on_progress)
+                    break
+                except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                    error = e
+                except requests.HTTPError as e:
+                    ## Client errors won't go away by retrying
+                    if e.response is not None and e.response.status_code < 500:
+                        raise
+                    error = e
+                attempt += 1
+                if attempt > retries:
+                    raise DownloadError(f'{url} failed after {retries} retries') from error
+                time.sleep(backoff * 2 ** (attempt - 1))
+                ## Rehash what's on disk - if the server ignored Range, the failed attempt restarted the file (and
+                ## its hash) from byte 0, which the caller's hash and offset don't know about
+                zip_hash = hashlib.sha256()
+                offset = 0
+                if os.path.exists(tmp_local_filepath):
+                    offset = os.path.getsize(tmp_local_filepath)
+                    hash_file(tmp_local_filepath, zip_hash)
+            download_span.set(bytes=offset - start_offset, retries=attempt)
+        
+        ## Check with zip size and sha, if correct, move from .tmp
+        new_zip_size = os.path.getsize(tmp_local_filepath)
+        if new_zip_size != zip_size or (zip_sha256 is not None and zip_hash.hexdigest() != zip_sha256):
+            os.remove(tmp_local_filepath)
+            raise DownloadError(f'{url} failed verification (size {new_zip_size}/{zip_size})')
+        shutil.move(tmp_local_filepath, local_filepath)
+
+        return local_filepath
+
+    ## Streams url into filepath starting at offset, updating zip_hash as bytes are written
+    ## Returns the new offset and hash - if the server ignores the Range header, the download restarts from byte 0
+    def _stream_to_file(self, url: str, filepath: str, offset: int, zip_hash, on_progress: Optional[Callable[[int], None]]=None):
+        headers = {'Range': f'bytes={offset}-'} if offset > 0 else {}
 
         # NOTE the stream=True parameter below
-        with requests.get(self.host_url + url, stream=True) as r:
+        with self.session.get(self.host_url + url, stream=True, headers=headers, timeout=60) as r:
             r.raise_for_status()
-            with open(tmp_local_filepath, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192): 
+            if offset > 0 and r.status_code != HTTPStatus.PARTIAL_CONTENT:
+                if on_progress:
+                    on_progress(-offset)
+                offset = 0
+                zip_hash = hashlib.sha256()
+            with open(filepath, 'ab' if offset > 0 else 'wb') as f:
+                for chunk in r.iter_content(chunk_size=65536): 
                     # If you have chunk encoded response uncomment if
                     # and set chunk_size parameter to None.
                     #if chunk: 
                     f.write(chunk)
-        
-        ## Check with zip size, if correct, move from .tmp
-        new_zip_size = os.path.getsize(tmp_local_filepath)
-        if new_zip_size == zip_size:
-            shutil.move(tmp_local_filepath, local_filepath)
+                    zip_hash.update(chunk)
+                    offset += len(chunk)
+                    if on_progress:
+                        on_progress(len(chunk))
+        return (offset, zip_hash)
 
-        return local_filepath
+    ## Fetches bytes [start, end) of url with a Range request
+    def download_range(self, url: str, start: int, end: int) -> bytes:
+        with metrics.span('range_fetch', video=url, bytes=end - start):
+            response = self.get(url, headers={'Range': f'bytes={start}-{end - 1}'})
+            response.raise_for_status()
+            if response.status_code != HTTPStatus.PARTIAL_CONTENT:
+                raise DownloadError(f'{url}: server does not support range requests')
+            if len(response.content) != end - start:
+                raise DownloadError(f'{url}: short range read ({len(response.content)}/{end - start} bytes)')
+            return response.content
+
+    ## Fetches a video's per-file manifest (see hoot/manifest.py)
+    def download_manifest(self, zip_url: str) -> dict:
+        response = self.get(manifest_path(zip_url))
+        assert response.status_code == HTTPStatus.OK, f'Service returned error {response.status_code}'
+        return response.json()
+
+    ## Fetches a single member out of a remote zip - its local header, then its data - and checks it against the manifest
+    def download_member(self, zip_url: str, member: dict) -> bytes:
+        local_header = self.download_range(zip_url, member['header_offset'], member['header_offset'] + ZIP_LOCAL_HEADER.size)
+        start, end = member_data_range(member, local_header)
+        data = self.download_range(zip_url, start, end) if end > start else b''
+        try:
+            return decode_member(member, data)
+        except ValueError as e:
+            raise DownloadError(str(e)) from e
 
+    ## Downloads license, test.txt, train.txt... into dest - through the cache if there is one
     def download_additional_files(self, files: List[str], dest: Path):
         for f in files:
-            response = requests.get(self.host_url + f)
+            if self.cache is not None:
+                cached = self.cache.file_path(f)
+                if self.offline:
+                    if cached is None:
+                        raise DownloadError(f'{f} is not cached, run once without --offline')
+                    shutil.copy(cached, dest.joinpath(f))
+                    continue
+                response = self.get(f, headers=self.cache.conditional_headers(f))
+                if response.status_code == HTTPStatus.NOT_MODIFIED and cached is not None:
+                    shutil.copy(cached, dest.joinpath(f))
+                    continue
+                if response.status_code == HTTPStatus.NOT_MODIFIED:
+                    response = self.get(f)
+                assert response.status_code == HTTPStatus.OK, f'Service returned error {response.status_code}'
+                shutil.copy(self.cache.store_file(f, response.content, response.headers.get('ETag'), response.headers.get('Last-Modified')), dest.joinpath(f))
+                continue
+            response = self.get(f)
             assert response.status_code == HTTPStatus.OK, f'Service returned error {response.status_code}'
-            with open(dest.joinpath(f), 'w') as fw:
-                fw.write(response.text)
+            with open(dest.joinpath(f), 'wb') as fw:
+                fw.write(response.content)
 
-def download_archives(destination: Path, version: str, extract: bool=False, clean: bool=False, test_only: bool=False, remove_archives: bool=False):
-    ## Create dest dir if it doesn't already exist
-    dest = Path(destination)
-    dest.mkdir(exist_ok=True)
+    ## Downloads a list of (class_dir, video) archives with a bounded pool of worker threads
+    ## All workers share the keep-alive session, progress is reported as aggregate throughput
+    ## If largest_first is set, the biggest archives are scheduled first so the long tail doesn't end up on one worker
+    ## on_complete (if given) is called with (class_dir, video, zip_path) as soon as each archive is downloaded
+    def download_videos(self, to_download: List[Tuple[Path, AnnotatedVideo]], jobs: int=1, clean: bool=False, largest_first: bool=False,
+                        on_complete: Optional[Callable[[Path, AnnotatedVideo, Path], None]]=None) -> List[Path]:
+        if largest_first:
+            to_download = sorted(to_download, key=lambda item: item[1].download_size, reverse=True)
 
+        lock = threading.Lock()
+        total_size = sum(v.download_size for _, v in to_download)
+        with tqdm(total=total_size, unit='B', unit_scale=True, unit_divisor=1024, desc="Downloading videos...") as pbar:
+            def on_progress(num_bytes: int):
+                with lock:
+                    pbar.update(num_bytes)
+
+            def download(class_dir: Path, v: AnnotatedVideo, submitted: float) -> Path:
+                metrics.record('download_queue_wait', time.time() - submitted, video=v.path)
+                return self.download_url(v.path, class_dir, v.download_size, clean, on_progress, v.zip_sha256)
+
+            with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+                submitted = time.time()
+                futures = {executor.submit(download, class_dir, v, submitted): (class_dir, v) for class_dir, v in to_download}
+                zip_paths = []
+                for future in as_completed(futures):
+                    zip_path = future.result()
+                    zip_paths.append(zip_path)
+                    if on_complete:
+                        class_dir, v = futures[future]
+                        on_complete(class_dir, v, zip_path)
+                return zip_paths
+
+## Downloader for a dataset version (eg. v1_0-HD), with its metadata cached under that version
+def version_downloader(version: str, jobs: int=1, offline: bool=False) -> Downloader:
     version_folder, quality = version.split("-")
     download_url = f'{base_url}{version_folder}/{quality}/'
-    dl = Downloader(download_url)
-    ## Fetch the latest metadata
-    metadata = load_from_json(dl.download_metadata())
+    return Downloader(download_url, jobs, MetadataCache(version, download_url), offline)
 
-    ## Download license, test.txt, train.txt
-    dl.download_additional_files(metadata.additional_files, dest)
+## Extracts a video zip into its folder, deleting the zip afterwards if remove_archive is set
+def extract_archive(zip_path: Path, v_folder: Path, remove_archive: bool=False, submitted: Optional[float]=None):
+    from hoot.binary_anno import ANNO_BINARY_NAME, mark_binary_current
+    if submitted is not None:
+        metrics.record('extract_queue_wait', time.time() - submitted, video=str(zip_path))
+    v_folder.mkdir(exist_ok=True)
+
+    ## Extract zip
+    with metrics.span('extract', video=str(zip_path), bytes=os.path.getsize(zip_path)), zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        zip_ref.extractall(v_folder)
+        names = zip_ref.namelist()
+
+    ## anno.bin and anno.json came out of the same zip, so anno.bin is current even if it was extracted first
+    if ANNO_BINARY_NAME in names and 'anno.json' in names:
+        mark_binary_current(v_folder)
+
+    ## If remove_archive is set, delete the zip file from the class folder
+    if remove_archive and os.path.isfile(zip_path):
+        os.remove(zip_path)
+
+## Downloads (and optionally extracts) a dataset version
+## In pipeline mode, each archive is extracted on a separate pool of extract_jobs threads as soon as it's downloaded,
+## while the remaining downloads continue - zips are deleted after extraction unless keep_archives is set
+## where (if given) is a query over metadata.json fields (see hoot/query.py) that selects the videos to download
+## dry_run only reports the number of videos and bytes that would be downloaded
+def download_archives(destination: Path, version: str, extract: bool=False, clean: bool=False, test_only: bool=False, remove_archives: bool=False, jobs: int=1, largest_first: bool=False,
+                      pipeline: bool=False, extract_jobs: int=2, keep_archives: bool=False, where: Optional[str]=None, dry_run: bool=False,
+                      offline: bool=False):
+    ## Compile the query first so a bad query fails before anything is fetched
+    query = compile_query(where) if where else None
+
+    dest = Path(destination)
+    dl = version_downloader(version, jobs, offline)
+    ## Fetch the latest metadata (or revalidate the cached copy)
+    metadata = dl.load_metadata()
 
     ## Collect videos to download
     to_download = []
     for c in metadata.classes:
         class_dir = dest.joinpath(c.name)
-        class_dir.mkdir(exist_ok=True)
         for v in c.videos:
-            if test_only:
-                if v.test_split:
-                    to_download.append([class_dir, v])
-            else:
-                ## ADD ANY DOWNLOAD FILTERS HERE ##
-                ## Use v.occlusion_tags, v.frame_occlusion_level etc.
-                ## Filter downloaded videos with an if statement like:
-                ## if "solid" in v.occlusion_tags:
-                to_download.append([class_dir, v])
+            if test_only and not v.test_split:
+                continue
+            if query is not None and not query(v, c.name):
+                continue
+            to_download.append([class_dir, v])
+
+    if dry_run:
+        download_size = sum(v.download_size for _, v in to_download)
+        install_size = sum(v.install_size for _, v in to_download)
+        print(f'{len(to_download)} videos, {download_size} bytes to download, {install_size} bytes installed')
+        return
+
+    ## Create dest and class dirs if they don't already exist
+    dest.mkdir(exist_ok=True)
+    for class_dir in {class_dir for class_dir, _ in to_download}:
+        class_dir.mkdir(exist_ok=True)
+
+    ## Download license, test.txt, train.txt
+    dl.download_additional_files(metadata.additional_files, dest)
+    ## Videos installed by earlier runs stay listed as installed
+    _, installed = load_local_metadata(dest)
+
+    ## Download and extract videos in a pipeline
+    if pipeline:
+        with ThreadPoolExecutor(max_workers=max(extract_jobs, 1)) as extractor:
+            extractions = []
+            def on_complete(class_dir: Path, v: AnnotatedVideo, zip_path: Path):
+                extractions.append(extractor.submit(extract_archive, zip_path, class_dir.joinpath(v.id), not keep_archives, time.time()))
+
+            dl.download_videos(to_download, jobs, clean, largest_first, on_complete)
+            for future in tqdm(as_completed(extractions), total=len(extractions), desc = "Extracting zip files..."):
+                future.result()
+        save_local_metadata(metadata, dest, installed | {(class_dir.name, v.id) for class_dir, v in to_download})
+        return
 
     ## Download videos
-    ## If clean is set, the video is skipped if it's already downloaded
-    for class_dir, v in tqdm(to_download, desc = "Downloading videos..."):
-        dl.download_url(v.path, class_dir, v.download_size, clean)
+    ## If clean is not set, the video is skipped if it's already downloaded
+    dl.download_videos(to_download, jobs, clean, largest_first)
     
     ## Extract zip archives
     if extract:
         for class_dir, v in tqdm(to_download, desc = "Extracting zip files..."):
-            ## Setup paths
-            v_zip_path = v.path
-            zip_path = dest.joinpath(v_zip_path)
-            v_folder = class_dir.joinpath(v.id)
-            v_folder.mkdir(exist_ok=True)
-            
-            ## Extract zip
-            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                zip_ref.extractall(v_folder)
-
-            ## If remove_archives is set, delete the zip file from the class folder
-            if remove_archives and os.path.isfile(zip_path):
-                os.remove(zip_path)
-
-from hoot.utils import hash_folder
-def verify_archives(directory: Path, version: str) -> List[Path]:
-    # returns a list of each video_dir that is invalid
+            extract_archive(dest.joinpath(v.path), class_dir.joinpath(v.id), remove_archives)
+
+    ## Remember which release this install came from, for hoot sync
+    save_local_metadata(metadata, dest, installed | {(class_dir.name, v.id) for class_dir, v in to_download})
+
+from hoot.utils import hash_folder, folder_fingerprint, pool_map
+from typing import NamedTuple, Dict
+
+verify_cache_name = '.hoot.verify_cache.json'
+
+class VerifyArgs(NamedTuple):
+    video_dir: str
+    cached: Optional[dict]
+    per_file: bool=False
+
+def verify_job(args: VerifyArgs) -> dict:
+    '''Hashes a video folder unless its fingerprint matches the cached entry - used in a multiprocessing pool
+        With per_file set, files are hashed on their own (on a few threads) and combined into a Merkle root,
+        otherwise the folder is hashed as one stream like hash_folder
+    '''
+    assert isinstance(args, VerifyArgs)
+    (video_dir, cached, per_file) = args
+    with metrics.span('fingerprint', video=video_dir):
+        fingerprint = folder_fingerprint(Path(video_dir))
+    ## A cached entry is only reused if it was hashed the same way (per file or as one stream)
+    if cached is not None and cached['fingerprint'] == fingerprint and ('files' if per_file else 'sha256') in cached:
+        return cached
+    if per_file:
+        with metrics.span('hash_files', video=video_dir) as hash_span:
+            files = hash_files(Path(video_dir))
+            hash_span.set(bytes=sum(size for size, _ in files.values()))
+        return {'fingerprint': fingerprint, 'install_size': sum(size for size, _ in files.values()),
+                'merkle_root': merkle_root({name: digest for name, (_, digest) in files.items()}), 'files': files}
+    install_size, sha256 = hash_folder(Path(video_dir))
+    return {'fingerprint': fingerprint, 'install_size': install_size, 'sha256': sha256}
+
+def verify_archives(directory: Path, version: str, threads: Optional[int]=None, full: bool=False, where: Optional[str]=None,
+                    offline: bool=False) -> Dict[Path, List[str]]:
+    '''
+    returns each video_dir that is invalid, with the names of its corrupt, missing or unexpected files
+    (an empty list when the video has no manifest and can only be checked as a whole)
+    Videos are hashed on a process pool with 'threads' workers (cpu count if None)
+    Videos with a merkle_root in metadata.json are hashed file by file, and compared against their
+    manifest only when the root doesn't match
+    Results are cached in directory/.hoot.verify_cache.json keyed on each video's file fingerprint
+    (names, sizes, mtimes, inodes) so unchanged videos are skipped on later runs - full forces a rehash
+    where (if given) is a metadata query (see hoot/query.py) that restricts which videos are verified
+    offline uses only the cached metadata - corrupt videos are then reported as a whole, since their
+    manifests can't be fetched
+    '''
+    query = compile_query(where) if where else None
     
     directory = Path(directory) #ensure it's a Path
     assert directory.exists()
     
-    ## Fetch the latest metadata
-    version_folder, quality = version.split("-")
-    download_url = f'{base_url}{version_folder}/{quality}/'
-    dl = Downloader(download_url)
-    metadata = load_from_json(dl.download_metadata())
+    ## Fetch the latest metadata (or revalidate the cached copy)
+    dl = version_downloader(version, offline=offline)
+    metadata = dl.load_metadata()
+
+    ## Index class and video metadata by name
+    video_index: Dict[Tuple[str, str], AnnotatedVideo] = {}
+    for c in metadata.classes:
+        for v in c.videos:
+            if query is None or query(v, c.name):
+                video_index[(c.name, v.id)] = v
+
+    ## Load the verification cache
+    cache_path = directory.joinpath(verify_cache_name)
+    cache = {}
+    if not full and cache_path.exists():
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
 
     #for each folderset on disk, verify data against the metadata.json
     #videos might be in 'test-only' mode or filtered some other way - assume videos present are intention
-    invalid_videos = []
-    for class_dir in directory.iterdir():
+    jobs = []
+    for class_dir in sorted(directory.iterdir()):
         if class_dir.is_dir() == False:
             continue
-
-        #find class metadata
-        class_metadata = None
-        for c in metadata.classes:
-            if c.name == class_dir.name:
-                class_metadata = c
-                break
-        if class_metadata is None:
-            continue
-        
-
-        for video_dir in class_dir.iterdir():
+        for video_dir in sorted(class_dir.iterdir()):
             if video_dir.is_dir() == False:
                 continue
+            if (class_dir.name, video_dir.name) not in video_index:
+                continue
+            key = f'{class_dir.name}/{video_dir.name}'
+            per_file = video_index[(class_dir.name, video_dir.name)].merkle_root is not None
+            jobs.append((key, video_dir, VerifyArgs(str(video_dir), cache.get(key), per_file)))
 
-            #find video metadata
-            video_metadata = None
-            for v in class_metadata.videos:
-                if v.id == video_dir.name:
-                    video_metadata = v
-                    break
-            if video_metadata is None:
+    results = pool_map(verify_job, [args for _, _, args in jobs], threads, desc='verifying videos')
+
+    invalid_videos = {}
+    for (key, video_dir, _), result in zip(jobs, results):
+        cache[key] = result
+        video_metadata = video_index[(video_dir.parent.name, video_dir.name)]
+        if video_metadata.merkle_root is None:
+            if video_metadata.install_size != result['install_size'] or video_metadata.sha256 != result['sha256']:
+                invalid_videos[video_dir] = []
+        elif video_metadata.merkle_root != result['merkle_root']:
+            ## Only corrupt videos need their manifest to pin down the bad files
+            if offline:
+                invalid_videos[video_dir] = []
                 continue
+            manifest = dl.download_manifest(video_metadata.path)
+            expected = {member['name'] for member in manifest['files']}
+            unexpected = [name for name in result['files'] if name not in expected]
+            invalid_videos[video_dir] = corrupt_members(manifest, result['files']) + unexpected
 
-            install_size, sha256 = hash_folder(video_dir)
-            if video_metadata.install_size != install_size or video_metadata.sha256 != sha256:
-                invalid_videos.append(video_dir)
+    ## Write the cache atomically so an interrupted run never leaves a broken cache
+    tmp_cache_path = str(cache_path) + '.tmp'
+    with open(tmp_cache_path, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_cache_path, cache_path)
                 
-    return invalid_videos    
+    return invalid_videos
+
+## Path of a zip member inside a video folder - member names come from the server's manifest, so names that
+## would land outside the folder (absolute paths, '..') are rejected
+def member_path(video_dir: Path, name: str) -> Path:
+    root = Path(video_dir).resolve()
+    path = root.joinpath(name).resolve()
+    if path == root or root not in path.parents:
+        raise DownloadError(f'{video_dir}: manifest member {name!r} is outside the video folder')
+    return path
+
+## Repairs the videos that fail verification
+## Corrupt or missing files are re-fetched one by one out of the remote zip with range requests, and files that
+## aren't in the manifest are deleted - videos without a manifest are downloaded and extracted again as a whole
+## Members are fetched on 'jobs' threads, returns whatever is still invalid afterwards (see verify_archives)
+def repair_archives(directory: Path, version: str, threads: Optional[int]=None, jobs: int=4, where: Optional[str]=None) -> Dict[Path, List[str]]:
+    directory = Path(directory)
+    invalid_videos = verify_archives(directory, version, threads, where=where)
+    if not invalid_videos:
+        return invalid_videos
+
+    dl = version_downloader(version, jobs)
+    metadata = dl.load_metadata()
+    videos = {(c.name, v.id): v for c in metadata.classes for v in c.videos}
+
+    def repair_member(video_dir: Path, zip_url: str, member: dict) -> int:
+        path = member_path(video_dir, member['name'])
+        content = dl.download_member(zip_url, member)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        return len(content)
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = []
+        for video_dir, names in invalid_videos.items():
+            v = videos[(video_dir.parent.name, video_dir.name)]
+            if v.merkle_root is None or not names:
+                ## Extracted next to the video and moved into place, so stale files in the old folder don't survive
+                zip_path = dl.download_url(v.path, video_dir.parent, v.download_size, True, zip_sha256=v.zip_sha256)
+                tmp_dir = video_dir.with_name(video_dir.name + '.tmp')
+                if tmp_dir.exists():
+                    shutil.rmtree(tmp_dir)
+                extract_archive(zip_path, tmp_dir, remove_archive=True)
+                shutil.rmtree(video_dir)
+                os.replace(tmp_dir, video_dir)
+                continue
+            members = {member['name']: member for member in dl.download_manifest(v.path)['files']}
+            for name in names:
+                if name in members:
+                    futures.append(executor.submit(repair_member, video_dir, v.path, members[name]))
+                else:
+                    os.remove(member_path(video_dir, name))
+        repaired_bytes = sum(future.result() for future in tqdm(as_completed(futures), total=len(futures), desc='repairing files'))
+    print(f'Re-fetched {len(futures)} files ({repaired_bytes} bytes)')
+
+    return verify_archives(directory, version, threads, where=where)
@@ -0,0 +1,170 @@
+## Tracker evaluation for HOOT
+## Computes success / precision / normalized precision for many trackers at once as NumPy batch operations,
+## broken down by frame-level occlusion attributes and occluder types
+##
+## Tracker results are read from <results_dir>/<tracker>/<video_key>.txt with one x,y,w,h box per frame
+## (comma, tab or space separated), in the same order as the video frames
+
+import json
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+import numpy as np
+
+from hoot.anno import load_video_from_file, OcclusionTags
+from hoot.utils import pool_map
+from hoot.geometry import polygons_to_xywh, iou_xywh
+
+## Thresholds used for the success / precision / normalized precision curves
+SUCCESS_THRESHOLDS = np.linspace(0, 1, 21)
+PRECISION_THRESHOLDS = np.arange(0, 51)
+NORM_PRECISION_THRESHOLDS = np.linspace(0, 0.5, 51)
+PRECISION_PIXELS = 20
+
+## Conditions results are broken down by - each is a boolean mask over the evaluated frames
+## Frames where the target is absent are never scored
+ATTRIBUTE_CONDITIONS = ["full_occlusion", "similar_occluder", "cut_by_frame", "partial_obj_occlusion"]
+OCCLUDER_CONDITIONS = {"s": OcclusionTags.solid, "sp": OcclusionTags.sparse,
+                       "st": OcclusionTags.semi_transparent, "t": OcclusionTags.transparent}
+
+class EvalArgs(NamedTuple):
+    video_dir: str
+    results_dir: str
+    trackers: List[str]
+
+## Reads a tracker result file into an (num_frames,4) array, missing rows are NaN
+## Raises ValueError naming the file and line for a line that isn't 4 numbers
+def load_tracker_results(result_file: Path, num_frames: int) -> np.ndarray:
+    boxes = np.full((num_frames, 4), np.nan)
+    if not result_file.exists():
+        return boxes
+    rows = []
+    with open(result_file, 'r') as f:
+        for line_number, line in enumerate(f, start=1):
+            values = line.replace(',', ' ').split()
+            if not values:
+                continue
+            if len(values) != 4:
+                raise ValueError(f'{result_file}:{line_number}: expected 4 values (x,y,w,h), got {len(values)}')
+            try:
+                rows.append([float(v) for v in values])
+            except ValueError:
+                raise ValueError(f'{result_file}:{line_number}: invalid box {line.strip()!r}') from None
+    results = np.array(rows, dtype=np.float64).reshape(-1, 4)[:num_frames]
+    boxes[:len(results)] = results
+    return boxes
+
+def eval_job(args: EvalArgs) -> dict:
+    '''Computes per-frame errors of every tracker on a single video - used in a multiprocessing pool'''
+    assert isinstance(args, EvalArgs)
+    video = load_video_from_file(Path(args.video_dir), lazy=True)
+    num_frames = len(video.frames)
+
+    ## Gather ground truth and conditions straight from the raw frame dicts
+    gt_polygons = np.full((num_frames, 4, 2), np.nan)
+    conditions = {name: np.zeros(num_frames, dtype=bool) for name in ["absent"] + ATTRIBUTE_CONDITIONS + list(OCCLUDER_CONDITIONS.values())}
+    for i in range(num_frames):
+        frame_data = video.frames.raw(i)
+        aa_bb = np.asarray(frame_data['aa_bb'], dtype=np.float64)
+        if aa_bb.shape == (4, 2):
+            gt_polygons[i] = aa_bb
+        conditions["absent"][i] = frame_data['attributes']['absent']
+        for attr in ATTRIBUTE_CONDITIONS:
+            conditions[attr][i] = frame_data['attributes'][attr]
+        for occ_type, tag in OCCLUDER_CONDITIONS.items():
+            conditions[tag][i] = isinstance(frame_data['occ_masks'].get(occ_type, []), dict)
+
+    ## Only frames with a visible, annotated target are scored
+    gt = polygons_to_xywh(gt_polygons)
+    valid = ~conditions.pop("absent") & ~np.isnan(gt).any(axis=1)
+    gt = gt[valid]
+    gt_center = gt[:, :2] + gt[:, 2:] / 2
+
+    errors = {}
+    for tracker in args.trackers:
+        pred = load_tracker_results(Path(args.results_dir, tracker, f'{video.video_key}.txt'), num_frames)[valid]
+        failed = np.isnan(pred).any(axis=1)
+        pred = np.nan_to_num(pred, nan=0.0)
+        iou = np.where(failed, 0.0, iou_xywh(gt, pred))
+        center_error = np.linalg.norm(pred[:, :2] + pred[:, 2:] / 2 - gt_center, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            norm_center_error = np.linalg.norm((pred[:, :2] + pred[:, 2:] / 2 - gt_center) / gt[:, 2:], axis=1)
+        center_error[failed] = np.inf
+        norm_center_error[failed | ~np.isfinite(norm_center_error)] = np.inf
+        errors[tracker] = (iou, center_error, norm_center_error)
+
+    return {
+        'video_key': video.video_key,
+        'conditions': {name: mask[valid] for name, mask in conditions.items()},
+        'errors': errors
+    }
+
+## Success / precision / normalized precision for one set of frames, curves are computed in a single broadcast
+def compute_metrics(iou: np.ndarray, center_error: np.ndarray, norm_center_error: np.ndarray) -> Dict[str, float]:
+    if len(iou) == 0:
+        return {'frames': 0, 'success_auc': float('nan'), 'precision': float('nan'), 'norm_precision_auc': float('nan')}
+    success = (iou[:, None] > SUCCESS_THRESHOLDS[None, :]).mean(axis=0)
+    precision = (center_error[:, None] <= PRECISION_THRESHOLDS[None, :]).mean(axis=0)
+    norm_precision = (norm_center_error[:, None] <= NORM_PRECISION_THRESHOLDS[None, :]).mean(axis=0)
+    return {
+        'frames': int(len(iou)),
+        'success_auc': float(success.mean()),
+        'precision': float(precision[PRECISION_PIXELS]),
+        'norm_precision_auc': float(norm_precision.mean()),
+    }
+
+## Evaluates every tracker in results_directory (or the given ones) on the videos in data_directory
+## video_keys restricts evaluation to a subset of videos (eg. the test split)
+## Returns {tracker: {condition: {metric: value}}}, where condition is 'all' or an attribute/occluder tag
+def evaluate_trackers(data_directory: str, results_directory: str, trackers: Optional[List[str]]=None,
+                      video_keys: Optional[List[str]]=None, threads: Optional[int]=None) -> Dict[str, Dict[str, Dict[str, float]]]:
+    datapath = Path(data_directory)
+    resultspath = Path(results_directory)
+    if trackers is None:
+        trackers = [d.name for d in sorted(resultspath.iterdir()) if d.is_dir()]
+    if video_keys is not None:
+        video_keys = set(video_keys)
+
+    video_dirs = []
+    for class_dir in sorted(datapath.iterdir()):
+        if not class_dir.is_dir():
+            continue
+        for video_dir in sorted(class_dir.iterdir()):
+            if not video_dir.is_dir() or not video_dir.joinpath('anno.json').exists():
+                continue
+            if video_keys is not None and f'{class_dir.name}-{video_dir.name}' not in video_keys:
+                continue
+            video_dirs.append(video_dir)
+
+    jobs = [EvalArgs(str(v), str(resultspath), trackers) for v in video_dirs]
+    results = pool_map(eval_job, jobs, threads, desc='evaluating videos')
+    if not results:
+        return {}
+
+    ## Concatenate per-frame arrays over the whole benchmark
+    condition_names = list(results[0]['conditions'].keys())
+    conditions = {name: np.concatenate([r['conditions'][name] for r in results]) for name in condition_names}
+    report = {}
+    for tracker in trackers:
+        iou, center_error, norm_center_error = (np.concatenate([r['errors'][tracker][i] for r in results]) for i in range(3))
+        report[tracker] = {'all': compute_metrics(iou, center_error, norm_center_error)}
+        for name, mask in conditions.items():
+            report[tracker][name] = compute_metrics(iou[mask], center_error[mask], norm_center_error[mask])
+    return report
+
+## Prints a tracker x condition table of success AUCs, and writes the full report to output_file if given
+def print_report(report: Dict[str, Dict[str, Dict[str, float]]], output_file: Optional[str]=None) -> None:
+    if output_file:
+        with open(output_file, 'w') as f:
+            json.dump(report, f, indent=2)
+    if not report:
+        print('No videos evaluated')
+        return
+
+    conditions = list(next(iter(report.values())).keys())
+    name_width = max(len('tracker'), max(len(t) for t in report))
+    print(f'{"tracker":<{name_width}}  {"prec@20":>8}  {"norm_prec":>9}  ' + '  '.join(f'{c[:12]:>12}' for c in conditions))
+    for tracker, tracker_report in report.items():
+        row = f'{tracker:<{name_width}}  {tracker_report["all"]["precision"]:>8.3f}  {tracker_report["all"]["norm_precision_auc"]:>9.3f}  '
+        row += '  '.join(f'{tracker_report[c]["success_auc"]:>12.3f}' for c in conditions)
+        print(row)
+    print('(columns after norm_prec are success AUC per condition)')
@@ -0,0 +1,151 @@
+## Decoded frame cache for HOOT
+## Converts each video's PNG frames once into a raw uint8 array file (<dest>/<class>/<video>.frames) that is
+## memory-mapped at load time - reading a frame is then a page-cache read instead of a PNG decode
+##
+## File layout: 8 byte magic, 4 byte little-endian header length, json header, zero padding up to a
+## page boundary, then the (num_frames, height, width, 3) uint8 BGR frames (as decoded by cv2)
+
+import json
+import os
+import struct
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Tuple, Union
+import cv2
+import numpy as np
+
+from hoot.anno import load_video_from_file
+from hoot.utils import pool_map, folder_fingerprint
+from hoot import metrics
+
+FRAME_CACHE_MAGIC = b'HOOTFRM1'
+FRAME_CACHE_SUFFIX = '.frames'
+## Frame data starts on a page boundary so it can be mapped directly
+DATA_ALIGNMENT = 4096
+
+class FrameCacheArgs(NamedTuple):
+    video_dir: str
+    output_path: str
+    resize: Optional[Union[float, Tuple[int, int]]]
+
+def _data_offset(header_length: int) -> int:
+    return -(-(len(FRAME_CACHE_MAGIC) + 4 + header_length) // DATA_ALIGNMENT) * DATA_ALIGNMENT
+
+## Reads a cache file's header, returns (header, data_offset) or None if it isn't a frame cache
+def _read_header(path: Path) -> Optional[Tuple[dict, int]]:
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(FRAME_CACHE_MAGIC)) != FRAME_CACHE_MAGIC:
+                return None
+            (header_length,) = struct.unpack('<I', f.read(4))
+            return (json.loads(f.read(header_length)), _data_offset(header_length))
+    except (OSError, ValueError, struct.error):
+        return None
+
+## Size a frame of width x height is cached at
+def _target_size(width: int, height: int, resize: Optional[Union[float, Tuple[int, int]]]) -> Tuple[int, int]:
+    if resize is None:
+        return (width, height)
+    if isinstance(resize, (tuple, list)):
+        return (int(resize[0]), int(resize[1]))
+    return (max(int(width * resize), 1), max(int(height * resize), 1))
+
+def cache_frames_job(args: FrameCacheArgs) -> str:
+    '''Decodes every frame of a video into its cache file - used in a multiprocessing pool
+        Skips videos whose cache was built from the same files at the same size
+        Writes to a .tmp file first, so an interrupted run never leaves a truncated cache behind
+    '''
+    assert isinstance(args, FrameCacheArgs)
+    video = load_video_from_file(Path(args.video_dir), lazy=True)
+    width, height = _target_size(video.width, video.height, args.resize)
+    fingerprint = folder_fingerprint(Path(args.video_dir))
+    output_path = Path(args.output_path)
+
+    existing = _read_header(output_path)
+    if existing is not None and existing[0]['source_fingerprint'] == fingerprint and existing[0]['shape'][1:3] == [height, width]:
+        return 'cached'
+
+    frame_ids = [int(video.frames.raw(i)['frame_id']) for i in range(len(video.frames))]
+    header = json.dumps({
+        'video_key': video.video_key,
+        'shape': [len(frame_ids), height, width, 3],
+        'dtype': 'uint8',
+        'color': 'bgr',
+        'frame_ids': frame_ids,
+        'source_size': [video.width, video.height],
+        'source_fingerprint': fingerprint,
+    }).encode('utf-8')
+    data_offset = _data_offset(len(header))
+
+    tmp_path = Path(str(output_path) + '.tmp')
+    with metrics.span('cache_frames', video=args.video_dir) as cache_span, open(tmp_path, 'wb') as f:
+        f.write(FRAME_CACHE_MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        f.write(b'\0' * (data_offset - f.tell()))
+        for frame_id in frame_ids:
+            img = cv2.imread(str(Path(args.video_dir).joinpath(f'{frame_id:06}.png')), cv2.IMREAD_COLOR)
+            if img is None:
+                raise FileNotFoundError(Path(args.video_dir).joinpath(f'{frame_id:06}.png'))
+            if img.shape[:2] != (height, width):
+                img = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+            f.write(np.ascontiguousarray(img).data)
+        cache_span.set(bytes=f.tell() - data_offset, frames=len(frame_ids))
+    os.replace(tmp_path, output_path)
+    return 'built'
+
+## Converts every video in a HOOT directory into a frame cache in destination (<class>/<video>.frames)
+## resize is a scale factor or a (width, height) to cache the frames at, full resolution if None
+## Videos are converted on a process pool with 'threads' workers (cpu count if None)
+def build_frame_cache(directory: str, destination: str, resize: Optional[Union[float, Tuple[int, int]]]=None,
+                      threads: Optional[int]=None) -> None:
+    datapath = Path(directory)
+    dest = Path(destination)
+
+    jobs = []
+    for class_dir in sorted(datapath.iterdir()):
+        if not class_dir.is_dir():
+            continue
+        for video_dir in sorted(class_dir.iterdir()):
+            if video_dir.is_dir() and video_dir.joinpath('anno.json').exists():
+                dest.joinpath(class_dir.name).mkdir(parents=True, exist_ok=True)
+                output_path = dest.joinpath(class_dir.name, video_dir.name + FRAME_CACHE_SUFFIX)
+                jobs.append(FrameCacheArgs(str(video_dir), str(output_path), resize))
+
+    results = pool_map(cache_frames_job, jobs, threads, desc='caching frames')
+    print(f'Cached {results.count("built")} videos ({results.count("cached")} already up to date)')
+
+## Memory-mapped frames of one video
+## cached[idx] / cached.frame(frame_id) are zero-copy (height, width, 3) views into the mapping
+class CachedFrames:
+    def __init__(self, path: str):
+        self.path = Path(path)
+        result = _read_header(self.path)
+        if result is None:
+            raise ValueError(f'{path} is not a HOOT frame cache')
+        header, data_offset = result
+        self.video_key: str = header['video_key']
+        self.shape: Tuple[int, ...] = tuple(header['shape'])
+        self.frame_ids: List[int] = header['frame_ids']
+        self.source_size: Tuple[int, int] = tuple(header['source_size'])
+        self._positions = {frame_id: idx for idx, frame_id in enumerate(self.frame_ids)}
+        ## Plain read-only ndarray over the mapping (it keeps the map open)
+        ## A video without frames has no data region to map
+        if self.shape[0] > 0:
+            self.frames = np.memmap(self.path, dtype=np.dtype(header['dtype']), mode='r', offset=data_offset, shape=self.shape).view(np.ndarray)
+        else:
+            self.frames = np.zeros(self.shape, dtype=np.dtype(header['dtype']))
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        return self.frames[idx]
+
+    ## Frame by its anno.json frame_id
+    def frame(self, frame_id: int) -> np.ndarray:
+        return self.frames[self._positions[frame_id]]
+
+## Opens the cached frames of a video, eg. load_cached_frames('/path/to/cache', 'apple-001')
+def load_cached_frames(cache_directory: str, video_key: str) -> CachedFrames:
+    class_name, video_id = video_key.rsplit('-', 1)
+    return CachedFrames(str(Path(cache_directory).joinpath(class_name, video_id + FRAME_CACHE_SUFFIX)))
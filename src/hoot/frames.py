@@ -0,0 +1,87 @@
+## Streaming frame iterator for HOOT videos
+## Decodes the next frames on a background thread pool while the current one is processed
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+import cv2
+import numpy as np
+
+from hoot.anno import Video, Frame
+from hoot.frame_cache import CachedFrames
+
+FrameItem = Tuple[Frame, np.ndarray, Optional[Dict[str, np.ndarray]]]
+
+## Iterates a video's frames, yielding (frame, image, masks)
+##   prefetch      - number of frames decoded ahead of the one being processed (bounds memory use)
+##   workers       - number of decode threads (cv2.imread releases the GIL)
+##   with_masks    - occ. types to decode masks for (eg. ["s", "st"]), masks is None if not given
+##   resize        - (width, height) (tuple or list) or a scale factor applied while decoding, masks are resized to match
+##   reuse_buffers - with resize, decode into a fixed ring of output buffers instead of allocating per frame
+##                   the yielded image is then only valid until the iterator is advanced - copy it to keep it
+##   start/stop    - frame range to iterate (python slice semantics)
+##   cached        - the video's CachedFrames (see hoot/frame_cache.py) - images are then read-only views
+##                   into the cache instead of decoded PNGs
+def iter_frames(video: Video, prefetch: int=8, workers: int=4, with_masks: Optional[List[str]]=None,
+                resize: Optional[Union[float, Tuple[int, int], List[int]]]=None, reuse_buffers: bool=False,
+                start: int=0, stop: Optional[int]=None, cached: Optional[CachedFrames]=None) -> Iterator[FrameItem]:
+    ## Frames are only built (eg. by LazyFrames/BinaryFrames) when the loader gets to them, on the decode threads
+    frame_indices = range(*slice(start, stop).indices(len(video.frames)))
+    prefetch = max(prefetch, 1)
+    ## The frame being processed + prefetched ones never share a slot
+    num_slots = prefetch + 2
+    buffers: List[Optional[np.ndarray]] = [None] * num_slots
+
+    def load(idx: int, frame_index: int) -> FrameItem:
+        frame = video.frames[frame_index]
+        if cached is not None:
+            img = cached.frame(frame.frame_id)
+        else:
+            img = cv2.imread(str(frame.frame_path), cv2.IMREAD_COLOR)
+            if img is None:
+                raise FileNotFoundError(frame.frame_path)
+
+        size = None
+        if resize is not None:
+            if isinstance(resize, (tuple, list)):
+                size = (int(resize[0]), int(resize[1]))
+            else:
+                size = (int(img.shape[1] * resize), int(img.shape[0] * resize))
+            slot = idx % num_slots
+            dst = buffers[slot] if reuse_buffers else None
+            img = cv2.resize(img, size, dst=dst, interpolation=cv2.INTER_AREA)
+            if reuse_buffers:
+                buffers[slot] = img
+
+        ## Frames cached at a lower resolution get masks to match
+        if size is None and img.shape[:2] != (video.height, video.width):
+            size = (img.shape[1], img.shape[0])
+
+        masks = None
+        if with_masks is not None:
+            masks = {}
+            for occ_type, occ_mask_obj in frame.occ_masks.get_masks(with_masks):
+                if occ_mask_obj:
+                    mask_mat = occ_mask_obj.mask
+                    if size is not None:
+                        mask_mat = cv2.resize(mask_mat, size, interpolation=cv2.INTER_NEAREST)
+                    masks[occ_type] = mask_mat
+        return (frame, img, masks)
+
+    executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+    try:
+        pending = deque()
+        jobs = iter(enumerate(frame_indices))
+        for idx, frame_index in jobs:
+            pending.append(executor.submit(load, idx, frame_index))
+            if len(pending) >= prefetch:
+                break
+
+        while pending:
+            item = pending.popleft().result()
+            next_job = next(jobs, None)
+            if next_job is not None:
+                pending.append(executor.submit(load, *next_job))
+            yield item
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,130 @@
+## Vectorized box geometry for HOOT
+## Batched IoU between convex quadrilaterals (eg. Frame.rot_bb) and axis-aligned boxes as NumPy operations
+## All polygon arrays are (N,4,2): N boxes of 4 [x, y] points, in either winding order
+
+from typing import Optional
+import numpy as np
+
+## A convex quad clipped by another convex quad has at most 8 vertices
+MAX_CLIP_VERTICES = 8
+
+## Converts (N,K,2) polygons (eg. aa_bb) to (N,4) x,y,w,h boxes
+def polygons_to_xywh(polygons: np.ndarray) -> np.ndarray:
+    polygons = np.asarray(polygons, dtype=np.float64)
+    mins = polygons.min(axis=1)
+    maxs = polygons.max(axis=1)
+    return np.concatenate([mins, maxs - mins], axis=1)
+
+## Converts (N,4) x,y,w,h boxes to (N,4,2) counter-clockwise polygons
+def xywh_to_polygons(boxes: np.ndarray) -> np.ndarray:
+    boxes = np.asarray(boxes, dtype=np.float64)
+    x, y, w, h = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    return np.stack([
+        np.stack([x, y], axis=1),
+        np.stack([x + w, y], axis=1),
+        np.stack([x + w, y + h], axis=1),
+        np.stack([x, y + h], axis=1)
+    ], axis=1)
+
+## Signed area of (N,K,2) polygons (shoelace) - positive for counter-clockwise in x-right/y-up coordinates
+def signed_polygon_area(polygons: np.ndarray) -> np.ndarray:
+    x = polygons[..., 0]
+    y = polygons[..., 1]
+    return 0.5 * (x * np.roll(y, -1, axis=-1) - np.roll(x, -1, axis=-1) * y).sum(axis=-1)
+
+## Area of (N,K,2) polygons
+def polygon_area(polygons: np.ndarray) -> np.ndarray:
+    return np.abs(signed_polygon_area(polygons))
+
+## Reverses polygons with negative signed area so all of them have the same (positive) winding
+def _orient(polygons: np.ndarray) -> np.ndarray:
+    flip = signed_polygon_area(polygons) < 0
+    polygons = polygons.copy()
+    polygons[flip] = polygons[flip, ::-1]
+    return polygons
+
+## Clips (N,M,2) subject polygons with counts[N] valid vertices by the half-plane left of edge e0->e1 (N,2)
+## One Sutherland-Hodgman step for all polygons at once, returns the clipped polygons and their counts
+def _clip_half_plane(subject: np.ndarray, counts: np.ndarray, e0: np.ndarray, e1: np.ndarray):
+    num, max_vertices = subject.shape[:2]
+    edge = (e1 - e0)[:, None, :]
+    side = edge[..., 0] * (subject[..., 1] - e0[:, None, 1]) - edge[..., 1] * (subject[..., 0] - e0[:, None, 0])
+
+    idx = np.arange(max_vertices)[None, :]
+    prev_idx = np.where(idx == 0, np.maximum(counts[:, None] - 1, 0), idx - 1)
+    valid = idx < counts[:, None]
+
+    cur_pts = subject
+    prev_pts = np.take_along_axis(subject, prev_idx[..., None], axis=1)
+    cur_side = side
+    prev_side = np.take_along_axis(side, prev_idx, axis=1)
+    cur_in = cur_side >= 0
+    prev_in = prev_side >= 0
+
+    ## Crossing point of the segment prev->cur with the clip line
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = prev_side / (prev_side - cur_side)
+    t = np.nan_to_num(t, nan=0.0, posinf=0.0, neginf=0.0)[..., None]
+    crossing = prev_pts + t * (cur_pts - prev_pts)
+
+    ## For each input vertex emit [crossing, cur] - crossing when the segment changes side, cur when inside
+    emitted = np.stack([crossing, cur_pts], axis=2).reshape(num, 2 * max_vertices, 2)
+    ## (a vertex exactly on the line is kept as is, so no duplicate crossing is emitted for it)
+    crosses = (cur_in != prev_in) & (cur_side != 0) & (prev_side != 0)
+    keep = np.stack([valid & crosses, valid & cur_in], axis=2).reshape(num, 2 * max_vertices)
+
+    ## Compact kept points to the front of each row, preserving order
+    order = np.argsort(~keep, axis=1, kind='stable')[:, :MAX_CLIP_VERTICES]
+    clipped = np.take_along_axis(emitted, order[..., None], axis=1)
+    new_counts = np.minimum(keep.sum(axis=1), MAX_CLIP_VERTICES)
+    return clipped, new_counts
+
+## Intersection area of convex (N,4,2) polygons a and b
+def convex_intersection_area(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    a = _orient(np.asarray(a, dtype=np.float64))
+    b = _orient(np.asarray(b, dtype=np.float64))
+    num = a.shape[0]
+
+    subject = np.zeros((num, MAX_CLIP_VERTICES, 2))
+    subject[:, :a.shape[1]] = a
+    counts = np.full(num, a.shape[1])
+    for k in range(b.shape[1]):
+        subject, counts = _clip_half_plane(subject, counts, b[:, k], b[:, (k + 1) % b.shape[1]])
+
+    ## Pad unused vertices with the first one so they add nothing to the shoelace sum
+    pad = np.arange(MAX_CLIP_VERTICES)[None, :] >= counts[:, None]
+    subject = np.where(pad[..., None], subject[:, :1], subject)
+    area = polygon_area(subject)
+    return np.where(counts >= 3, area, 0.0)
+
+## IoU of convex (N,4,2) polygon arrays, eg. predicted rotated boxes against Frame.rot_bb
+## chunk_size bounds the size of the temporary arrays for very large N
+def quad_iou(a: np.ndarray, b: np.ndarray, chunk_size: Optional[int]=None) -> np.ndarray:
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    assert a.shape == b.shape and a.ndim == 3 and a.shape[1:] == (4, 2), 'expected two (N,4,2) polygon arrays'
+
+    if chunk_size is not None and len(a) > chunk_size:
+        return np.concatenate([quad_iou(a[i:i + chunk_size], b[i:i + chunk_size]) for i in range(0, len(a), chunk_size)])
+
+    inter = convex_intersection_area(a, b)
+    union = polygon_area(a) + polygon_area(b) - inter
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = np.where(union > 0, inter / union, 0.0)
+    return np.nan_to_num(iou, nan=0.0)
+
+## IoU of (N,4) x,y,w,h boxes against (N,4,2) rotated boxes
+def xywh_quad_iou(boxes: np.ndarray, polygons: np.ndarray, chunk_size: Optional[int]=None) -> np.ndarray:
+    return quad_iou(xywh_to_polygons(boxes), polygons, chunk_size)
+
+## IoU of two (N,4) arrays of x,y,w,h boxes
+def iou_xywh(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    x1 = np.maximum(a[:, 0], b[:, 0])
+    y1 = np.maximum(a[:, 1], b[:, 1])
+    x2 = np.minimum(a[:, 0] + a[:, 2], b[:, 0] + b[:, 2])
+    y2 = np.minimum(a[:, 1] + a[:, 3], b[:, 1] + b[:, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    union = a[:, 2] * a[:, 3] + b[:, 2] * b[:, 3] - inter
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = np.where(union > 0, inter / union, 0.0)
+    return np.nan_to_num(iou, nan=0.0)
@@ -0,0 +1,191 @@
+## Columnar annotation index for HOOT
+## Compiles every anno.json/meta.info in a dataset into a set of .npy arrays (one row per frame)
+## that can be memory-mapped and filtered with NumPy across the whole benchmark
+
+import json
+import dataclasses
+from pathlib import Path
+from typing import List, Optional, NamedTuple, Dict
+import numpy as np
+
+from hoot.anno import load_video_from_file, FrameAttributes
+from hoot.utils import pool_map
+
+## Bit positions for the attributes and occluders columns
+ATTRIBUTE_BITS = {f.name: i for i, f in enumerate(dataclasses.fields(FrameAttributes))}
+OCCLUDER_TYPES = ["all", "s", "sp", "st", "t"]
+OCCLUDER_BITS = {occ_type: i for i, occ_type in enumerate(OCCLUDER_TYPES)}
+
+## Per-frame columns, each stored as <name>.npy in the index directory
+## rle_sizes holds the [height, width] of each mask, which needn't be the video size (eg. rescaled masks)
+COLUMNS = ["video_idx", "frame_id", "aa_bb", "rot_bb", "attributes", "occluders", "rle_offsets", "rle_lengths", "rle_sizes"]
+RLE_PAYLOAD = "rle.bin"
+INDEX_INFO = "index.json"
+
+class IndexArgs(NamedTuple):
+    video_dir: str
+
+def _box_array(box: list) -> np.ndarray:
+    '''Converts a 4-point polygon to a (4,2) array, NaN if the box isn't annotated'''
+    arr = np.asarray(box, dtype=np.float32)
+    if arr.shape != (4, 2):
+        return np.full((4, 2), np.nan, dtype=np.float32)
+    return arr
+
+def index_job(args: IndexArgs) -> dict:
+    '''Builds the columns for a single video - used in a multiprocessing pool'''
+    assert isinstance(args, IndexArgs)
+    video = load_video_from_file(Path(args.video_dir), lazy=True)
+    num_frames = len(video.frames)
+
+    frame_id = np.zeros(num_frames, dtype=np.int32)
+    aa_bb = np.zeros((num_frames, 4, 2), dtype=np.float32)
+    rot_bb = np.zeros((num_frames, 4, 2), dtype=np.float32)
+    attributes = np.zeros(num_frames, dtype=np.uint8)
+    occluders = np.zeros(num_frames, dtype=np.uint8)
+    rle_offsets = np.zeros((num_frames, len(OCCLUDER_TYPES)), dtype=np.int64)
+    rle_lengths = np.zeros((num_frames, len(OCCLUDER_TYPES)), dtype=np.int32)
+    rle_sizes = np.zeros((num_frames, len(OCCLUDER_TYPES), 2), dtype=np.int32)
+    payload = bytearray()
+
+    for i in range(num_frames):
+        frame_data = video.frames.raw(i)
+        frame_id[i] = int(frame_data['frame_id'])
+        aa_bb[i] = _box_array(frame_data['aa_bb'])
+        rot_bb[i] = _box_array(frame_data['rot_bb'])
+        for attr, bit in ATTRIBUTE_BITS.items():
+            if frame_data['attributes'][attr]:
+                attributes[i] |= 1 << bit
+        for occ_type, bit in OCCLUDER_BITS.items():
+            m = frame_data['occ_masks'].get(occ_type, [])
+            if isinstance(m, dict):
+                occluders[i] |= 1 << bit
+                ## Hex from anno.json, raw bytes from anno.bin
+                counts = m['counts'] if isinstance(m['counts'], bytes) else bytes.fromhex(m['counts'])
+                rle_offsets[i, bit] = len(payload)
+                rle_lengths[i, bit] = len(counts)
+                rle_sizes[i, bit] = [int(d) for d in m['size']]
+                payload += counts
+
+    return {
+        'video_key': video.video_key,
+        'video_path': video.video_path,
+        'height': video.height,
+        'width': video.width,
+        'frame_id': frame_id,
+        'aa_bb': aa_bb,
+        'rot_bb': rot_bb,
+        'attributes': attributes,
+        'occluders': occluders,
+        'rle_offsets': rle_offsets,
+        'rle_lengths': rle_lengths,
+        'rle_sizes': rle_sizes,
+        'payload': bytes(payload)
+    }
+
+## Walks a HOOT directory and writes the columnar index to destination
+def build_index(directory: str, destination: str, threads: Optional[int]=None) -> None:
+    datapath = Path(directory)
+    dest = Path(destination)
+    dest.mkdir(parents=True, exist_ok=True)
+
+    # Assemble all video directories
+    jobs = []
+    for class_dir in sorted(datapath.iterdir()):
+        if not class_dir.is_dir():
+            continue
+        for video_dir in sorted(class_dir.iterdir()):
+            if video_dir.is_dir() and video_dir.joinpath('anno.json').exists():
+                jobs.append(IndexArgs(str(video_dir)))
+
+    results = pool_map(index_job, jobs, threads, desc='indexing videos')
+
+    # Concatenate per-video columns, shifting RLE offsets into the global payload
+    columns: Dict[str, list] = {name: [] for name in COLUMNS}
+    videos = []
+    frame_start = 0
+    payload_size = 0
+    with open(dest.joinpath(RLE_PAYLOAD), 'wb') as f:
+        for video_idx, r in enumerate(results):
+            num_frames = len(r['frame_id'])
+            columns['video_idx'].append(np.full(num_frames, video_idx, dtype=np.int32))
+            for name in ['frame_id', 'aa_bb', 'rot_bb', 'attributes', 'occluders', 'rle_lengths', 'rle_sizes']:
+                columns[name].append(r[name])
+            columns['rle_offsets'].append(r['rle_offsets'] + payload_size)
+            f.write(r['payload'])
+            payload_size += len(r['payload'])
+            videos.append({
+                'video_key': r['video_key'],
+                'video_path': r['video_path'],
+                'height': r['height'],
+                'width': r['width'],
+                'frame_start': frame_start,
+                'num_frames': num_frames
+            })
+            frame_start += num_frames
+
+    for name in COLUMNS:
+        np.save(dest.joinpath(f'{name}.npy'), np.concatenate(columns[name]) if columns[name] else np.zeros(0))
+
+    with open(dest.joinpath(INDEX_INFO), 'w') as f:
+        json.dump({
+            'attribute_bits': ATTRIBUTE_BITS,
+            'occluder_bits': OCCLUDER_BITS,
+            'videos': videos
+        }, f, indent=2)
+
+    print(f'Indexed {frame_start} frames from {len(videos)} videos')
+
+## Memory-mapped view of an index written by build_index
+## Every column is a NumPy array with one row per frame, eg. index.aa_bb[rows]
+class HootIndex:
+    def __init__(self, directory: str, mmap: bool=True):
+        self.directory = Path(directory)
+        with open(self.directory.joinpath(INDEX_INFO), 'r') as f:
+            info = json.load(f)
+        self.attribute_bits: Dict[str, int] = info['attribute_bits']
+        self.occluder_bits: Dict[str, int] = info['occluder_bits']
+        self.videos: List[dict] = info['videos']
+        self.video_keys = np.array([v['video_key'] for v in self.videos])
+
+        mmap_mode = 'r' if mmap else None
+        for name in COLUMNS:
+            setattr(self, name, np.load(self.directory.joinpath(f'{name}.npy'), mmap_mode=mmap_mode))
+        payload_path = self.directory.joinpath(RLE_PAYLOAD)
+        if payload_path.stat().st_size > 0:
+            self.rle_payload = np.memmap(payload_path, dtype=np.uint8, mode='r')
+        else:
+            self.rle_payload = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return len(self.frame_id)
+
+    ## Boolean mask of frames with the given FrameAttributes flag set, eg. has_attribute('full_occlusion')
+    def has_attribute(self, attr: str) -> np.ndarray:
+        return (self.attributes & np.uint8(1 << self.attribute_bits[attr])) != 0
+
+    ## Boolean mask of frames that have a mask for the given occluder type, eg. has_occluder('s')
+    def has_occluder(self, occ_type: str) -> np.ndarray:
+        return (self.occluders & np.uint8(1 << self.occluder_bits[occ_type])) != 0
+
+    ## Boolean mask of frames that belong to the given video key, eg. 'apple-001'
+    def video_rows(self, video_key: str) -> np.ndarray:
+        return self.video_keys[self.video_idx] == video_key
+
+    ## Video key of each of the given frame rows
+    def video_key_of(self, rows) -> np.ndarray:
+        return self.video_keys[self.video_idx[rows]]
+
+    ## COCO RLE dict for a frame row and occluder type (None if the frame has no such mask)
+    ## The result can be passed straight to pycocotools.mask.decode/area/merge
+    def rle(self, row: int, occ_type: str) -> Optional[dict]:
+        bit = self.occluder_bits[occ_type]
+        if not self.occluders[row] & (1 << bit):
+            return None
+        start = int(self.rle_offsets[row, bit])
+        counts = self.rle_payload[start:start + int(self.rle_lengths[row, bit])].tobytes()
+        return {"size": [int(d) for d in self.rle_sizes[row, bit]], "counts": counts}
+
+## Loads an index written by build_index
+def load_index(directory: str, mmap: bool=True) -> HootIndex:
+    return HootIndex(directory, mmap)
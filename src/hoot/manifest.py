@@ -0,0 +1,126 @@
+## Per-file hash manifests for video archives
+## Every video zip gets a <id>.manifest.json sidecar listing each member's size, sha256 and position in the zip,
+## and the Merkle root over those hashes is stored in metadata.json
+##
+## Files can then be hashed independently (in parallel), a corrupt video can be narrowed down to the exact
+## frames that don't match, and those members can be re-fetched from the zip with HTTP range requests
+
+import hashlib
+import json
+import os
+import struct
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+MANIFEST_SUFFIX = '.manifest.json'
+
+## Fixed part of a zip local file header, followed by the file name and extra field
+ZIP_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+ZIP_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+
+## Path of a video's manifest next to its zip, eg. apple/001.zip -> apple/001.manifest.json
+def manifest_path(zip_path: str) -> str:
+    return str(zip_path)[:-len('.zip')] + MANIFEST_SUFFIX if str(zip_path).endswith('.zip') else str(zip_path) + MANIFEST_SUFFIX
+
+## Merkle root over (name, sha256) pairs, sorted by name
+## Leaves and inner nodes are domain separated, an odd node is carried up to the next level as is
+def merkle_root(file_hashes: Dict[str, str]) -> str:
+    level = [hashlib.sha256(b'\x00' + name.encode('utf-8') + b'\x00' + bytes.fromhex(digest)).digest()
+             for name, digest in sorted(file_hashes.items())]
+    if not level:
+        return hashlib.sha256(b'').hexdigest()
+    while len(level) > 1:
+        next_level = [hashlib.sha256(b'\x01' + level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2 == 1:
+            next_level.append(level[-1])
+        level = next_level
+    return level[0].hex()
+
+## Builds the manifest of a written zip - file_hashes (name -> sha256) can be passed in if they were
+## computed while the zip was written, otherwise every member is read back and hashed
+def zip_manifest(data_zip: zipfile.ZipFile, file_hashes: Optional[Dict[str, str]]=None) -> dict:
+    files = []
+    hashes = {}
+    for z_info in data_zip.infolist():
+        if file_hashes is not None:
+            digest = file_hashes[z_info.filename]
+        else:
+            member_hash = hashlib.sha256()
+            with data_zip.open(z_info, 'r') as f:
+                for chunk in iter(lambda: f.read(1048576), b""):
+                    member_hash.update(chunk)
+            digest = member_hash.hexdigest()
+        hashes[z_info.filename] = digest
+        files.append({
+            'name': z_info.filename,
+            'size': z_info.file_size,
+            'sha256': digest,
+            'header_offset': z_info.header_offset,
+            'compress_size': z_info.compress_size,
+            'compress_type': z_info.compress_type,
+        })
+    return {'merkle_root': merkle_root(hashes), 'files': files}
+
+def write_manifest(path: Path, manifest: dict) -> None:
+    tmp_path = str(path) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+def load_manifest(path: Path) -> dict:
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def _hash_file(path: str) -> Tuple[int, str]:
+    file_hash = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b""):
+            file_hash.update(chunk)
+            size += len(chunk)
+    return (size, file_hash.hexdigest())
+
+## Hashes every file in a video folder on a thread pool (hashlib releases the GIL on large buffers)
+## Returns name -> (size, sha256)
+def hash_files(directory: Path, threads: int=4) -> Dict[str, Tuple[int, str]]:
+    paths = {}
+    for root, dirs, files in os.walk(directory, topdown=True, followlinks=False):
+        for name in files:
+            paths[name] = os.path.join(root, name)
+    names = sorted(paths)
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        return dict(zip(names, executor.map(_hash_file, [paths[n] for n in names])))
+
+## Names of the manifest members that are missing or don't match the hashed files
+def corrupt_members(manifest: dict, file_hashes: Dict[str, Tuple[int, str]]) -> List[str]:
+    corrupt = []
+    for member in manifest['files']:
+        found = file_hashes.get(member['name'])
+        if found is None or found[0] != member['size'] or found[1] != member['sha256']:
+            corrupt.append(member['name'])
+    return corrupt
+
+## Byte range of a member's data in the zip, given its local file header
+## (the local extra field can differ from the central directory's, so it has to be read from the header)
+def member_data_range(member: dict, local_header: bytes) -> Tuple[int, int]:
+    fields = ZIP_LOCAL_HEADER.unpack(local_header[:ZIP_LOCAL_HEADER.size])
+    if fields[0] != ZIP_LOCAL_HEADER_SIGNATURE:
+        raise ValueError(f'bad zip local header for {member["name"]}')
+    name_length, extra_length = fields[-2], fields[-1]
+    start = member['header_offset'] + ZIP_LOCAL_HEADER.size + name_length + extra_length
+    return (start, start + member['compress_size'])
+
+## Decompresses a member's raw zip data and checks it against the manifest
+def decode_member(member: dict, data: bytes) -> bytes:
+    if member['compress_type'] == zipfile.ZIP_STORED:
+        content = data
+    elif member['compress_type'] == zipfile.ZIP_DEFLATED:
+        content = zlib.decompressobj(-15).decompress(data)
+    else:
+        raise ValueError(f'unsupported compression type {member["compress_type"]} for {member["name"]}')
+    if len(content) != member['size'] or hashlib.sha256(content).hexdigest() != member['sha256']:
+        raise ValueError(f'{member["name"]} does not match its manifest entry')
+    return content
@@ -1,5 +1,5 @@
 import dataclasses
-from typing import List, MutableSet, Dict
+from typing import List, MutableSet, Dict, Optional
 import datetime
 from dacite import from_dict
 import json
@@ -24,6 +24,8 @@ class AnnotatedVideo:
     test_split: bool
     occlusion_levels: OcclusionLevels
     tags: List[str]=dataclasses.field(default_factory=list)
+    zip_sha256: Optional[str]=None  #sha256 of the zip file itself, checked while downloading
+    merkle_root: Optional[str]=None  #Merkle root of the per-file hashes in <id>.manifest.json
     
 ## Object metadata class that holds a list of videos
 @dataclasses.dataclass
@@ -46,4 +48,13 @@ class HootDataset:
 def load_from_json(metadata_dict: dict) -> HootDataset:
     metadata_dict['date_created'] = datetime.datetime.strptime(metadata_dict['date_created'], '%Y-%m-%d').date()
     metadata = from_dict(data_class=HootDataset, data=metadata_dict)
-    return metadata
\ No newline at end of file
+    return metadata
+## Function to write metadata.json - eg. next to a local install, to know what it was downloaded from
+def save_to_json(metadata: HootDataset, path) -> None:
+    with open(path, 'w') as f:
+        json.dump(dataclasses.asdict(metadata), fp=f, default=str, indent=2)
+
+## Function to load a metadata.json file from disk
+def load_from_file(path) -> HootDataset:
+    with open(path, 'r') as f:
+        return load_from_json(json.load(f))
@@ -0,0 +1,139 @@
+## Timing and throughput instrumentation for the CLI commands
+## Code is wrapped in spans (eg. 'download', 'hash_folder', 'zip_write', 'anno_parse', 'extract') which record
+## their duration, bytes processed and any extra attributes as one json line per span
+## Disabled by default - span() then returns a shared no-op object so the overhead is a single check
+##
+## Worker processes inherit the trace file through the HOOT_METRICS_OUT environment variable and append
+## to it directly, so spans from multiprocessing pools end up in the same trace
+
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+METRICS_ENV = 'HOOT_METRICS_OUT'
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+## Appends spans to a jsonl trace file - each span is written with a single O_APPEND write,
+## so lines from different threads and processes don't interleave
+class MetricsRecorder:
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _file(self) -> int:
+        ## Re-open after a fork so each process has its own descriptor
+        if self._fd is None or self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+        return self._fd
+
+    def write(self, entry: dict):
+        line = (json.dumps(entry, default=str) + '\n').encode('utf-8')
+        with self._lock:
+            os.write(self._file(), line)
+
+class Span:
+    def __init__(self, recorder: MetricsRecorder, name: str, attrs: dict):
+        self.recorder = recorder
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self._start
+        self.recorder.write({'name': self.name, 'start': self.start, 'seconds': seconds, 'pid': os.getpid(),
+                             'thread': threading.get_ident(), 'error': exc_type is not None, **self.attrs})
+        return False
+
+    ## Adds attributes known only once the work is done, eg. span.set(bytes=n)
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+_recorder: Optional[MetricsRecorder] = None
+if os.environ.get(METRICS_ENV):
+    _recorder = MetricsRecorder(os.environ[METRICS_ENV])
+
+## Starts recording spans to path (truncates it), also for any worker processes started afterwards
+def enable_metrics(path: str) -> None:
+    global _recorder
+    open(path, 'w').close()
+    os.environ[METRICS_ENV] = path
+    _recorder = MetricsRecorder(path)
+
+def disable_metrics() -> None:
+    global _recorder
+    os.environ.pop(METRICS_ENV, None)
+    _recorder = None
+
+def metrics_enabled() -> bool:
+    return _recorder is not None
+
+## Context manager that times a block of code, eg.
+##   with span('hash_folder', video=str(directory)) as s:
+##       ...
+##       s.set(bytes=data_size)
+def span(name: str, **attrs):
+    if _recorder is None:
+        return _NULL_SPAN
+    return Span(_recorder, name, attrs)
+
+## Records an already measured duration, eg. the time a job waited in a queue
+def record(name: str, seconds: float, **attrs) -> None:
+    if _recorder is None:
+        return
+    _recorder.write({'name': name, 'start': time.time() - seconds, 'seconds': seconds, 'pid': os.getpid(),
+                     'thread': threading.get_ident(), **attrs})
+
+## Aggregates a trace file per span name: count, total/mean/p95 time, bytes and MB/s
+def summarize(path: str) -> Dict[str, dict]:
+    spans: Dict[str, List[dict]] = defaultdict(list)
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                spans[entry['name']].append(entry)
+
+    summary = {}
+    for name, entries in spans.items():
+        seconds = sorted(e['seconds'] for e in entries)
+        total_bytes = sum(e.get('bytes', 0) for e in entries)
+        total_seconds = sum(seconds)
+        summary[name] = {
+            'count': len(entries),
+            'total_s': total_seconds,
+            'mean_ms': 1000 * total_seconds / len(entries),
+            'p95_ms': 1000 * seconds[min(len(seconds) - 1, int(0.95 * len(seconds)))],
+            'bytes': total_bytes,
+            'mb_per_s': total_bytes / (1024 * 1024) / total_seconds if total_bytes and total_seconds > 0 else None,
+        }
+    return summary
+
+## Prints the per-span summary table of a trace file
+def print_summary(path: str) -> None:
+    summary = summarize(path)
+    if not summary:
+        return
+    print(f'{"span":<22} {"count":>7} {"total s":>9} {"mean ms":>9} {"p95 ms":>9} {"MB/s":>9}')
+    for name, s in sorted(summary.items(), key=lambda kv: -kv[1]['total_s']):
+        mb_per_s = f'{s["mb_per_s"]:.1f}' if s['mb_per_s'] is not None else '-'
+        print(f'{name:<22} {s["count"]:>7} {s["total_s"]:>9.3f} {s["mean_ms"]:>9.2f} {s["p95_ms"]:>9.2f} {mb_per_s:>9}')
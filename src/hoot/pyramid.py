@@ -0,0 +1,166 @@
+## Multi-resolution pyramids for HOOT videos
+## Writes 1/2, 1/4 and 1/8 resolution copies of each video - frames plus anno.json/meta.info with rot_bb, aa_bb
+## and occluder masks rescaled to match - so previews and low-res pipelines never decode full resolution frames
+##
+## Each level is a complete HOOT video folder at <hoot>/.hoot.pyramid/<class>/<video>/1_<factor>/, outside the
+## video folders themselves so verify/repair and make-archive never see it. Load one with
+## load_video_from_file(videopath, scale=0.25)
+
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import List, NamedTuple, Optional
+import cv2
+import numpy as np
+from pycocotools import mask
+
+from hoot.utils import pool_map, folder_fingerprint
+from hoot import metrics
+
+PYRAMID_DIR = '.hoot.pyramid'
+PYRAMID_SCALES = [0.5, 0.25, 0.125]
+PYRAMID_RECORD = 'pyramid.json'
+
+## Name of a level's folder, eg. '1_4' for scale 0.25
+def level_name(scale: float) -> str:
+    assert scale in PYRAMID_SCALES, f'scale must be one of {PYRAMID_SCALES}'
+    return f'1_{round(1 / scale)}'
+
+## Folder holding all pyramid levels of a video folder (<hoot>/<class>/<video>)
+def pyramid_video_path(videopath: Path) -> Path:
+    videopath = Path(videopath)
+    return videopath.parent.parent.joinpath(PYRAMID_DIR, videopath.parent.name, videopath.name)
+
+## Video folder of a pyramid level, the video folder itself for scale 1
+def pyramid_level_path(videopath: Path, scale: float) -> Path:
+    if scale == 1:
+        return Path(videopath)
+    return pyramid_video_path(videopath).joinpath(level_name(scale))
+
+## Size (width, height) of a pyramid level
+def level_size(width: int, height: int, scale: float) -> tuple:
+    return (max(int(width * scale), 1), max(int(height * scale), 1))
+
+## Scales the points of a rot_bb/aa_bb polygon, unannotated boxes stay empty
+def rescale_polygon(polygon: List[List[float]], sx: float, sy: float) -> List[List[float]]:
+    return [[round(pt[0] * sx, 3), round(pt[1] * sy, 3)] for pt in polygon]
+
+## Resizes an anno.json mask ({'size': [h, w], 'counts': hex}) to width x height
+## Nearest neighbour, the same as iter_frames does when it resizes masks on the fly
+def rescale_mask(mask_data: dict, width: int, height: int) -> dict:
+    mask_mat = mask.decode({'size': mask_data['size'], 'counts': bytes.fromhex(mask_data['counts'])})
+    mask_mat = cv2.resize(mask_mat, (width, height), interpolation=cv2.INTER_NEAREST)
+    rle = mask.encode(np.asfortranarray(mask_mat))
+    return {'size': [int(s) for s in rle['size']], 'counts': rle['counts'].hex()}
+
+## anno.json content of a pyramid level - occlusion levels and attributes don't depend on resolution
+def rescale_annotations(anno_data: dict, source_width: int, source_height: int, width: int, height: int) -> dict:
+    sx = width / source_width
+    sy = height / source_height
+    frames = []
+    for f in anno_data['frames']:
+        frames.append({
+            **f,
+            'rot_bb': rescale_polygon(f['rot_bb'], sx, sy),
+            'aa_bb': rescale_polygon(f['aa_bb'], sx, sy),
+            'occ_masks': {occ_type: rescale_mask(m, width, height) if isinstance(m, dict) else m
+                          for occ_type, m in f['occ_masks'].items()},
+        })
+    return {**anno_data, 'frames': frames}
+
+class PyramidArgs(NamedTuple):
+    video_dir: str
+    scales: List[float]
+
+def _read_record(path: Path) -> dict:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def build_pyramid_job(args: PyramidArgs) -> str:
+    '''Writes the requested pyramid levels of a video - used in a multiprocessing pool
+        Levels already built from the same source files are skipped
+        Each level is built in a .tmp folder and moved into place, and pyramid.json (the source fingerprint and
+        finished levels) is written last, so an interrupted build is redone on the next run
+    '''
+    assert isinstance(args, PyramidArgs)
+    video_dir = Path(args.video_dir)
+    pyramid_dir = pyramid_video_path(video_dir)
+    record_path = pyramid_dir.joinpath(PYRAMID_RECORD)
+    fingerprint = folder_fingerprint(video_dir)
+
+    record = _read_record(record_path)
+    if record.get('source_fingerprint') != fingerprint:
+        record = {'source_fingerprint': fingerprint, 'levels': []}
+        if pyramid_dir.exists():
+            shutil.rmtree(pyramid_dir)
+    missing = [s for s in sorted(args.scales, reverse=True) if level_name(s) not in record['levels']]
+    if not missing:
+        return 'cached'
+
+    with open(video_dir.joinpath('anno.json'), 'r') as f:
+        anno_data = json.load(f)
+    with open(video_dir.joinpath('meta.info'), 'r') as f:
+        meta_data = json.load(f)
+    source_width, source_height = int(meta_data['width']), int(meta_data['height'])
+
+    ## Folders the levels are written to, with their anno.json/meta.info
+    tmp_dirs = {}
+    for scale in missing:
+        width, height = level_size(source_width, source_height, scale)
+        tmp_dir = pyramid_dir.joinpath(level_name(scale) + '.tmp')
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)
+        tmp_dir.mkdir(parents=True)
+        with open(tmp_dir.joinpath('anno.json'), 'w') as f:
+            json.dump(rescale_annotations(anno_data, source_width, source_height, width, height), f)
+        with open(tmp_dir.joinpath('meta.info'), 'w') as f:
+            json.dump({**meta_data, 'width': width, 'height': height}, f)
+        tmp_dirs[scale] = tmp_dir
+
+    ## Each level is downscaled from the one above it (not from full resolution), which is what makes a pyramid cheap
+    chain = [s for s in PYRAMID_SCALES if s >= min(missing)]
+    with metrics.span('build_pyramid', video=str(video_dir)) as pyramid_span:
+        num_frames = 0
+        for f in anno_data['frames']:
+            frame_name = f'{int(f["frame_id"]):06}.png'
+            img = cv2.imread(str(video_dir.joinpath(frame_name)), cv2.IMREAD_COLOR)
+            if img is None:
+                raise FileNotFoundError(video_dir.joinpath(frame_name))
+            for scale in chain:
+                img = cv2.resize(img, level_size(source_width, source_height, scale), interpolation=cv2.INTER_AREA)
+                if scale in tmp_dirs:
+                    cv2.imwrite(str(tmp_dirs[scale].joinpath(frame_name)), img)
+            num_frames += 1
+        pyramid_span.set(frames=num_frames, levels=len(missing))
+
+    for scale, tmp_dir in tmp_dirs.items():
+        level_dir = pyramid_dir.joinpath(level_name(scale))
+        if level_dir.exists():
+            shutil.rmtree(level_dir)
+        os.replace(tmp_dir, level_dir)
+        record['levels'].append(level_name(scale))
+    with open(record_path, 'w') as f:
+        json.dump(record, f)
+    return 'built'
+
+## Builds pyramid levels (all of PYRAMID_SCALES if scales is None) for every video in a HOOT directory
+## Videos are processed on a process pool with 'threads' workers (cpu count if None)
+def build_pyramids(directory: str, scales: Optional[List[float]]=None, threads: Optional[int]=None) -> None:
+    datapath = Path(directory)
+    scales = list(scales) if scales else PYRAMID_SCALES
+    assert all(s in PYRAMID_SCALES for s in scales), f'scales must be in {PYRAMID_SCALES}'
+
+    jobs = []
+    for class_dir in sorted(datapath.iterdir()):
+        if not class_dir.is_dir() or class_dir.name.startswith('.'):
+            continue
+        for video_dir in sorted(class_dir.iterdir()):
+            if video_dir.is_dir() and video_dir.joinpath('anno.json').exists():
+                jobs.append(PyramidArgs(str(video_dir), scales))
+
+    results = pool_map(build_pyramid_job, jobs, threads, desc='building pyramids')
+    print(f'Built pyramids for {results.count("built")} videos ({results.count("cached")} already up to date)')
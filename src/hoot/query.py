@@ -0,0 +1,209 @@
+## Small query language for selecting videos from metadata.json
+## Used by 'hoot download/verify --where' to filter videos before any bytes are transferred
+##
+## eg. "tags contains semi_transparent and occlusion_levels.frame_occlusion_level > 0.5 and test_split"
+##
+## expr       := term ('or' term)*
+## term       := factor ('and' factor)*
+## factor     := 'not' factor | '(' expr ')' | comparison
+## comparison := field [op value] | field 'in' list     (a bare field is tested for truthiness)
+## op         := == != > >= < <= contains
+## list       := '(' value (',' value)* ')' | '[' value (',' value)* ']'
+## field      := dotted AnnotatedVideo attribute (eg. occlusion_levels.mean_target_occlusion_level) or 'class'
+## value      := number, true/false, 'quoted string' or bare word
+##
+## Values are converted to the field's type when the query is compiled (so id == 001 compares with '001'), and
+## operators that don't apply to the field's type (eg. tags > 5) are rejected there. 'in' takes a list
+## (class in (apple, toy_car)) - a bare string would be a substring test, so it's rejected
+
+import re
+import operator
+import dataclasses
+import typing
+from typing import Any, Callable, List, Optional, Tuple
+
+from hoot.metadata import AnnotatedVideo
+
+token_regex = re.compile(r'''\s*(?:(?P<op>==|!=|>=|<=|>|<)|(?P<paren>[()\[\]])|(?P<comma>,)|(?P<str>'[^']*'|"[^"]*")|(?P<word>[^\s()\[\],=!<>'"]+))''')
+
+OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    'contains': lambda a, b: b in a,
+    'in': lambda a, b: a in b,
+}
+
+VideoQuery = Callable[[AnnotatedVideo, str], bool]
+
+def _tokenize(text: str) -> List[Tuple[str, str]]:
+    tokens = []
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        match = token_regex.match(text, pos)
+        if match is None or match.end() == pos:
+            raise ValueError(f'invalid query near: {text[pos:]!r}')
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'word' and value in ('and', 'or', 'not', 'contains', 'in'):
+            kind = 'op' if value in ('contains', 'in') else value
+        tokens.append((kind, value))
+        pos = match.end()
+    return tokens
+
+## Operators each field type supports - list fields (tags) only support contains
+TYPE_OPERATORS = {
+    str: ['==', '!=', '>', '>=', '<', '<=', 'contains', 'in'],
+    int: ['==', '!=', '>', '>=', '<', '<=', 'in'],
+    float: ['==', '!=', '>', '>=', '<', '<=', 'in'],
+    bool: ['==', '!='],
+    list: ['contains'],
+}
+
+## Type of a dotted field as (type, element type) eg. (int, None) for download_size, (list, str) for tags
+## Optional fields get the type they hold
+def _field_type(field: str) -> Tuple[type, Optional[type]]:
+    if field == 'class':
+        return (str, None)
+    field_type = AnnotatedVideo
+    for attr in field.split('.'):
+        if not dataclasses.is_dataclass(field_type) or attr not in typing.get_type_hints(field_type):
+            raise ValueError(f'unknown metadata field: {field}')
+        field_type = typing.get_type_hints(field_type)[attr]
+        args = [a for a in typing.get_args(field_type) if a is not type(None)]
+        if typing.get_origin(field_type) is typing.Union:
+            field_type = args[0]
+    if typing.get_origin(field_type) is list:
+        return (list, typing.get_args(field_type)[0])
+    return (field_type, None)
+
+## Converts a query literal to the given type, raises ValueError if it can't be
+def _parse_value(kind: str, value: str, value_type: type, field: str) -> Any:
+    if kind == 'str':
+        value = value[1:-1]
+    if value_type is str:
+        return value
+    if value_type is bool and value in ('true', 'True', 'false', 'False'):
+        return value in ('true', 'True')
+    if kind != 'str' and value_type in (int, float):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    raise ValueError(f'invalid query: {field} is {value_type.__name__}, {value!r} is not')
+
+def _get_field(video: AnnotatedVideo, class_name: str, field: str) -> Any:
+    if field == 'class':
+        return class_name
+    value = video
+    for attr in field.split('.'):
+        if not hasattr(value, attr):
+            raise ValueError(f'unknown metadata field: {field}')
+        value = getattr(value, attr)
+    return value
+
+class _Parser:
+    def __init__(self, tokens: List[Tuple[str, str]]):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self) -> Optional[Tuple[str, str]]:
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self, kind: Optional[str]=None) -> Tuple[str, str]:
+        token = self.peek()
+        if token is None or (kind is not None and token[0] != kind):
+            raise ValueError(f'invalid query: expected {kind or "a value"}, got {token[1] if token else "end of query"}')
+        self.pos += 1
+        return token
+
+    def expr(self) -> VideoQuery:
+        terms = [self.term()]
+        while self.peek() and self.peek()[0] == 'or':
+            self.take('or')
+            terms.append(self.term())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda v, c: any(t(v, c) for t in terms)
+
+    def term(self) -> VideoQuery:
+        factors = [self.factor()]
+        while self.peek() and self.peek()[0] == 'and':
+            self.take('and')
+            factors.append(self.factor())
+        if len(factors) == 1:
+            return factors[0]
+        return lambda v, c: all(f(v, c) for f in factors)
+
+    def factor(self) -> VideoQuery:
+        token = self.peek()
+        if token and token[0] == 'not':
+            self.take('not')
+            inner = self.factor()
+            return lambda v, c: not inner(v, c)
+        if token and token[1] == '(':
+            self.take('paren')
+            inner = self.expr()
+            if self.take('paren')[1] != ')':
+                raise ValueError('invalid query: expected )')
+            return inner
+        return self.comparison()
+
+    ## Literal list after 'in', as a tuple of values of the field's type
+    def value_list(self, value_type: type, field: str) -> tuple:
+        token = self.peek()
+        if token is None or token[1] not in ('(', '['):
+            raise ValueError(f'invalid query: in takes a list, eg. {field} in (a, b) - got {token[1] if token else "end of query"}')
+        closing = ')' if self.take('paren')[1] == '(' else ']'
+        values = []
+        while True:
+            kind, value = self.take()
+            if kind not in ('word', 'str'):
+                raise ValueError(f'invalid query: expected a value, got {value}')
+            values.append(_parse_value(kind, value, value_type, field))
+            if self.peek() and self.peek()[0] == 'comma':
+                self.take('comma')
+                continue
+            if self.take('paren')[1] != closing:
+                raise ValueError(f'invalid query: expected {closing}')
+            return tuple(values)
+
+    def comparison(self) -> VideoQuery:
+        field = self.take('word')[1]
+        ## Validate the field name and type against the metadata schema up front
+        field_type, element_type = _field_type(field)
+        token = self.peek()
+        if token is None or token[0] != 'op':
+            return lambda v, c: bool(_get_field(v, c, field))
+        op_name = self.take('op')[1]
+        if op_name not in TYPE_OPERATORS.get(field_type, []):
+            raise ValueError(f'invalid query: {op_name} doesn\'t apply to {field} ({field_type.__name__})')
+        op = OPERATORS[op_name]
+        if op_name == 'in':
+            value = self.value_list(field_type, field)
+            return lambda v, c: (lambda x: x is not None and op(x, value))(_get_field(v, c, field))
+        kind, value = self.take()
+        if kind not in ('word', 'str'):
+            raise ValueError(f'invalid query: expected a value, got {value}')
+        value = _parse_value(kind, value, element_type if field_type is list else field_type, field)
+        if op_name in ('==', '!='):
+            return lambda v, c: op(_get_field(v, c, field), value)
+        ## Unset optional fields (eg. zip_sha256) never match an ordering or containment test
+        return lambda v, c: (lambda x: x is not None and op(x, value))(_get_field(v, c, field))
+
+## Compiles a query string into a function (video, class_name) -> bool
+## Raises ValueError for malformed queries or unknown fields
+def compile_query(text: str) -> VideoQuery:
+    parser = _Parser(_tokenize(text))
+    query = parser.expr()
+    if parser.peek() is not None:
+        raise ValueError(f'invalid query near: {parser.peek()[1]}')
+    return query
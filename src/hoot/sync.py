@@ -0,0 +1,152 @@
+## Incremental updates of a local HOOT install to a new release
+## Local and remote metadata.json are compared video by video (sha256 and install size), so only added or
+## changed videos are downloaded - videos removed from the release are deleted or moved to a quarantine folder
+## The local metadata.json is the whole release an install was made from, next to the set of videos installed from
+## it (see save_local_metadata) - videos a subset install skipped are neither downloaded nor counted as unchanged
+
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Tuple
+
+from hoot.downloader import version_downloader, extract_archive, local_metadata_name, load_local_metadata, save_local_metadata
+from hoot.metadata import HootDataset, AnnotatedVideo, load_from_file
+from hoot.query import compile_query
+from hoot.pyramid import pyramid_video_path
+
+QUARANTINE_NAME = '.hoot.quarantine'
+## Downloads are staged here until every one has succeeded, so a failed sync leaves the install untouched
+STAGING_NAME = '.hoot.sync'
+REMOVED_ACTIONS = ['quarantine', 'delete', 'keep']
+
+class MetadataDiff(NamedTuple):
+    added: List[Tuple[str, AnnotatedVideo]]
+    changed: List[Tuple[str, AnnotatedVideo, AnnotatedVideo]]  #(class, old, new)
+    removed: List[Tuple[str, AnnotatedVideo]]
+    unchanged: List[Tuple[str, AnnotatedVideo]]
+
+## Compares two releases video by video, keyed on class and video id
+## A video changed if its sha256 or install size differs
+def diff_metadata(old: HootDataset, new: HootDataset) -> MetadataDiff:
+    old_videos = {(c.name, v.id): v for c in old.classes for v in c.videos}
+    new_videos = {(c.name, v.id): v for c in new.classes for v in c.videos}
+    diff = MetadataDiff([], [], [], [])
+    for (class_name, video_id), v in new_videos.items():
+        old_v = old_videos.get((class_name, video_id))
+        if old_v is None:
+            diff.added.append((class_name, v))
+        elif old_v.sha256 != v.sha256 or old_v.install_size != v.install_size:
+            diff.changed.append((class_name, old_v, v))
+        else:
+            diff.unchanged.append((class_name, v))
+    diff.removed.extend((class_name, v) for (class_name, video_id), v in old_videos.items() if (class_name, video_id) not in new_videos)
+    return diff
+
+## Prints the per-video changes (if verbose) and the bytes to download compared to a full download
+def print_diff(diff: MetadataDiff, verbose: bool=False) -> None:
+    if verbose:
+        for class_name, v in diff.added:
+            print(f'+ {class_name}/{v.id}')
+        for class_name, _, v in diff.changed:
+            print(f'~ {class_name}/{v.id}')
+        for class_name, v in diff.removed:
+            print(f'- {class_name}/{v.id}')
+    download_size = sum(v.download_size for _, v in diff.added) + sum(v.download_size for _, _, v in diff.changed)
+    full_size = download_size + sum(v.download_size for _, v in diff.unchanged)
+    saved = full_size - download_size
+    print(f'{len(diff.added)} added, {len(diff.changed)} changed, {len(diff.removed)} removed, {len(diff.unchanged)} unchanged')
+    print(f'{download_size} bytes to download instead of {full_size} ({saved} bytes saved'
+          + (f', {100 * saved / full_size:.1f}%)' if full_size else ')'))
+
+## Diff between two metadata.json files on disk, no network needed
+def diff_metadata_files(old_path: str, new_path: str) -> MetadataDiff:
+    return diff_metadata(load_from_file(old_path), load_from_file(new_path))
+
+## Moves (quarantine) or deletes a video's folder and zip from a local install
+## Its pyramid levels are always deleted, they can be rebuilt with hoot build-pyramid
+def _retire_video(dest: Path, class_name: str, v: AnnotatedVideo, action: str, stamp: str) -> None:
+    if action == 'keep':
+        return
+    pyramid_path = pyramid_video_path(dest.joinpath(class_name, v.id))
+    if pyramid_path.exists():
+        shutil.rmtree(pyramid_path)
+    for path in [dest.joinpath(class_name, v.id), dest.joinpath(v.path)]:
+        if not path.exists():
+            continue
+        if action == 'delete':
+            shutil.rmtree(path) if path.is_dir() else path.unlink()
+        else:
+            target = dest.joinpath(QUARANTINE_NAME, stamp, class_name, path.name)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(str(path), str(target))
+
+## Updates a local install in destination to the latest release of version
+## Only videos that were added, or that changed and are installed locally, are downloaded
+## Old copies of changed videos and videos dropped from the release are handled by removed: quarantine (moved to
+## destination/.hoot.quarantine/<timestamp>/), delete or keep
+## where (if given) is a metadata query (see hoot/query.py) that limits which added videos are downloaded
+## dry_run only prints the diff
+## Added and changed videos are downloaded (and extracted) into destination/.hoot.sync/ first - old copies are only
+## retired and replaced once every download succeeded, so a failed sync can simply be run again (partial downloads resume)
+def sync_archives(destination: str, version: str, jobs: int=4, extract: bool=True, removed: str='quarantine',
+                  where: Optional[str]=None, dry_run: bool=False, verbose: bool=False) -> MetadataDiff:
+    assert removed in REMOVED_ACTIONS
+    query = compile_query(where) if where else None
+    dest = Path(destination)
+    local_metadata_path = dest.joinpath(local_metadata_name)
+
+    dl = version_downloader(version, jobs)
+    remote = dl.load_metadata()
+    local, installed = load_local_metadata(dest)
+    if local is None:
+        print(f'No {local_metadata_path} found - every video counts as added')
+        local = HootDataset(version='', change_log='')
+
+    diff = diff_metadata(local, remote)
+    ## Only videos new in the release are added - changed, removed and unchanged videos only count if they're
+    ## installed, so a subset install stays a subset
+    diff = MetadataDiff(
+        added=[(c, v) for c, v in diff.added if query is None or query(v, c)],
+        changed=[(c, old, new) for c, old, new in diff.changed if (c, old.id) in installed],
+        removed=[(c, v) for c, v in diff.removed if (c, v.id) in installed],
+        unchanged=[(c, v) for c, v in diff.unchanged if (c, v.id) in installed],
+    )
+    print_diff(diff, verbose)
+    if dry_run:
+        return diff
+
+    ## Each video is staged in a folder named after its zip hash, so a zip staged for another release is never reused
+    staging = dest.joinpath(STAGING_NAME)
+    updates = [(c, None, v) for c, v in diff.added] + diff.changed
+    stage_dir = lambda class_name, v: staging.joinpath(class_name, v.zip_sha256 or v.sha256)
+    to_download = [(stage_dir(c, v), v) for c, _, v in updates]
+    for stage, _ in to_download:
+        stage.mkdir(parents=True, exist_ok=True)
+    dest.mkdir(exist_ok=True)
+    dl.download_additional_files(remote.additional_files, dest)
+    if to_download:
+        dl.download_videos(to_download, jobs)
+    if extract:
+        for stage, v in to_download:
+            extract_archive(stage.joinpath(Path(v.path).name), stage.joinpath(v.id), remove_archive=True)
+
+    ## Everything is downloaded - swap the new copies in
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    for class_name, v in diff.removed:
+        _retire_video(dest, class_name, v, removed, stamp)
+    for class_name, old_v, v in updates:
+        if old_v is not None:
+            _retire_video(dest, class_name, old_v, 'delete' if removed == 'keep' else removed, stamp)
+        dest.joinpath(class_name).mkdir(exist_ok=True)
+        staged = stage_dir(class_name, v).joinpath(v.id if extract else Path(v.path).name)
+        target = dest.joinpath(class_name, v.id) if extract else dest.joinpath(v.path)
+        if target.exists():
+            shutil.rmtree(target) if target.is_dir() else target.unlink()
+        os.replace(staged, target)
+    if staging.exists():
+        shutil.rmtree(staging)
+
+    save_local_metadata(remote, dest, {(class_name, v.id) for class_name, v in diff.unchanged}
+                        | {(class_name, v.id) for class_name, _, v in updates})
+    return diff
@@ -0,0 +1,130 @@
+## Synthetic HOOT dataset generator
+## Writes a HOOT-format folder (class/video dirs with PNG frames, anno.json, meta.info, test.txt, train.txt)
+## with moving target boxes and RLE occluder masks, so the toolkit can be tested and benchmarked offline
+
+import json
+from pathlib import Path
+from typing import List
+import cv2
+import numpy as np
+from pycocotools import mask
+
+from hoot.anno import MotionTags, TargetTags
+
+SYNTHETIC_CLASSES = ["apple", "toy_car", "paper_bag", "cat", "mug", "umbrella", "keyboard", "book"]
+
+## Encodes a binary mask as it's stored in anno.json (COCO RLE with hex counts)
+def encode_mask(mask_mat: np.ndarray) -> dict:
+    rle = mask.encode(np.asfortranarray(mask_mat.astype(np.uint8)))
+    return {"size": [int(s) for s in rle["size"]], "counts": rle["counts"].hex()}
+
+## Generates a single synthetic video folder, returns the video key
+def generate_video(video_dir: Path, class_name: str, video_id: str, num_frames: int, width: int, height: int,
+                   rng: np.random.Generator) -> str:
+    video_dir.mkdir(parents=True, exist_ok=True)
+
+    ## Smooth background with some noise so the PNGs compress like real footage
+    xs = np.linspace(0, 255, width, dtype=np.float32)
+    ys = np.linspace(0, 255, height, dtype=np.float32)
+    background = np.stack([np.add.outer(ys, xs) / 2, np.add.outer(ys, 255 - xs) / 2, np.tile(xs, (height, 1))], axis=-1)
+
+    ## Target moves along a straight line and rotates slowly, occluders sweep across it
+    box_w, box_h = width * rng.uniform(0.15, 0.3), height * rng.uniform(0.15, 0.3)
+    start = np.array([rng.uniform(box_w, width - box_w), rng.uniform(box_h, height - box_h)])
+    velocity = rng.uniform(-1, 1, 2) * min(width, height) / (4 * num_frames)
+    angle_speed = rng.uniform(-0.5, 0.5) / num_frames
+    occ_types = [t for t in ["s", "sp", "st", "t"] if rng.random() < 0.6] or ["s"]
+    occluders = {t: (rng.uniform(0, width), rng.uniform(0.1, 0.3) * width, rng.uniform(-2, 2) * width / num_frames) for t in occ_types}
+
+    frames = []
+    occluded_fractions = []
+    for frame_id in range(1, num_frames + 1):
+        center = start + velocity * frame_id
+        angle = angle_speed * frame_id
+        corners = np.array([[-box_w, -box_h], [box_w, -box_h], [box_w, box_h], [-box_w, box_h]]) / 2
+        rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+        rot_bb = corners @ rotation.T + center
+        mins, maxs = rot_bb.min(axis=0), rot_bb.max(axis=0)
+        aa_bb = np.array([[mins[0], mins[1]], [maxs[0], mins[1]], [maxs[0], maxs[1]], [mins[0], maxs[1]]])
+
+        image = background + rng.normal(0, 6, background.shape).astype(np.float32)
+        cv2.fillPoly(image, [rot_bb.astype(np.int32)], (40, 180, 60))
+
+        ## Vertical occluder bands (sparse ones are striped) moving horizontally
+        target_mask = np.zeros((height, width), dtype=np.uint8)
+        cv2.fillPoly(target_mask, [rot_bb.astype(np.int32)], 1)
+        occ_masks = {"all": [], "s": [], "sp": [], "st": [], "t": []}
+        all_mask = np.zeros((height, width), dtype=np.uint8)
+        for occ_type, (x0, band_w, speed) in occluders.items():
+            x = int((x0 + speed * frame_id) % width)
+            layer = np.zeros((height, width), dtype=np.uint8)
+            layer[:, x:x + int(band_w)] = 1
+            if occ_type == "sp":
+                layer[::8] = 0
+            if (layer & target_mask).any():
+                occ_masks[occ_type] = encode_mask(layer)
+                all_mask |= layer
+                image[layer.astype(bool)] = image[layer.astype(bool)] * 0.5 + 60
+        if all_mask.any():
+            occ_masks["all"] = encode_mask(all_mask)
+
+        target_area = max(int(target_mask.sum()), 1)
+        occluded_fraction = float((all_mask & target_mask).sum()) / target_area
+        occluded_fractions.append(occluded_fraction)
+        cv2.imwrite(str(video_dir.joinpath(f'{frame_id:06}.png')), np.clip(image, 0, 255).astype(np.uint8))
+
+        frames.append({
+            "frame_id": frame_id,
+            "rot_bb": rot_bb.round(2).tolist(),
+            "aa_bb": aa_bb.round(2).tolist(),
+            "occ_masks": occ_masks,
+            "attributes": {
+                "absent": False,
+                "full_occlusion": occluded_fraction > 0.99,
+                "similar_occluder": False,
+                "cut_by_frame": bool((mins < 0).any() or maxs[0] > width or maxs[1] > height),
+                "partial_obj_occlusion": 0 < occluded_fraction <= 0.99,
+            }
+        })
+
+    video_key = f'{class_name}-{video_id}'
+    with open(video_dir.joinpath('anno.json'), 'w') as f:
+        json.dump({
+            "video_key": video_key,
+            "frames": frames,
+            "frame_occlusion_level": float(np.mean([o > 0 for o in occluded_fractions])),
+            "median_target_occlusion_level": float(np.median(occluded_fractions)),
+            "mean_target_occlusion_level": float(np.mean(occluded_fractions)),
+        }, f)
+
+    tag_names = [v for tags in (MotionTags, TargetTags) for k, v in vars(tags).items() if not k.startswith('_')]
+    video_tags = {tag: bool(rng.random() < 0.3) for tag in tag_names}
+    with open(video_dir.joinpath('meta.info'), 'w') as f:
+        json.dump({"height": height, "width": width, "video_tags": video_tags}, f)
+
+    return video_key
+
+## Generates a synthetic HOOT dataset in directory
+## Every third video goes to the test split, the rest to the train split
+def generate_dataset(directory: str, num_classes: int=2, videos_per_class: int=3, num_frames: int=30,
+                     width: int=640, height: int=360, seed: int=0) -> List[str]:
+    datapath = Path(directory)
+    datapath.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    ## Class names must be letters and underscores only, so extra classes get a letter suffix (apple_b, ...)
+    num_names = len(SYNTHETIC_CLASSES)
+    class_names = [SYNTHETIC_CLASSES[i % num_names] + (f'_{chr(ord("a") + i // num_names)}' if i >= num_names else '')
+                   for i in range(num_classes)]
+    test_keys, train_keys = [], []
+    for class_name in class_names:
+        for v in range(1, videos_per_class + 1):
+            video_id = f'{v:03}'
+            video_key = generate_video(datapath.joinpath(class_name, video_id), class_name, video_id, num_frames, width, height, rng)
+            (test_keys if v % 3 == 1 else train_keys).append(video_key)
+
+    with open(datapath.joinpath('test.txt'), 'w') as f:
+        f.write('\n'.join(test_keys) + '\n')
+    with open(datapath.joinpath('train.txt'), 'w') as f:
+        f.write('\n'.join(train_keys) + '\n')
+    return test_keys + train_keys
@@ -1,11 +1,177 @@
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+import email.utils
+import os
+import random
+import threading
+import time
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from typing import NamedTuple, Optional, Tuple
 
-## Function that starts a local server at localhost
-## Used to test the dataset downloader
-def start_local_server(directory: str, port: int):
-    class LocalHTTPRequestHandler(SimpleHTTPRequestHandler):
+## Simulated network conditions for the local server
+## latency: seconds added before every response
+## bandwidth: bytes/s cap per connection (0 for no cap)
+## drop_rate: probability that a response body is cut off part way and the connection closed
+## seed: seeds the random drops so a run can be reproduced
+class LinkConditions(NamedTuple):
+    latency: float=0.0
+    bandwidth: int=0
+    drop_rate: float=0.0
+    seed: Optional[int]=None
+
+## Parses a single 'bytes=start-end' / 'bytes=start-' / 'bytes=-suffix' Range header into [start, end)
+## Returns None for headers it doesn't understand (eg. multiple ranges) or that are syntactically invalid
+## (eg. 'bytes=5-3', last byte before the first - RFC 7233 2.1), which are then ignored
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    start, _, end = spec.strip().partition('-')
+    try:
+        if start == '':
+            return (max(size - int(end), 0), size)
+        if end and int(end) < int(start):
+            return None
+        return (int(start), min(int(end) + 1, size) if end else size)
+    except ValueError:
+        return None
+
+## Request handler with HTTP/1.1 keep-alive, Range/206 responses and ETag/Last-Modified validators
+class LocalHTTPRequestHandler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    conditions = LinkConditions()
+    rng = random.Random()
+    rng_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        self.remaining = None
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return super().send_head()
+
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND, 'File not found')
+            return None
+
+        st = os.fstat(f.fileno())
+        etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+        last_modified = self.date_time_string(st.st_mtime)
+
+        if self.conditions.latency > 0:
+            time.sleep(self.conditions.latency)
+
+        ## Conditional requests - If-None-Match takes precedence over If-Modified-Since
+        if_none_match = self.headers.get('If-None-Match')
+        if_modified_since = self.headers.get('If-Modified-Since')
+        not_modified = False
+        if if_none_match is not None:
+            not_modified = etag in [t.strip() for t in if_none_match.split(',')] or if_none_match.strip() == '*'
+        elif if_modified_since is not None:
+            try:
+                not_modified = int(st.st_mtime) <= email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                pass
+        if not_modified:
+            f.close()
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+
+        ## Byte ranges - If-Range only honors the Range when the file hasn't changed
+        byte_range = None
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if range_header is not None and (if_range is None or if_range.strip() in (etag, last_modified)):
+            byte_range = parse_range(range_header, st.st_size)
+            if byte_range is not None and byte_range[0] >= max(st.st_size, 1):
+                f.close()
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header('Content-Range', f'bytes */{st.st_size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+
+        if byte_range is None:
+            start, end = 0, st.st_size
+            self.send_response(HTTPStatus.OK)
+        else:
+            start, end = byte_range
+            self.send_response(HTTPStatus.PARTIAL_CONTENT)
+            self.send_header('Content-Range', f'bytes {start}-{end - 1}/{st.st_size}')
+        f.seek(start)
+        self.remaining = end - start
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+        return f
+
+    ## Copies at most self.remaining bytes (the requested range), applying the bandwidth cap and random drops
+    def copyfile(self, source, outputfile):
+        remaining = self.remaining
+        if remaining is None:
+            return super().copyfile(source, outputfile)
+
+        conditions = self.conditions
+        cut_at = None
+        if conditions.drop_rate > 0:
+            with self.rng_lock:
+                if self.rng.random() < conditions.drop_rate:
+                    cut_at = self.rng.randrange(0, max(remaining, 1))
+
+        chunk_size = 65536
+        if conditions.bandwidth > 0:
+            ## Small chunks keep the throttled stream smooth
+            chunk_size = max(min(chunk_size, conditions.bandwidth // 20), 1024)
+        sent = 0
+        start = time.perf_counter()
+        while sent < remaining:
+            size = min(chunk_size, remaining - sent)
+            if cut_at is not None:
+                size = min(size, cut_at - sent)
+            chunk = source.read(size)
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            sent += len(chunk)
+            if cut_at is not None and sent >= cut_at:
+                break
+            if conditions.bandwidth > 0:
+                ahead = sent / conditions.bandwidth - (time.perf_counter() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+        if sent < remaining:
+            ## Simulated connection drop - the client sees a short body
+            self.close_connection = True
+
+## Function that builds a local server at localhost serving directory
+## Port 0 picks a free port (see httpd.server_address)
+## Every connection gets its own thread, so concurrent and keep-alive downloads behave like against a real host
+def make_local_server(directory: str, port: int, conditions: Optional[LinkConditions]=None) -> ThreadingHTTPServer:
+    conditions = conditions or LinkConditions()
+
+    class Handler(LocalHTTPRequestHandler):
         def __init__(self, *args, **kwargs):
             super().__init__(*args, directory=directory, **kwargs)
 
-    httpd = HTTPServer(('localhost', port), LocalHTTPRequestHandler)
+    Handler.conditions = conditions
+    Handler.rng = random.Random(conditions.seed)
+    httpd = ThreadingHTTPServer(('localhost', port), Handler)
+    httpd.daemon_threads = True
+    return httpd
+
+## Function that starts a local server at localhost
+## Used to test the dataset downloader
+def start_local_server(directory: str, port: int, conditions: Optional[LinkConditions]=None):
+    httpd = make_local_server(directory, port, conditions)
     httpd.serve_forever()
@@ -19,47 +19,125 @@ def validate_version(version: str) -> bool:
 import hashlib
 import zipfile
 import os
+import time
+import multiprocessing
+from collections import Counter
+from tqdm import tqdm
+from hoot import metrics
+from hoot.manifest import zip_manifest
 from pathlib import Path
-import zipfile
-from typing import NamedTuple, List, Tuple
+from typing import NamedTuple, List, Tuple, Optional, Dict, Callable, Iterable, Any
+
+## Zip compression per file extension: (compress_type, compresslevel)
+## PNG frames are already compressed, so they're stored - deflating them costs CPU for ~0% gain
+## anno.json is mostly hex RLE strings and shrinks several times over with deflate
+COMPRESSION_POLICY = {
+    '.png': (zipfile.ZIP_STORED, None),
+    '.json': (zipfile.ZIP_DEFLATED, 6),
+    '.info': (zipfile.ZIP_DEFLATED, 6),
+    '.txt': (zipfile.ZIP_DEFLATED, 6),
+}
+DEFAULT_COMPRESSION = (zipfile.ZIP_DEFLATED, 6)
+
+def compression_policy(level: int=6) -> Dict[str, Tuple[int, Optional[int]]]:
+    '''COMPRESSION_POLICY with every deflated extension at the given level (0-9)'''
+    return {ext: (compress_type, level if compress_type == zipfile.ZIP_DEFLATED else compress_level)
+            for ext, (compress_type, compress_level) in COMPRESSION_POLICY.items()}
 
 class PackageInfo(NamedTuple):
     id: str
     original_size: int
     sha256: str
     zip_path: str
-
-def package_folder(id: str, directory: Path, zip_output: Path, allowed_file_types: List[str]) -> PackageInfo:
+    zip_sha256: Optional[str]=None
+    ## extension -> [original bytes, compressed bytes]
+    member_sizes: Optional[Dict[str, List[int]]]=None
+    ## per-file hashes and zip offsets + Merkle root, see hoot/manifest.py
+    manifest: Optional[dict]=None
+
+def package_folder(id: str, directory: Path, zip_output: Path, allowed_file_types: List[str],
+                   compression: Optional[Dict[str, Tuple[int, Optional[int]]]]=None,
+                   extra_files: Optional[Dict[str, bytes]]=None) -> PackageInfo:
     '''
     Walks a directory alphabetically and builds a hash digest + zip archive
     Hash digest includes utf-8 encoded filenames (eg. "0001.png")
+    Each member is compressed according to its extension (see COMPRESSION_POLICY)
+    Each file is also hashed on its own for the archive's manifest
+    extra_files are generated members (name -> content, eg. anno.bin) zipped and hashed in order with the
+    files on disk, so the hash matches hash_folder of the extracted zip
     '''
+    if extra_files is None:
+        extra_files = {}
+    if compression is None:
+        compression = COMPRESSION_POLICY
 
     data_size = 0
     data_hash = hashlib.sha256()
-    data_zip = zipfile.ZipFile(zip_output, mode='w')
-
-    for root, dirs, files in os.walk(directory, topdown=True, followlinks=False):
-        #breakpoint()
-        for name in sorted(files):
-            #print(os.path.splitext(name), allowed_file_types)
-            if os.path.splitext(name)[1] not in allowed_file_types:
-                continue
-
-            #include the file name in the hash
-            data_hash.update(name.encode('utf-8'))
-
-            # hash and write to zip using the same read stream
-            z_info = zipfile.ZipInfo.from_file(Path(root) / name, name)
-            with open(os.path.join(root, name), "rb") as f, data_zip.open(z_info, mode='w') as zip_stream:
-                for chunk in iter(lambda: f.read(16384), b""):
-                    data_hash.update(chunk)
-                    data_size += len(chunk)
-                    zip_stream.write(chunk)
-
-    return PackageInfo(id, data_size, data_hash.hexdigest(), zip_output)
-
-
+    file_hashes = {}
+    with metrics.span('zip_write', video=str(directory)) as zip_span, zipfile.ZipFile(zip_output, mode='w') as data_zip:
+        for root, dirs, files in os.walk(directory, topdown=True, followlinks=False):
+            #breakpoint()
+            ## (generated members only go in the top level folder)
+            generated = extra_files if root == str(directory) else {}
+            for name in sorted(set(files) | set(generated)):
+                #print(os.path.splitext(name), allowed_file_types)
+                if name not in generated and os.path.splitext(name)[1] not in allowed_file_types:
+                    continue
+
+                #include the file name in the hash
+                data_hash.update(name.encode('utf-8'))
+
+                if name in generated:
+                    content = generated[name]
+                    z_info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+                    z_info.compress_type, z_info._compresslevel = compression.get(os.path.splitext(name)[1], DEFAULT_COMPRESSION)
+                    data_zip.writestr(z_info, content)
+                    data_hash.update(content)
+                    data_size += len(content)
+                    file_hashes[name] = hashlib.sha256(content).hexdigest()
+                    continue
+
+                # hash and write to zip using the same read stream
+                z_info = zipfile.ZipInfo.from_file(Path(root) / name, name)
+                ## (ZipInfo only takes the level through its private attribute)
+                z_info.compress_type, z_info._compresslevel = compression.get(os.path.splitext(name)[1], DEFAULT_COMPRESSION)
+                file_hash = hashlib.sha256()
+                with open(os.path.join(root, name), "rb") as f, data_zip.open(z_info, mode='w') as zip_stream:
+                    for chunk in iter(lambda: f.read(16384), b""):
+                        data_hash.update(chunk)
+                        file_hash.update(chunk)
+                        data_size += len(chunk)
+                        zip_stream.write(chunk)
+                file_hashes[name] = file_hash.hexdigest()
+
+        member_sizes = {}
+        for z_info in data_zip.infolist():
+            sizes = member_sizes.setdefault(os.path.splitext(z_info.filename)[1], [0, 0])
+            sizes[0] += z_info.file_size
+            sizes[1] += z_info.compress_size
+        zip_span.set(bytes=data_size, compressed_bytes=sum(c for _, c in member_sizes.values()))
+        manifest = zip_manifest(data_zip, file_hashes)
+
+    # hash the finished zip - it's still in the page cache, so this is cheap
+    with metrics.span('hash_zip', video=str(directory)) as hash_span:
+        zip_sha256 = hash_file(zip_output).hexdigest()
+        hash_span.set(bytes=os.path.getsize(zip_output))
+
+    return PackageInfo(id, data_size, data_hash.hexdigest(), zip_output, zip_sha256, member_sizes, manifest)
+
+
+
+def hash_file(filepath: Path, data_hash=None, chunk_size: int=1048576):
+    '''
+    Hashes the contents of a single file (eg. a downloaded zip)
+    Updates and returns the given hash object, or a new sha256 if None
+    '''
+    if data_hash is None:
+        data_hash = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            data_hash.update(chunk)
+    return data_hash
 
 def hash_folder(directory: Path) -> Tuple[int, str]:
     '''
@@ -71,16 +149,68 @@ def hash_folder(directory: Path) -> Tuple[int, str]:
     data_size = 0
     data_hash = hashlib.sha256()
 
-    for root, dirs, files in os.walk(directory, topdown=True, followlinks=False):
-        #breakpoint()
-        for name in sorted(files):
-            #include the file name in the hash
-            data_hash.update(name.encode('utf-8'))
+    with metrics.span('hash_folder', video=str(directory)) as hash_span:
+        for root, dirs, files in os.walk(directory, topdown=True, followlinks=False):
+            #breakpoint()
+            for name in sorted(files):
+                #include the file name in the hash
+                data_hash.update(name.encode('utf-8'))
 
-            # hash and write to zip using the same read stream
-            with open(os.path.join(root, name), "rb") as f:
-                for chunk in iter(lambda: f.read(16384), b""):
-                    data_hash.update(chunk)
-                    data_size += len(chunk)
+                # hash using large reads - frames are big PNGs
+                with open(os.path.join(root, name), "rb") as f:
+                    for chunk in iter(lambda: f.read(1048576), b""):
+                        data_hash.update(chunk)
+                        data_size += len(chunk)
+        hash_span.set(bytes=data_size)
 
     return (data_size, data_hash.hexdigest())
+
+def folder_fingerprint(directory: Path) -> str:
+    '''
+    Builds a cheap fingerprint of a directory from file stats only (names, sizes, mtimes, inodes)
+    Used to skip re-hashing folders that haven't changed since they were last verified
+    '''
+    fingerprint = hashlib.sha256()
+    for root, dirs, files in os.walk(directory, topdown=True, followlinks=False):
+        dirs.sort()
+        for name in sorted(files):
+            st = os.stat(os.path.join(root, name))
+            rel_path = os.path.relpath(os.path.join(root, name), directory)
+            fingerprint.update(f'{rel_path}\0{st.st_size}\0{st.st_mtime_ns}\0{st.st_ino}\n'.encode('utf-8'))
+    return fingerprint.hexdigest()
+
+def _indexed_job(args: Tuple[Callable, int, Any, float]) -> Tuple[int, str, Any]:
+    '''Runs a single pool job and tags the result with its index and worker name'''
+    fn, idx, job, submitted = args
+    metrics.record('pool_queue_wait', time.time() - submitted, job=fn.__name__)
+    return (idx, multiprocessing.current_process().name, fn(job))
+
+def pool_map(fn: Callable, jobs: Iterable, processes: Optional[int]=None, desc: Optional[str]=None) -> List:
+    '''
+    Maps fn over jobs on a process pool sized by processes (cpu count if None)
+    Results are returned in job order regardless of completion order, so outputs stay deterministic
+    Progress bar shows the number of jobs completed per worker
+    fn must be a top-level (picklable) function
+    '''
+    jobs = list(jobs)
+    results = [None] * len(jobs)
+    per_worker = Counter()
+
+    with tqdm(total=len(jobs), desc=desc) as pbar:
+        ## Single process - run inline, easier to debug and no pickling overhead
+        if processes == 1 or len(jobs) <= 1:
+            for idx, job in enumerate(jobs):
+                results[idx] = fn(job)
+                pbar.update(1)
+            return results
+
+        with multiprocessing.Pool(processes) as pool:
+            submitted = time.time()
+            tasks = [(fn, idx, job, submitted) for idx, job in enumerate(jobs)]
+            for idx, worker, result in pool.imap_unordered(_indexed_job, tasks):
+                results[idx] = result
+                per_worker[worker.rsplit('-', 1)[-1]] += 1
+                pbar.set_postfix({f'w{k}': v for k, v in sorted(per_worker.items(), key=lambda kv: (len(kv[0]), kv[0]))}, refresh=False)
+                pbar.update(1)
+
+    return results
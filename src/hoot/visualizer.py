@@ -1,11 +1,12 @@
 import multiprocessing
 from tqdm import tqdm
-from typing import Optional
+from typing import Optional, NamedTuple
 from pathlib import Path
 import json
 import pickle
 import os
-from hoot.anno import load_video_from_file, Video
+from hoot.anno import load_video_from_file, Video, Frame
+from hoot.utils import pool_map
 import cv2
 import numpy as np
 import sys
@@ -20,80 +21,115 @@ COLORS = {"tgt_poly": (0, 255, 0),
           "t": (255 ,178, 102)
          }
 
-## Main driver code to visualize all videos, if a specific video is given, it skips all the rest
-def visualize_videos(data_directory: str, output_directory: Optional[str], video_key: Optional[str]) -> None:
+## Order of occluder layers when compositing - a solid occluder in fact trumps all the rest
+OCC_LAYER_ORDER = ["t", "st", "sp", "s"]
+## Palette indexed by layer label (0 = no occluder)
+OCC_PALETTE = np.array([(0, 0, 0)] + [COLORS[occ_type] for occ_type in OCC_LAYER_ORDER], dtype=np.uint8)
+
+## Splits a video key (eg. 'toy_car-003') into class and video names
+def split_video_key(video_key: str):
+    class_name, _, video_name = video_key.rpartition('-')
+    return (class_name, video_name)
+
+## Main driver code to visualize all videos, if a specific video is given, only that video is loaded
+## In headless mode nothing is shown on screen: videos are rendered in parallel processes straight to
+## <output_directory>/<video_key>.mp4
+## scale (0.5, 0.25 or 0.125) visualizes that pyramid level of each video (see hoot/pyramid.py) as it is,
+## instead of decoding full resolution frames and halving them
+def visualize_videos(data_directory: str, output_directory: Optional[str], video_key: Optional[str],
+                     headless: bool=False, threads: Optional[int]=None, fps: float=30.0, scale: Optional[float]=None) -> None:
 
     # Handle directories
     datapath = Path(data_directory)
     outpath = Path(output_directory) if output_directory else None
     if outpath:
         outpath.mkdir(exist_ok=True)
+    assert outpath is not None or not headless, 'headless mode needs an output directory'
 
-    # Assemble all class directories
-    class_directories = [d for d in sorted(datapath.iterdir()) if d.is_dir()]
+    # Collect the video directories to visualize
+    if video_key:
+        class_name, video_name = split_video_key(video_key)
+        video_paths = [datapath.joinpath(class_name, video_name)]
+        assert video_paths[0].is_dir(), f'video {video_key} not found in {datapath}'
+    else:
+        class_directories = [d for d in sorted(datapath.iterdir()) if d.is_dir()]
+        video_paths = [v for c in class_directories for v in sorted(c.iterdir()) if v.joinpath('anno.json').exists()]
 
-    videos = []
-    for class_dir in tqdm(class_directories, desc='loading annotations per obj class'):
-        video_dirs = [d for d in sorted(class_dir.iterdir()) if d.is_dir()]
-        
-        for video_path in video_dirs:
-            if video_key and video_key != class_dir.name + "-" + video_path.name:
-                continue
-            video_anno_json = video_path.joinpath('anno.json')
-            video_meta_json = video_path.joinpath('meta.info')
-            video_data = load_video_from_file(video_path, None, video_anno_json, video_meta_json)
-            videos.append(video_data)
+    # Render videos to files in parallel
+    if headless:
+        jobs = [RenderArgs(str(v), str(outpath.joinpath(f'{v.parent.name}-{v.name}.mp4')), fps, "multi", scale) for v in video_paths]
+        pool_map(render_job, jobs, threads, desc='rendering videos')
+        return
+
+    # Visualize boxes and masks, loading annotations one video at a time
+    for video_path in tqdm(video_paths, desc='visualizing videos'):
+        video_data = load_video_from_file(video_path, lazy=True, scale=scale)
+        visualize_video(video_data, outpath, downscale=scale is None)
+
+class RenderArgs(NamedTuple):
+    video_path: str
+    output_file: str
+    fps: float
+    with_mask: str
+    scale: Optional[float]=None
+
+def render_job(args: RenderArgs) -> str:
+    '''Renders a single video to an MP4 file - used in a multiprocessing pool'''
+    assert isinstance(args, RenderArgs)
+    video_data = load_video_from_file(Path(args.video_path), lazy=True, scale=args.scale)
+    render_video(video_data, Path(args.output_file), args.fps, args.with_mask, downscale=args.scale is None)
+    return args.output_file
 
-    # Visualize boxes and masks on either given video or all videos
-    for video_data in videos:
-        if video_key:
-            if video_data.video_key == video_key:
-                ## Visualize given video
-                visualize_video(video_data, outpath)
-                break
-        else:
-            ## Visualize all
-            visualize_video(video_data, outpath)
+## Draws boxes and occlusion masks on a frame image (in place), returns the (possibly resized) visualization
+## downscale halves frames taller than 1000px - pyramid levels are already small, so they're drawn as they are
+def draw_frame(img_data: np.ndarray, frame: Frame, with_mask: Optional[str]="multi", downscale: bool=True) -> np.ndarray:
+    ## If object out of frame, no annotations to plot
+    if not frame.attributes.absent:
+        ## Plot the rotated bb
+        cv2.polylines(img_data, [np.array(frame.rot_bb, np.int32)], True, COLORS["tgt_rot_bb"], thickness=5)
+
+        ## Plot the binary occlusion masks
+        if with_mask == "binary":
+            if frame.occ_masks.all:
+                img_data[frame.occ_masks.all.mask.astype(bool)] = COLORS["occ"]
+        elif with_mask == "multi":
+            ## Composite all layers in one pass: each pixel takes the label of its highest priority occluder
+            labels = None
+            for label, (occ_type, occ_mask_obj) in enumerate(frame.occ_masks.get_masks(OCC_LAYER_ORDER), start=1):
+                if occ_mask_obj:
+                    layer = occ_mask_obj.mask * np.uint8(label)
+                    labels = layer if labels is None else np.maximum(labels, layer, out=labels)
+            if labels is not None:
+                occ_idxs = labels > 0
+                img_data[occ_idxs] = OCC_PALETTE[labels[occ_idxs]]
+
+    ## Resize cause original images are BIG
+    h,w = img_data.shape[:2]
+    if downscale and h>1000:
+        return cv2.resize(img_data,(int(w*0.5),int(h*0.5)), interpolation = cv2.INTER_AREA)
+    return img_data
+
+## Renders a single video to an encoded MP4 file without any windows
+def render_video(video_data: Video, output_file: Path, fps: float=30.0, with_mask: Optional[str]="multi", downscale: bool=True) -> None:
+    writer = None
+    try:
+        ## Decode upcoming frames in the background while the current one is drawn and encoded
+        for frame, img_data, _ in video_data.iter_frames(prefetch=4, workers=2):
+            vis_data = draw_frame(img_data, frame, with_mask, downscale)
+            if writer is None:
+                h, w = vis_data.shape[:2]
+                writer = cv2.VideoWriter(str(output_file), cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+            writer.write(vis_data)
+    finally:
+        if writer is not None:
+            writer.release()
         
 ## Function to visualize a single video
-def visualize_video(video_data: Video, output_folder: Optional[Path]=None, with_mask: Optional[str]="multi") -> None:
+def visualize_video(video_data: Video, output_folder: Optional[Path]=None, with_mask: Optional[str]="multi", downscale: bool=True) -> None:
 
     for idx, frame in enumerate(video_data.frames):
         img_data = cv2.imread(str(frame.frame_path))
-
-        ## If object out of frame, no annotations to plot
-        if frame.attributes.absent:
-            vid_data = img_data
-        else:
-            ## Plot the rotated bb
-            cv2.polylines(img_data, [np.array(frame.rot_bb, np.int32)], True, COLORS["tgt_rot_bb"], thickness=5)
-
-            ## Plot the binary occlusion masks
-            if with_mask == "binary":
-                if frame.occ_masks.all:       
-                    occ_mask_mat = frame.occ_masks.all.mask
-                    occ_mask = cv2.cvtColor(occ_mask_mat,cv2.COLOR_GRAY2BGR)
-                    occ_idxs = (occ_mask == [1,1,1]).all(-1)
-                    img_data[occ_idxs] = COLORS["occ"]
-                vis_data = img_data
-            elif with_mask == "multi": 
-                ## This order is of some importance
-                ## Why? Cause a solid occluder in fact trumps all the rest
-                occ_types_list = ["t","st","sp","s"]
-                
-                for occ_type, occ_mask_obj in frame.occ_masks.get_masks(occ_types_list):
-                    if occ_mask_obj:
-                        occ_mask = cv2.cvtColor(occ_mask_obj.mask,cv2.COLOR_GRAY2BGR)
-                        occ_idxs = (occ_mask == [1,1,1]).all(-1)
-                        img_data[occ_idxs] = COLORS[occ_type]
-                vis_data = img_data
-            else:
-                vis_data = img_data
-    
-        ## Resize cause original images are BIG
-        h,w = img_data.shape[:2]
-        if h>1000:
-            vis_data = cv2.resize(vis_data,(int(w*0.5),int(h*0.5)), interpolation = cv2.INTER_AREA)
+        vis_data = draw_frame(img_data, frame, with_mask, downscale)
         
         if output_folder:
             video_key = video_data.video_key
@@ -106,4 +142,3 @@ def visualize_video(video_data: Video, output_folder: Optional[Path]=None, with_
         cv2.imshow("video",vis_data)
         cv2.waitKey(2)
     cv2.destroyAllWindows()
-            
\ No newline at end of file
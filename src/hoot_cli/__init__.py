@@ -2,10 +2,32 @@ import dataclasses
 import click
 from pathlib import Path
 import json
+import os
+import tempfile
+from typing import Optional
+from hoot import metrics
 
 @click.group()
-def cli():
-    pass
+@click.option('--profile', type=bool, default=False, is_flag=True, help='Record per-stage timings and print a summary at the end')
+@click.option('--metrics-out', type=click.Path(), default=None, help='Write per-stage timing spans as jsonl (implies --profile)')
+@click.pass_context
+def cli(ctx: click.Context, profile: bool=False, metrics_out: Optional[str]=None):
+    if not profile and metrics_out is None:
+        return
+    trace_path = metrics_out
+    if trace_path is None:
+        fd, trace_path = tempfile.mkstemp(prefix='hoot-metrics-', suffix='.jsonl')
+        os.close(fd)
+    metrics.enable_metrics(trace_path)
+
+    def finish():
+        metrics.print_summary(trace_path)
+        metrics.disable_metrics()
+        if metrics_out is None:
+            os.remove(trace_path)
+        else:
+            print(f'Trace written to {trace_path}')
+    ctx.call_on_close(finish)
 
 
 ## 'hoot make-archive' CLI command
@@ -18,11 +40,24 @@ from hoot.archiver import make_archive
 @click.option('--version', type=str, prompt='Version: (eg 1.0)')
 @click.option('--threads', type=int, default=None)
 @click.option('--clean', type=bool, default=False, is_flag=True)
-def launch_make_archive(directory: str, destination: str, version: str, threads: Optional[int]=None, clean: bool=False):
-    make_archive(directory, destination, version, threads, clean)
+@click.option('--compress-level', type=click.IntRange(0, 9), default=6, help='Deflate level for anno.json and other text files, PNGs are always stored')
+@click.option('--binary-anno', type=bool, default=False, is_flag=True, help='Also pack each anno.json into a compact anno.bin')
+def launch_make_archive(directory: str, destination: str, version: str, threads: Optional[int]=None, clean: bool=False, compress_level: int=6,
+                        binary_anno: bool=False):
+    make_archive(directory, destination, version, threads, clean, compress_level, binary_anno)
 
 ## 'hoot download' CLI command
 from hoot.downloader import download_archives
+from hoot.query import compile_query
+
+def validate_query(where: Optional[str]):
+    '''Reports a malformed --where query as a usage error'''
+    if where is None:
+        return
+    try:
+        compile_query(where)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--where')
 RELEASED_VERSIONS = ["v1_0-HD", "v1_0-UHD"]
 
 @cli.command(name="download")
@@ -32,35 +67,197 @@ RELEASED_VERSIONS = ["v1_0-HD", "v1_0-UHD"]
 @click.option('--clean', type=bool, default=False, is_flag=True)
 @click.option('--test-only', type=bool, default=False, is_flag=True)
 @click.option('--remove-archives', type=bool, default=False, is_flag=True)
-def download(destination: Path, version: str, extract: bool=False, clean: bool=False, test_only: bool=False, remove_archives: bool=False):
-    download_archives(destination, version, extract, clean, test_only, remove_archives)
+@click.option('--jobs', '-j', type=int, default=4, help='Number of concurrent downloads')
+@click.option('--largest-first', type=bool, default=False, is_flag=True, help='Schedule the largest archives first')
+@click.option('--pipeline', type=bool, default=False, is_flag=True, help='Extract each archive as soon as it is downloaded')
+@click.option('--extract-jobs', type=int, default=2, help='Number of concurrent extractions in pipeline mode')
+@click.option('--keep-archives', type=bool, default=False, is_flag=True, help='Keep zip files after extraction in pipeline mode')
+@click.option('--where', type=str, default=None, help='Only download videos matching a metadata query')
+@click.option('--dry-run', type=bool, default=False, is_flag=True, help='Only report the number of videos and bytes to download')
+@click.option('--offline', type=bool, default=False, is_flag=True, help='Use only the cached metadata and already downloaded zips')
+def download(destination: Path, version: str, extract: bool=False, clean: bool=False, test_only: bool=False, remove_archives: bool=False, jobs: int=4, largest_first: bool=False,
+             pipeline: bool=False, extract_jobs: int=2, keep_archives: bool=False, where: Optional[str]=None, dry_run: bool=False, offline: bool=False):
+    validate_query(where)
+    download_archives(destination, version, extract, clean, test_only, remove_archives, jobs, largest_first, pipeline, extract_jobs, keep_archives, where, dry_run, offline)
 
 from hoot.downloader import verify_archives
 @cli.command(name="verify")
 @click.option('--directory', '--dir', type=click.Path(), prompt='Data directory')
 @click.option('--version', type=click.Choice(RELEASED_VERSIONS), prompt="Dataset Version")
-def verify(directory: Path, version: str):
+@click.option('--threads', type=int, default=None)
+@click.option('--full', type=bool, default=False, is_flag=True, help='Rehash every video, ignoring the verification cache')
+@click.option('--where', type=str, default=None, help='Only verify videos matching a metadata query')
+@click.option('--offline', type=bool, default=False, is_flag=True, help='Verify against the cached metadata without any network access')
+def verify(directory: Path, version: str, threads: Optional[int]=None, full: bool=False, where: Optional[str]=None, offline: bool=False):
     '''Prints class-video paths that are INVALID for the selected data version.'''
-    invalid_paths = verify_archives(directory, version)
-    for p in invalid_paths:
-        print(p)
+    validate_query(where)
+    invalid_videos = verify_archives(directory, version, threads, full, where, offline)
+    print_invalid(invalid_videos)
+
+def print_invalid(invalid_videos: dict):
+    '''Prints each corrupt file, or the whole video when it can't be narrowed down'''
+    for video_dir, names in invalid_videos.items():
+        if not names:
+            print(video_dir)
+        for name in names:
+            print(Path(video_dir).joinpath(name))
 
-#TODO: add a repair_archive function
+## 'hoot repair' command for fixing corrupt downloads
+from hoot.downloader import repair_archives
+
+@cli.command(name="repair")
+@click.option('--directory', '--dir', type=click.Path(), prompt='Data directory')
+@click.option('--version', type=click.Choice(RELEASED_VERSIONS), prompt="Dataset Version")
+@click.option('--threads', type=int, default=None)
+@click.option('--jobs', '-j', type=int, default=4, help='Number of concurrent range requests')
+@click.option('--where', type=str, default=None, help='Only repair videos matching a metadata query')
+def repair(directory: Path, version: str, threads: Optional[int]=None, jobs: int=4, where: Optional[str]=None):
+    '''Re-fetches only the corrupt files of INVALID videos, then prints anything still invalid.'''
+    validate_query(where)
+    invalid_videos = repair_archives(directory, version, threads, jobs, where)
+    print_invalid(invalid_videos)
+
+## 'hoot sync' and 'hoot diff' commands for updating an install to a new release
+from hoot.sync import sync_archives, diff_metadata_files, print_diff, REMOVED_ACTIONS
+
+@cli.command(name="sync")
+@click.option('--destination', '--dest', type=click.Path(), prompt='Local HOOT install')
+@click.option('--version', type=click.Choice(RELEASED_VERSIONS), prompt="Dataset Version")
+@click.option('--jobs', '-j', type=int, default=4, help='Number of concurrent downloads')
+@click.option('--extract/--no-extract', default=True, help='Extract (and delete) downloaded zips')
+@click.option('--removed', type=click.Choice(REMOVED_ACTIONS), default='quarantine', help='What to do with videos dropped from the release')
+@click.option('--where', type=str, default=None, help='Only download added videos matching a metadata query')
+@click.option('--dry-run', type=bool, default=False, is_flag=True, help='Only print what would change')
+@click.option('--verbose', '-v', type=bool, default=False, is_flag=True, help='List every added, changed and removed video')
+def sync(destination: str, version: str, jobs: int=4, extract: bool=True, removed: str='quarantine', where: Optional[str]=None,
+         dry_run: bool=False, verbose: bool=False):
+    '''Downloads only the videos that were added or changed since the local install's metadata.json.'''
+    validate_query(where)
+    sync_archives(destination, version, jobs, extract, removed, where, dry_run, verbose)
+
+@cli.command(name="diff")
+@click.argument('old_metadata', type=click.Path(exists=True))
+@click.argument('new_metadata', type=click.Path(exists=True))
+@click.option('--verbose', '-v', type=bool, default=False, is_flag=True, help='List every added, changed and removed video')
+def diff(old_metadata: str, new_metadata: str, verbose: bool=False):
+    '''Compares two metadata.json files offline.'''
+    print_diff(diff_metadata_files(old_metadata, new_metadata), verbose)
 
 ## 'hoot visualize' command for quickly visualizing videos
 from hoot.visualizer import visualize_videos
+from hoot.pyramid import PYRAMID_SCALES, build_pyramids
 
 @cli.command(name='visualize')
 @click.option('--directory', '--dir', type=click.Path(), prompt='Hoot Directory')
 @click.option('--output', '--dest', type=click.Path(), default=None)
 @click.option('--video', type=str, default=None)
-def launch_visualizer(directory: str, output: Optional[str], video: Optional[str]):
-    visualize_videos(directory, output, video)           
+@click.option('--headless', type=bool, default=False, is_flag=True, help='Render videos to <dest>/<video>.mp4 in parallel without a display')
+@click.option('--threads', type=int, default=None)
+@click.option('--fps', type=float, default=30.0)
+@click.option('--scale', type=click.Choice([str(s) for s in PYRAMID_SCALES]), default=None, help='Visualize this pyramid level (see build-pyramid)')
+def launch_visualizer(directory: str, output: Optional[str], video: Optional[str], headless: bool=False, threads: Optional[int]=None, fps: float=30.0,
+                      scale: Optional[str]=None):
+    if headless and output is None:
+        raise click.BadParameter('headless mode needs an output directory', param_hint='--dest')
+    visualize_videos(directory, output, video, headless, threads, fps, float(scale) if scale else None)           
+
+## 'hoot build-index' command for compiling all annotations into a columnar index
+from hoot.index import build_index
+
+@cli.command(name='build-index')
+@click.option('--directory', '--dir', type=click.Path(), prompt='Hoot Directory')
+@click.option('--destination', '--dest', type=click.Path(), prompt='Index destination directory')
+@click.option('--threads', type=int, default=None)
+def launch_build_index(directory: str, destination: str, threads: Optional[int]=None):
+    build_index(directory, destination, threads)
+
+## 'hoot cache-frames' command for decoding frames once into memory-mappable arrays
+from hoot.frame_cache import build_frame_cache
+
+@cli.command(name='cache-frames')
+@click.option('--directory', '--dir', type=click.Path(), prompt='Hoot Directory')
+@click.option('--destination', '--dest', type=click.Path(), prompt='Frame cache destination directory')
+@click.option('--scale', type=float, default=None, help='Cache frames scaled by this factor (eg. 0.5)')
+@click.option('--size', type=(int, int), default=None, help='Cache frames at this WIDTH HEIGHT')
+@click.option('--threads', type=int, default=None)
+def launch_cache_frames(directory: str, destination: str, scale: Optional[float]=None, size: Optional[tuple]=None, threads: Optional[int]=None):
+    '''Decodes every video's PNG frames once into <dest>/<class>/<video>.frames.'''
+    if scale is not None and size is not None:
+        raise click.BadParameter('use either --scale or --size', param_hint='--scale')
+    build_frame_cache(directory, destination, size if size is not None else scale, threads)
+
+## 'hoot build-pyramid' command for writing 1/2, 1/4 and 1/8 resolution copies of each video
+@cli.command(name='build-pyramid')
+@click.option('--directory', '--dir', type=click.Path(), prompt='Hoot Directory')
+@click.option('--scale', 'scales', type=click.Choice([str(s) for s in PYRAMID_SCALES]), multiple=True, help='Level(s) to build, all by default')
+@click.option('--threads', type=int, default=None)
+def launch_build_pyramid(directory: str, scales: tuple, threads: Optional[int]=None):
+    '''Writes downscaled frames and rescaled annotations of every video to <dir>/.hoot.pyramid/.'''
+    build_pyramids(directory, [float(s) for s in scales] or None, threads)
+
+## 'hoot evaluate' command for scoring tracker results
+from hoot.evaluation import evaluate_trackers, print_report
+
+@cli.command(name='evaluate')
+@click.option('--directory', '--dir', type=click.Path(), prompt='Hoot Directory')
+@click.option('--results', type=click.Path(), prompt='Tracker results directory')
+@click.option('--tracker', 'trackers', type=str, multiple=True, help='Tracker(s) to evaluate, all in the results directory by default')
+@click.option('--test-only', type=bool, default=False, is_flag=True)
+@click.option('--output', type=click.Path(), default=None, help='Write the full report as json')
+@click.option('--threads', type=int, default=None)
+def launch_evaluate(directory: str, results: str, trackers: tuple, test_only: bool=False, output: Optional[str]=None, threads: Optional[int]=None):
+    '''Scores <results>/<tracker>/<video_key>.txt files (one x,y,w,h box per frame) against HOOT annotations.'''
+    video_keys = None
+    if test_only:
+        with open(Path(directory).joinpath('test.txt'), 'r') as f:
+            video_keys = [k.strip() for k in f.readlines() if k.strip()]
+    report = evaluate_trackers(directory, results, list(trackers) or None, video_keys, threads)
+    print_report(report, output)
+
+## 'hoot generate-synthetic' and 'hoot benchmark' commands for offline testing and benchmarking
+from hoot.synthetic import generate_dataset
+from hoot.benchmark import run_benchmarks
+from hoot.test_server import LinkConditions
+
+@cli.command(name='generate-synthetic')
+@click.option('--destination', '--dest', type=click.Path(), prompt='Destination directory')
+@click.option('--classes', type=int, default=2)
+@click.option('--videos', type=int, default=3, help='Videos per class')
+@click.option('--frames', type=int, default=30, help='Frames per video')
+@click.option('--width', type=int, default=640)
+@click.option('--height', type=int, default=360)
+@click.option('--seed', type=int, default=0)
+def launch_generate_synthetic(destination: str, classes: int, videos: int, frames: int, width: int, height: int, seed: int):
+    '''Writes a synthetic HOOT-format dataset.'''
+    generate_dataset(destination, classes, videos, frames, width, height, seed)
+
+@cli.command(name='benchmark')
+@click.option('--workdir', type=click.Path(), default=None, help='Where to generate data (a temporary directory by default)')
+@click.option('--classes', type=int, default=2)
+@click.option('--videos', type=int, default=3, help='Videos per class')
+@click.option('--frames', type=int, default=30, help='Frames per video')
+@click.option('--width', type=int, default=640)
+@click.option('--height', type=int, default=360)
+@click.option('--jobs', type=int, default=4)
+@click.option('--output', type=click.Path(), default=None, help='Write results as json')
+@click.option('--baseline', type=click.Path(), default=None, help='Compare against an earlier results json')
+@click.option('--latency', type=float, default=0.0, help='Seconds of delay the local server adds to every response')
+@click.option('--bandwidth', type=int, default=0, help='Local server per-connection cap in KB/s (0 for no cap)')
+@click.option('--drop-rate', type=click.FloatRange(0.0, 1.0), default=0.0, help='Probability of the local server cutting a response off')
+def launch_benchmark(workdir: Optional[str], classes: int, videos: int, frames: int, width: int, height: int, jobs: int,
+                     output: Optional[str], baseline: Optional[str], latency: float=0.0, bandwidth: int=0, drop_rate: float=0.0):
+    '''Times the toolkit's hot paths on a synthetic dataset, offline.'''
+    run_benchmarks(workdir, classes, videos, frames, width, height, jobs, output, baseline,
+                   conditions=LinkConditions(latency, bandwidth * 1024, drop_rate, seed=0))
 
 ## 'hoot test-server' command for local DL testing
 from hoot.test_server import start_local_server
 @cli.command(name='test-server')
 @click.option('--directory', '--dir', type=click.Path(), prompt='Hoot Archive to Host')
 @click.option('--port', type=int, default=8080)
-def test_server(directory: str, port: int):
-    start_local_server(directory, port)
+@click.option('--latency', type=float, default=0.0, help='Seconds of delay added to every response')
+@click.option('--bandwidth', type=int, default=0, help='Per-connection cap in KB/s (0 for no cap)')
+@click.option('--drop-rate', type=click.FloatRange(0.0, 1.0), default=0.0, help='Probability of cutting a response off part way')
+@click.option('--seed', type=int, default=None, help='Seed for reproducible connection drops')
+def test_server(directory: str, port: int, latency: float=0.0, bandwidth: int=0, drop_rate: float=0.0, seed: Optional[int]=None):
+    start_local_server(directory, port, LinkConditions(latency, bandwidth * 1024, drop_rate, seed))
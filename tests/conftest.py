@@ -0,0 +1,37 @@
+import json
+from pathlib import Path
+
+import pytest
+
+OCC_TYPES = ['all', 's', 'sp', 'st', 't']
+
+@pytest.fixture
+def write_video():
+    '''Writes a video folder's anno.json and meta.info, returns the anno.json dict
+        frames are anno.json frame dicts - missing boxes and masks default to empty, missing attributes to False
+        video_tags lists the meta.info tags that are set, anno_fields overrides video-level anno.json fields
+    '''
+    ## Imported here - conftest is loaded before pytest has put src/ on the path
+    from hoot.anno import FrameAttributes, MotionTags, TargetTags
+    attributes = [f.name for f in FrameAttributes.__dataclass_fields__.values()]
+    tag_names = [v for tags in (MotionTags, TargetTags) for k, v in vars(tags).items() if not k.startswith('_')]
+
+    def write(videopath: Path, frames: list, height: int, width: int, video_tags=(), **anno_fields) -> dict:
+        videopath.mkdir(parents=True, exist_ok=True)
+        anno = {
+            'video_key': f'{videopath.parent.name}-{videopath.name}',
+            'frame_occlusion_level': 0.0,
+            'median_target_occlusion_level': 0.0,
+            'mean_target_occlusion_level': 0.0,
+            **anno_fields,
+            'frames': [{'rot_bb': [], 'aa_bb': [], **frame,
+                        'occ_masks': {**{occ_type: [] for occ_type in OCC_TYPES}, **frame.get('occ_masks', {})},
+                        'attributes': {**{attr: False for attr in attributes}, **frame.get('attributes', {})}}
+                       for frame in frames],
+        }
+        with open(videopath.joinpath('anno.json'), 'w') as f:
+            json.dump(anno, f)
+        with open(videopath.joinpath('meta.info'), 'w') as f:
+            json.dump({'height': height, 'width': width, 'video_tags': {tag: tag in video_tags for tag in tag_names}}, f)
+        return anno
+    return write
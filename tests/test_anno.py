@@ -0,0 +1,50 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from hoot.anno import OcclusionMasks, load_video_from_file, occlusion_stats
+from hoot.synthetic import encode_mask
+
+@pytest.fixture
+def occluded_video(tmp_path, write_video):
+    def write(extra_attribute: bool=False) -> Path:
+        occluder = np.zeros((8, 10), dtype=np.uint8)
+        occluder[2:5, 3:7] = 1
+        box = [[1.0, 1.0], [6.0, 1.0], [6.0, 5.0], [1.0, 5.0]]
+        frames = [{'frame_id': frame_id, 'rot_bb': box, 'aa_bb': box, 'occ_masks': {'s': encode_mask(occluder)},
+                   'attributes': {'similar_occluder': frame_id == 2, 'partial_obj_occlusion': True,
+                                  **({'glare': True} if extra_attribute else {})}}
+                  for frame_id in (2, 1)]
+        videopath = tmp_path.joinpath('apple', '001')
+        write_video(videopath, frames, 8, 10, video_tags=['blur'], frame_occlusion_level=0.5,
+                    median_target_occlusion_level=0.2, mean_target_occlusion_level=0.25)
+        return videopath
+    return write
+
+def test_lazy_matches_eager(occluded_video):
+    videopath = occluded_video()
+    eager = load_video_from_file(videopath)
+    lazy = load_video_from_file(videopath, lazy=True)
+    assert [f.frame_id for f in lazy.frames] == [f.frame_id for f in eager.frames] == [1, 2]
+    assert sorted(lazy.occlusion_tags) == sorted(eager.occlusion_tags)
+    assert lazy.frames[0].attributes == eager.frames[0].attributes
+    assert np.array_equal(lazy.frames[1].occ_masks.s.mask, eager.frames[1].occ_masks.s.mask)
+
+def test_unknown_anno_keys_are_ignored(occluded_video):
+    videopath = occluded_video(extra_attribute=True)
+    eager = load_video_from_file(videopath)
+    lazy = load_video_from_file(videopath, lazy=True)
+    assert sorted(lazy.occlusion_tags) == sorted(eager.occlusion_tags)
+    assert 'glare' not in lazy.occlusion_tags
+    assert lazy.frames[1].attributes == eager.frames[1].attributes
+
+def test_target_overlap_without_target_is_nan(occluded_video):
+    assert np.isnan(OcclusionMasks().target_overlap([]))
+    assert np.isnan(OcclusionMasks().target_overlap([[1.0, 1.0], [1.0, 1.0], [1.0, 1.0], [1.0, 1.0]]))
+    assert OcclusionMasks().target_overlap([[1.0, 1.0], [6.0, 1.0], [6.0, 5.0], [1.0, 5.0]]) == 0.0
+
+    video = load_video_from_file(occluded_video())
+    stats = occlusion_stats(video)
+    overlaps = [f.occ_masks.target_overlap(f.rot_bb) for f in video.frames]
+    assert np.allclose(overlaps, stats['union_overlap'])
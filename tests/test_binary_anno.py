@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import zipfile
+
+import numpy as np
+import pytest
+
+from hoot.anno import load_video_from_file
+from hoot.downloader import extract_archive
+from hoot.binary_anno import (ANNO_BINARY_NAME, BinaryAnnotations, open_binary_annotations, pack_annotation_file,
+                              pack_annotations)
+from hoot.synthetic import encode_mask
+
+HEIGHT, WIDTH = 12, 16
+
+def rle_hex(rows: slice, cols: slice) -> dict:
+    mask_mat = np.zeros((HEIGHT, WIDTH), dtype=np.uint8)
+    mask_mat[rows, cols] = 1
+    return encode_mask(mask_mat)
+
+@pytest.fixture
+def videopath(tmp_path, write_video):
+    box = [[1.5, 2.0], [9.0, 2.0], [9.0, 8.25], [1.5, 8.25]]
+    frames = [
+        {'frame_id': 3, 'rot_bb': box, 'aa_bb': box,
+         'occ_masks': {'all': rle_hex(slice(0, 4), slice(0, 8)), 's': rle_hex(slice(0, 4), slice(0, 8))},
+         'attributes': {'partial_obj_occlusion': True}},
+        {'frame_id': 1, 'attributes': {'absent': True}},
+        {'frame_id': 2, 'rot_bb': box, 'aa_bb': box,
+         'occ_masks': {'all': rle_hex(slice(2, 9), slice(3, 5)), 'sp': rle_hex(slice(2, 9), slice(3, 4)),
+                       'st': rle_hex(slice(5, 9), slice(4, 5))},
+         'attributes': {'similar_occluder': True, 'cut_by_frame': True}},
+        {'frame_id': 4, 'rot_bb': box, 'aa_bb': box},
+    ]
+    videopath = tmp_path.joinpath('apple', '001')
+    write_video(videopath, frames, HEIGHT, WIDTH, video_tags=['dynamic'], frame_occlusion_level=0.4,
+                median_target_occlusion_level=0.1, mean_target_occlusion_level=0.2)
+    return videopath
+
+def annotations(videopath) -> dict:
+    return json.loads(videopath.joinpath('anno.json').read_text())
+
+def write_binary(videopath):
+    videopath.joinpath(ANNO_BINARY_NAME).write_bytes(pack_annotation_file(videopath.joinpath('anno.json')))
+
+def test_raw_frames_round_trip(videopath, tmp_path):
+    path = tmp_path.joinpath(ANNO_BINARY_NAME)
+    path.write_bytes(pack_annotations(annotations(videopath)))
+    binary = BinaryAnnotations(path)
+    expected = sorted(annotations(videopath)['frames'], key=lambda f: f['frame_id'])
+    assert binary.num_frames == 4 and binary.mask_size == [HEIGHT, WIDTH]
+    for i, frame_data in enumerate(expected):
+        raw = binary.raw(i)
+        assert raw['frame_id'] == frame_data['frame_id']
+        assert raw['attributes'] == frame_data['attributes']
+        assert raw['occ_masks'] == {occ_type: {'size': m['size'], 'counts': bytes.fromhex(m['counts'])} if m else []
+                                    for occ_type, m in frame_data['occ_masks'].items()}
+        assert raw['rot_bb'] == frame_data['rot_bb'] and raw['aa_bb'] == frame_data['aa_bb']
+    polygons = binary.polygons('aa_bb')
+    assert np.isnan(polygons[0]).all() and np.allclose(polygons[1], expected[1]['aa_bb'])
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_binary_video_matches_json(videopath, lazy):
+    from_json = load_video_from_file(videopath, annopath=videopath.joinpath('anno.json'))
+    write_binary(videopath)
+    from_binary = load_video_from_file(videopath, lazy=lazy)
+    assert isinstance(from_binary.frames[0].occ_masks.s, list)
+    assert from_binary.video_key == from_json.video_key
+    assert sorted(from_binary.occlusion_tags) == sorted(from_json.occlusion_tags)
+    for fb, fj in zip(from_binary.frames, from_json.frames):
+        assert fb.frame_id == fj.frame_id and fb.frame_path == fj.frame_path
+        assert fb.attributes == fj.attributes
+        assert fb.rot_bb == fj.rot_bb and fb.aa_bb == fj.aa_bb
+        for (_, mb), (_, mj) in zip(fb.occ_masks.get_masks(), fj.occ_masks.get_masks()):
+            assert bool(mb) == bool(mj)
+            if mj:
+                assert np.array_equal(mb.mask, mj.mask)
+    ## Frame 4 has a target but no occluders
+    unoccluded = from_binary.frames[3]
+    assert unoccluded.occ_masks.target_overlap(unoccluded.rot_bb) == 0.0
+    assert unoccluded.to_xywh == [1.5, 2.0, 7.5, 6.25]
+
+def test_stale_binary_is_ignored(videopath, tmp_path, monkeypatch):
+    monkeypatch.setenv('HOOT_CACHE_DIR', str(tmp_path.joinpath('cache')))
+    write_binary(videopath)
+    binpath = videopath.joinpath(ANNO_BINARY_NAME)
+    annopath = videopath.joinpath('anno.json')
+    bin_mtime = os.stat(binpath).st_mtime_ns
+
+    ## A newer anno.json with the packed content is still current - and is only hashed once,
+    ## without writing anything
+    os.utime(annopath, ns=(bin_mtime + 10**9, bin_mtime + 10**9))
+    assert open_binary_annotations(videopath) is not None
+    assert os.stat(binpath).st_mtime_ns == bin_mtime
+    assert not tmp_path.joinpath('cache').exists()
+    hashed = []
+    sha256 = hashlib.sha256
+    monkeypatch.setattr(hashlib, 'sha256', lambda *args: hashed.append(args) or sha256(*args))
+    assert open_binary_annotations(videopath) is not None
+    assert hashed == []
+
+    ## An edited anno.json of the same size is not
+    content = annopath.read_bytes().replace(b'apple-001', b'apple-002')
+    annopath.write_bytes(content)
+    os.utime(annopath, ns=(bin_mtime + 2 * 10**9, bin_mtime + 2 * 10**9))
+    assert open_binary_annotations(videopath) is None
+    assert load_video_from_file(videopath).video_key == 'apple-002'
+
+def test_extracted_binary_is_current(videopath, tmp_path):
+    write_binary(videopath)
+    zip_path = tmp_path.joinpath('001.zip')
+    with zipfile.ZipFile(zip_path, 'w') as z:
+        for name in (ANNO_BINARY_NAME, 'anno.json', 'meta.info'):
+            z.write(videopath.joinpath(name), name)
+    extracted = tmp_path.joinpath('extracted')
+    extract_archive(zip_path, extracted)
+    assert os.stat(extracted.joinpath(ANNO_BINARY_NAME)).st_mtime_ns >= os.stat(extracted.joinpath('anno.json')).st_mtime_ns
+    assert open_binary_annotations(extracted) is not None
+
+def test_unpackable_annotations(videopath):
+    anno = annotations(videopath)
+    anno['frames'][0]['rot_bb'] = [[0, 0], [1, 1]]
+    with pytest.raises(ValueError):
+        pack_annotations(anno)
+    anno = annotations(videopath)
+    anno['frames'][2]['occ_masks']['t'] = {'size': [HEIGHT * 2, WIDTH], 'counts': anno['frames'][2]['occ_masks']['st']['counts']}
+    with pytest.raises(ValueError):
+        pack_annotations(anno)
@@ -0,0 +1,75 @@
+import hashlib
+import threading
+
+import pytest
+
+from hoot.downloader import DownloadError, Downloader, VerifyArgs, verify_job
+from hoot.metadata import AnnotatedVideo, OcclusionLevels
+from hoot.test_server import make_local_server
+
+@pytest.fixture
+def server(tmp_path):
+    served = tmp_path.joinpath('served')
+    served.mkdir()
+    httpd = make_local_server(str(served), 0)
+    ## Count the TCP connections the server accepts
+    connections = []
+    process_request = httpd.process_request
+    def counting_process_request(request, client_address):
+        connections.append(client_address)
+        process_request(request, client_address)
+    httpd.process_request = counting_process_request
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield served, f'http://localhost:{httpd.server_address[1]}/', connections
+    httpd.shutdown()
+    httpd.server_close()
+
+def annotated_video(served, name: str, data: bytes) -> AnnotatedVideo:
+    served.joinpath('apple').mkdir(exist_ok=True)
+    served.joinpath('apple', name).write_bytes(data)
+    return AnnotatedVideo(id=name[:-4], path=f'apple/{name}', sha256='', download_size=len(data), install_size=len(data),
+                          test_split=False, occlusion_levels=OcclusionLevels(0.0, 0.0, 0.0),
+                          zip_sha256=hashlib.sha256(data).hexdigest())
+
+def test_download_videos_concurrently(server, tmp_path):
+    served, host_url, connections = server
+    contents = {f'{i:03}.zip': bytes([i]) * (100000 + 7919 * i) for i in range(1, 13)}
+    videos = [annotated_video(served, name, data) for name, data in contents.items()]
+    dest = tmp_path.joinpath('dest', 'apple')
+    dest.mkdir(parents=True)
+
+    jobs = 4
+    dl = Downloader(host_url, jobs)
+    completed = []
+    zip_paths = dl.download_videos([(dest, v) for v in videos], jobs, largest_first=True,
+                                   on_complete=lambda class_dir, v, zip_path: completed.append(v.id))
+
+    assert sorted(p.name for p in zip_paths) == sorted(contents)
+    assert sorted(completed) == sorted(v.id for v in videos)
+    for name, data in contents.items():
+        assert dest.joinpath(name).read_bytes() == data
+        assert not dest.joinpath(name + '.tmp').exists()
+    ## Every worker reused a keep-alive connection from the shared session instead of opening one per archive
+    assert 1 <= len(connections) <= jobs
+
+def test_failed_verification_is_not_kept(server, tmp_path):
+    served, host_url, _ = server
+    video = annotated_video(served, '001.zip', b'zip' * 1000)
+    video.zip_sha256 = hashlib.sha256(b'something else').hexdigest()
+    dest = tmp_path.joinpath('dest')
+    dest.mkdir()
+    with pytest.raises(DownloadError):
+        Downloader(host_url, 2).download_videos([(dest, video)], 2)
+    assert list(dest.iterdir()) == []
+
+def test_verify_cache_entry_of_the_other_mode_is_rehashed(tmp_path):
+    video_dir = tmp_path.joinpath('apple', '001')
+    video_dir.mkdir(parents=True)
+    video_dir.joinpath('anno.json').write_bytes(b'{}')
+    per_file = verify_job(VerifyArgs(str(video_dir), None, per_file=True))
+    assert 'merkle_root' in per_file and 'sha256' not in per_file
+    ## Eg. a later run with metadata that has no merkle_root
+    whole = verify_job(VerifyArgs(str(video_dir), per_file, per_file=False))
+    assert 'sha256' in whole
+    assert verify_job(VerifyArgs(str(video_dir), whole, per_file=True))['files'] == per_file['files']
@@ -0,0 +1,33 @@
+import cv2
+import numpy as np
+import pytest
+
+from hoot.frame_cache import build_frame_cache, load_cached_frames
+
+@pytest.fixture
+def video_with_frames(write_video):
+    def write(videopath, frame_ids) -> dict:
+        write_video(videopath, [{'frame_id': frame_id} for frame_id in frame_ids], 6, 8)
+        images = {}
+        for frame_id in frame_ids:
+            images[frame_id] = np.full((6, 8, 3), frame_id * 10, dtype=np.uint8)
+            cv2.imwrite(str(videopath.joinpath(f'{frame_id:06}.png')), images[frame_id])
+        return images
+    return write
+
+@pytest.mark.parametrize('resize', [None, 0.5])
+def test_frame_cache_round_trip(tmp_path, video_with_frames, resize):
+    images = video_with_frames(tmp_path.joinpath('data', 'apple', '001'), [2, 1])
+    video_with_frames(tmp_path.joinpath('data', 'apple', '002'), [])
+    build_frame_cache(str(tmp_path.joinpath('data')), str(tmp_path.joinpath('cache')), resize, threads=1)
+
+    cached = load_cached_frames(str(tmp_path.joinpath('cache')), 'apple-001')
+    assert cached.frame_ids == [1, 2]
+    height, width = (6, 8) if resize is None else (3, 4)
+    assert cached.shape == (2, height, width, 3)
+    for frame_id, img in images.items():
+        assert np.array_equal(cached.frame(frame_id), img[:height, :width])
+
+    ## A video without frames loads as an empty array
+    empty = load_cached_frames(str(tmp_path.joinpath('cache')), 'apple-002')
+    assert len(empty) == 0 and empty.frames.shape == (0, height, width, 3)
@@ -0,0 +1,70 @@
+import numpy as np
+
+from hoot.geometry import iou_xywh, polygon_area, polygons_to_xywh, quad_iou, xywh_to_polygons
+
+def shoelace(points) -> float:
+    return 0.5 * abs(sum(x0 * y1 - x1 * y0 for (x0, y0), (x1, y1) in zip(points, points[1:] + points[:1])))
+
+def counter_clockwise(points):
+    signed = sum(x0 * y1 - x1 * y0 for (x0, y0), (x1, y1) in zip(points, points[1:] + points[:1]))
+    return points if signed > 0 else points[::-1]
+
+## Sutherland-Hodgman clipping of one convex polygon by another, one pair at a time
+def reference_iou(a, b) -> float:
+    a = counter_clockwise([tuple(p) for p in a])
+    b = counter_clockwise([tuple(p) for p in b])
+    clipped = a
+    for (ex0, ey0), (ex1, ey1) in zip(b, b[1:] + b[:1]):
+        inside = lambda p: (ex1 - ex0) * (p[1] - ey0) - (ey1 - ey0) * (p[0] - ex0) >= 0
+        def crossing(p, q):
+            dp = (ex1 - ex0) * (p[1] - ey0) - (ey1 - ey0) * (p[0] - ex0)
+            dq = (ex1 - ex0) * (q[1] - ey0) - (ey1 - ey0) * (q[0] - ex0)
+            t = dp / (dp - dq)
+            return (p[0] + t * (q[0] - p[0]), p[1] + t * (q[1] - p[1]))
+        points, clipped = clipped, []
+        for p, q in zip(points, points[1:] + points[:1]):
+            if inside(q):
+                if not inside(p):
+                    clipped.append(crossing(p, q))
+                clipped.append(q)
+            elif inside(p):
+                clipped.append(crossing(p, q))
+        if not clipped:
+            return 0.0
+    inter = shoelace(clipped) if len(clipped) >= 3 else 0.0
+    union = shoelace(a) + shoelace(b) - inter
+    return inter / union if union > 0 else 0.0
+
+def rotated_boxes(rng, n: int) -> np.ndarray:
+    centers = rng.uniform(20, 80, (n, 1, 2))
+    sizes = rng.uniform(5, 40, (n, 1, 2))
+    angles = rng.uniform(0, np.pi, n)
+    corners = np.array([[-0.5, -0.5], [0.5, -0.5], [0.5, 0.5], [-0.5, 0.5]]) * sizes
+    rotation = np.stack([np.stack([np.cos(angles), -np.sin(angles)], -1), np.stack([np.sin(angles), np.cos(angles)], -1)], -2)
+    return centers + corners @ rotation.transpose(0, 2, 1)
+
+def test_quad_iou_matches_reference():
+    rng = np.random.default_rng(0)
+    a = rotated_boxes(rng, 200)
+    b = rotated_boxes(rng, 200)
+    ## Mixed winding order
+    b[::2] = b[::2, ::-1]
+    expected = np.array([reference_iou(p, q) for p, q in zip(a, b)])
+    assert np.allclose(quad_iou(a, b), expected, atol=1e-9)
+    assert np.allclose(quad_iou(a, b, chunk_size=7), expected, atol=1e-9)
+    assert (expected > 0).sum() > 20
+
+def test_quad_iou_special_cases():
+    square = np.array([[[0, 0], [10, 0], [10, 10], [0, 10]]], dtype=np.float64)
+    assert np.allclose(quad_iou(square, square), [1.0])
+    assert np.allclose(quad_iou(square, square + 20), [0.0])
+    assert np.allclose(quad_iou(square, square + [5, 0]), [50 / 150])
+    assert np.allclose(quad_iou(square, np.zeros_like(square)), [0.0])
+
+def test_xywh_round_trip_and_iou():
+    boxes = np.array([[0, 0, 10, 10], [5, 5, 2, 4]], dtype=np.float64)
+    polygons = xywh_to_polygons(boxes)
+    assert np.allclose(polygons_to_xywh(polygons), boxes)
+    assert np.allclose(polygon_area(polygons), [100, 8])
+    shifted = boxes + [5, 0, 0, 0]
+    assert np.allclose(iou_xywh(boxes, shifted), quad_iou(polygons, xywh_to_polygons(shifted)))
@@ -0,0 +1,20 @@
+import numpy as np
+from pycocotools import mask
+
+from hoot.index import build_index, load_index
+from hoot.synthetic import encode_mask
+
+def test_rle_keeps_the_mask_size(tmp_path, write_video):
+    ## A half-resolution mask in a 16x20 video (eg. a rescaled annotation)
+    occluder = np.zeros((8, 10), dtype=np.uint8)
+    occluder[2:5, 3:7] = 1
+    box = [[1.0, 1.0], [6.0, 1.0], [6.0, 5.0], [1.0, 5.0]]
+    frames = [{'frame_id': 1, 'rot_bb': box, 'aa_bb': box, 'occ_masks': {'s': encode_mask(occluder)},
+               'attributes': {'partial_obj_occlusion': True}}]
+    write_video(tmp_path.joinpath('data', 'apple', '001'), frames, 16, 20)
+
+    build_index(str(tmp_path.joinpath('data')), str(tmp_path.joinpath('index')))
+    index = load_index(str(tmp_path.joinpath('index')))
+    assert index.has_occluder('s').tolist() == [True]
+    assert index.rle(0, 't') is None
+    assert np.array_equal(mask.decode(index.rle(0, 's')), occluder)
@@ -0,0 +1,66 @@
+import hashlib
+import zipfile
+
+import pytest
+
+from hoot.manifest import (ZIP_LOCAL_HEADER, corrupt_members, decode_member, hash_files, manifest_path,
+                           member_data_range, merkle_root, zip_manifest)
+
+def sha(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def test_merkle_root_is_order_independent_and_content_sensitive():
+    hashes = {'000001.png': sha(b'a'), '000002.png': sha(b'b'), 'anno.json': sha(b'c')}
+    root = merkle_root(hashes)
+    assert merkle_root(dict(reversed(list(hashes.items())))) == root
+    assert merkle_root({**hashes, 'anno.json': sha(b'd')}) != root
+    ## A renamed file changes the root even with the same content
+    assert merkle_root({'000003.png' if k == '000002.png' else k: v for k, v in hashes.items()}) != root
+    assert merkle_root({**hashes, 'meta.info': sha(b'e')}) != root
+    assert merkle_root({}) == sha(b'')
+
+def test_merkle_root_tree_shape():
+    leaf = lambda name, digest: hashlib.sha256(b'\x00' + name.encode() + b'\x00' + bytes.fromhex(digest)).digest()
+    node = lambda left, right: hashlib.sha256(b'\x01' + left + right).digest()
+    a, b, c = (leaf(n, sha(n.encode())) for n in 'abc')
+    assert merkle_root({'a': sha(b'a')}) == a.hex()
+    ## The odd leaf is carried up as is
+    assert merkle_root({n: sha(n.encode()) for n in 'abc'}) == node(node(a, b), c).hex()
+
+def test_corrupt_members():
+    manifest = {'files': [{'name': 'a', 'size': 1, 'sha256': sha(b'a')},
+                          {'name': 'b', 'size': 1, 'sha256': sha(b'b')},
+                          {'name': 'c', 'size': 1, 'sha256': sha(b'c')}]}
+    found = {'a': (1, sha(b'a')), 'b': (1, sha(b'x')), 'd': (1, sha(b'd'))}
+    assert corrupt_members(manifest, found) == ['b', 'c']
+    assert corrupt_members(manifest, {'a': (1, sha(b'a')), 'b': (1, sha(b'b')), 'c': (2, sha(b'c'))}) == ['c']
+
+def test_zip_members_round_trip(tmp_path):
+    contents = {'000001.png': bytes(range(256)) * 40, 'anno.json': b'{"frames": []}' * 100, 'empty.txt': b''}
+    zip_path = tmp_path.joinpath('001.zip')
+    with zipfile.ZipFile(zip_path, 'w') as z:
+        for name, data in contents.items():
+            z.writestr(name, data, compress_type=zipfile.ZIP_STORED if name.endswith('.png') else zipfile.ZIP_DEFLATED)
+    with zipfile.ZipFile(zip_path) as z:
+        manifest = zip_manifest(z)
+    assert manifest['merkle_root'] == merkle_root({name: sha(data) for name, data in contents.items()})
+
+    raw = zip_path.read_bytes()
+    for member in manifest['files']:
+        header = raw[member['header_offset']:member['header_offset'] + ZIP_LOCAL_HEADER.size]
+        start, end = member_data_range(member, header)
+        assert decode_member(member, raw[start:end]) == contents[member['name']]
+        if member['compress_type'] == zipfile.ZIP_STORED and end > start:
+            with pytest.raises(ValueError):
+                decode_member(member, raw[start:end - 1] + bytes([raw[end - 1] ^ 1]))
+
+    with pytest.raises(ValueError):
+        member_data_range(manifest['files'][0], b'\0' * ZIP_LOCAL_HEADER.size)
+
+def test_hash_files(tmp_path):
+    tmp_path.joinpath('a.txt').write_bytes(b'hello')
+    tmp_path.joinpath('b.txt').write_bytes(b'')
+    assert hash_files(tmp_path, threads=2) == {'a.txt': (5, sha(b'hello')), 'b.txt': (0, sha(b''))}
+
+def test_manifest_path():
+    assert manifest_path('apple/001.zip') == 'apple/001.manifest.json'
@@ -0,0 +1,62 @@
+import pytest
+
+from hoot.metadata import AnnotatedVideo, OcclusionLevels
+from hoot.query import compile_query
+
+def video(id: str, download_size: int, test_split: bool, frame_level: float, tags, zip_sha256=None) -> AnnotatedVideo:
+    return AnnotatedVideo(id=id, path=f'{id}.zip', sha256='0' * 64, download_size=download_size, install_size=2 * download_size,
+                          test_split=test_split, occlusion_levels=OcclusionLevels(frame_level, frame_level / 2, frame_level / 2),
+                          tags=tags, zip_sha256=zip_sha256)
+
+VIDEOS = [
+    ('apple', video('001', 100, True, 0.8, ['solid', 'semi_transparent'])),
+    ('apple', video('002', 300, False, 0.2, ['sparse'], zip_sha256='ab' * 32)),
+    ('pineapple', video('001', 200, True, 0.5, [])),
+    ('toy_car', video('003', 50, False, 0.9, ['semi_transparent'])),
+]
+
+def select(text: str):
+    query = compile_query(text)
+    return [(class_name, v.id) for class_name, v in VIDEOS if query(v, class_name)]
+
+def test_comparisons():
+    assert select('download_size > 150') == [('apple', '002'), ('pineapple', '001')]
+    assert select('occlusion_levels.frame_occlusion_level >= 0.8') == [('apple', '001'), ('toy_car', '003')]
+    assert select('tags contains semi_transparent') == [('apple', '001'), ('toy_car', '003')]
+    assert select('test_split') == [('apple', '001'), ('pineapple', '001')]
+    assert select("class == 'toy_car'") == [('toy_car', '003')]
+
+def test_boolean_operators():
+    assert select('not test_split and (class == apple or download_size < 100)') == [('apple', '002'), ('toy_car', '003')]
+    assert select('test_split or tags contains sparse') == [('apple', '001'), ('apple', '002'), ('pineapple', '001')]
+
+def test_values_take_the_field_type():
+    ## ids are strings, a bare 001 must not become the int 1
+    assert select('id == 001') == [('apple', '001'), ('pineapple', '001')]
+    assert select('test_split == false') == [('apple', '002'), ('toy_car', '003')]
+
+def test_unset_optional_fields_never_match_orderings():
+    assert select("zip_sha256 > ''") == [('apple', '002')]
+    assert select('zip_sha256') == [('apple', '002')]
+
+def test_in_is_membership_in_a_list():
+    assert select('class in (apple, toy_car)') == [('apple', '001'), ('apple', '002'), ('toy_car', '003')]
+    assert select("class in ['pineapple']") == [('pineapple', '001')]
+    assert select('download_size in (50, 300)') == [('apple', '002'), ('toy_car', '003')]
+
+@pytest.mark.parametrize('text', [
+    'class in "pineapple"',
+    'class in pineapple',
+    'class in (apple',
+    'class in (apple]',
+    'tags > 5',
+    'test_split > 1',
+    'download_size == big',
+    'no_such_field == 1',
+    'occlusion_levels.nope > 0',
+    'download_size > 1 and',
+    '(test_split',
+])
+def test_invalid_queries_fail_to_compile(text):
+    with pytest.raises(ValueError):
+        compile_query(text)
@@ -0,0 +1,49 @@
+import pytest
+
+from hoot import sync
+from hoot.downloader import load_local_metadata, local_installed_name, save_local_metadata
+from hoot.metadata import AnnotatedVideo, HootDataset, OcclusionLevels, TargetClass
+
+def release(**sha256s) -> HootDataset:
+    classes = {}
+    for key, sha256 in sha256s.items():
+        class_name, video_id = key.split('_')
+        classes.setdefault(class_name, []).append(AnnotatedVideo(
+            id=video_id, path=f'{class_name}/{video_id}.zip', sha256=sha256, download_size=100, install_size=100,
+            test_split=False, occlusion_levels=OcclusionLevels(0.0, 0.0, 0.0)))
+    return HootDataset(version='1.0', change_log='', classes=[TargetClass(name, videos) for name, videos in classes.items()])
+
+class FakeDownloader:
+    def __init__(self, metadata: HootDataset):
+        self.metadata = metadata
+
+    def load_metadata(self) -> HootDataset:
+        return self.metadata
+
+@pytest.fixture
+def subset_install(tmp_path):
+    ## Installed with --where "class == 'apple'" from a release that also has a toy car
+    old = release(apple_001='a', apple_002='a', toycar_001='a')
+    for video_id in ('001', '002'):
+        tmp_path.joinpath('apple', video_id).mkdir(parents=True)
+    save_local_metadata(old, tmp_path, {('apple', '001'), ('apple', '002')})
+    return tmp_path
+
+def test_sync_keeps_a_subset_install_a_subset(subset_install, monkeypatch):
+    new = release(apple_001='b', apple_002='a', toycar_001='b', toycar_002='a')
+    monkeypatch.setattr(sync, 'version_downloader', lambda version, jobs: FakeDownloader(new))
+    diff = sync.sync_archives(str(subset_install), 'v1_0-HD', dry_run=True)
+    ## The skipped toy car isn't added, and its change doesn't matter - only the new video is added
+    assert [(c, v.id) for c, v in diff.added] == [('toycar', '002')]
+    assert [(c, old.id) for c, old, _ in diff.changed] == [('apple', '001')]
+    assert [(c, v.id) for c, v in diff.unchanged] == [('apple', '002')]
+    assert diff.removed == []
+
+def test_local_metadata_round_trip(subset_install):
+    metadata, installed = load_local_metadata(subset_install)
+    assert [v.id for c in metadata.classes for v in c.videos] == ['001', '002', '001']
+    assert installed == {('apple', '001'), ('apple', '002')}
+
+    ## Installs from before the installed set was saved count what's on disk
+    subset_install.joinpath(local_installed_name).unlink()
+    assert load_local_metadata(subset_install)[1] == installed
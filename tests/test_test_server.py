@@ -0,0 +1,26 @@
+import pytest
+
+from hoot.test_server import parse_range
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-9', (0, 10)),
+    ('bytes=5-5', (5, 6)),
+    ('bytes=7-', (7, 100)),
+    ('bytes=-10', (90, 100)),
+    ('bytes=-500', (0, 100)),
+    ('bytes=90-500', (90, 100)),
+    (' bytes = 3-4', (3, 5)),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 100) == expected
+
+@pytest.mark.parametrize('header', [
+    'bytes=5-3',
+    'bytes=0-1,5-6',
+    'items=0-9',
+    'bytes=a-b',
+    'bytes=-',
+    'bytes=',
+])
+def test_parse_range_ignores_invalid_headers(header):
+    assert parse_range(header, 100) is None